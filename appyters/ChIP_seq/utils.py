@@ -3,6 +3,7 @@ import pandas as pd
 import os
 import urllib3
 import requests, json
+from enrichr_client import get_client as get_enrichr_client
 import sys
 import random
 from time import sleep
@@ -48,18 +49,7 @@ def display_object(counter, caption, df=None, istable=True):
 
 
 def submit_enrichr_geneset(geneset, label=''):
-    ENRICHR_URL = 'http://amp.pharm.mssm.edu/Enrichr/addList'
-    genes_str = '\n'.join(geneset)
-    payload = {
-        'list': (None, genes_str),
-        'description': (None, label)
-    }
-    response = requests.post(ENRICHR_URL, files=payload)
-    if not response.ok:
-        raise Exception('Error analyzing gene list')
-    time.sleep(0.5)
-    data = json.loads(response.text)
-    return data
+    return get_enrichr_client().add_list(geneset, description=label)
 
 def run_enrichr(geneset, signature_label):
     # Submit to Enrichr
@@ -68,19 +58,11 @@ def run_enrichr(geneset, signature_label):
     return enrichr_ids
 
 def get_enrichr_results(user_list_id, gene_set_libraries, overlappingGenes=True, geneset=None):
-    ENRICHR_URL = 'http://amp.pharm.mssm.edu/Enrichr/enrich'
-    query_string = '?userListId=%s&backgroundType=%s'
+    client = get_enrichr_client()
+    responses = client.map(lambda gene_set_library: client.enrich(user_list_id, gene_set_library), gene_set_libraries)
     results = []
-    for gene_set_library, label in gene_set_libraries.items():
-        response = requests.get(
-                    ENRICHR_URL +
-                       query_string % (user_list_id, gene_set_library)
-                )
-        if not response.ok:
-            raise Exception('Error fetching enrichment results')
-
-        data = json.loads(response.text)
-        resultDataframe = pd.DataFrame(data[gene_set_library], columns=[
+    for (gene_set_library, label), data in zip(gene_set_libraries.items(), responses):
+        resultDataframe = pd.DataFrame(data, columns=[
                                        'rank', 'term_name', 'pvalue', 'zscore', 'combined_score', 'overlapping_genes', 'FDR', 'old_pvalue', 'old_FDR'])
         selectedColumns = ['term_name', 'zscore', 'combined_score', 'pvalue', 'FDR'] if not overlappingGenes else [
             'term_name', 'zscore', 'combined_score', 'FDR', 'pvalue', 'overlapping_genes']
@@ -114,7 +96,8 @@ def get_enrichr_results_by_library(enrichr_results, signature_label, plot_type='
         }
 
     # Get Enrichment Results
-    enrichment_results = {geneset: get_enrichr_results(enrichr_results[geneset]['userListId'], gene_set_libraries=libraries, geneset=geneset) for geneset in ['upregulated', 'downregulated']}
+    genesets = ['upregulated', 'downregulated']
+    enrichment_results = dict(zip(genesets, get_enrichr_client().map(lambda geneset: get_enrichr_results(enrichr_results[geneset]['userListId'], gene_set_libraries=libraries, geneset=geneset), genesets)))
     enrichment_results['signature_label'] = signature_label
     enrichment_results['plot_type'] = plot_type
     enrichment_results['sort_results_by'] = sort_results_by
@@ -145,15 +128,8 @@ def get_enrichr_result_tables_by_library(enrichr_results, signature_label, libra
         }
 
 
-    # Initialize results
-    results = []
-
-    # Loop through genesets
-    for geneset in ['upregulated', 'downregulated']:
-
-        # Append ChEA results
-        enrichment_dataframe = get_enrichr_results(enrichr_results[geneset]['userListId'], gene_set_libraries=libraries, geneset=geneset)
-        results.append(enrichment_dataframe)
+    # Get results of each geneset
+    results = get_enrichr_client().map(lambda geneset: get_enrichr_results(enrichr_results[geneset]['userListId'], gene_set_libraries=libraries, geneset=geneset), ['upregulated', 'downregulated'])
 
     # Concatenate results
     enrichment_dataframe = pd.concat(results)
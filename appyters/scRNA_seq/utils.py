@@ -1,6 +1,7 @@
 # Basic libraries
 import pandas as pd
 import requests, json
+from enrichr_client import get_client as get_enrichr_client, GeneSetLibrary, enrichment_table, load_library
 import time
 import numpy as np
 import warnings
@@ -45,10 +46,8 @@ import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 import umap.umap_ as umap
 from sklearn.decomposition import NMF
-from statsmodels.stats.multitest import multipletests
 
 from IPython.display import display, HTML
-from maayanlab_bioinformatics.enrichment.crisp import enrich_crisp, fisher_overlap
 
 # Bokeh
 from bokeh.io import output_notebook
@@ -437,18 +436,7 @@ def get_signatures(classes, dataset, method, meta_class_column_name, cluster=Tru
 
 
 def submit_enrichr_geneset(geneset, label):
-    ENRICHR_URL = 'https://amp.pharm.mssm.edu/Enrichr/addList'
-    genes_str = '\n'.join(geneset)
-    payload = {
-        'list': (None, genes_str),
-        'description': (None, label)
-    }
-    response = requests.post(ENRICHR_URL, files=payload)
-    if not response.ok:
-        raise Exception('Error analyzing gene list')
-    time.sleep(0.5)
-    data = json.loads(response.text)
-    return data
+    return get_enrichr_client().add_list(geneset, description=label)
 
 
 def run_enrichr(signature, signature_label, geneset_size=500, fc_colname = 'logFC'):
@@ -464,24 +452,16 @@ def run_enrichr(signature, signature_label, geneset_size=500, fc_colname = 'logF
     }
 
     # Submit to Enrichr
-    enrichr_ids = {geneset_label: submit_enrichr_geneset(geneset=geneset, label=signature_label+', '+geneset_label+', from scRNA-seq Appyter') for geneset_label, geneset in genesets.items()}
+    enrichr_ids = dict(zip(genesets, get_enrichr_client().map(lambda geneset_label: submit_enrichr_geneset(geneset=genesets[geneset_label], label=signature_label+', '+geneset_label+', from scRNA-seq Appyter'), genesets)))
     enrichr_ids['signature_label'] = signature_label
     return enrichr_ids
 
 def get_enrichr_results(user_list_id, gene_set_libraries, overlappingGenes=True, geneset=None):
-    ENRICHR_URL = 'http://amp.pharm.mssm.edu/Enrichr/enrich'
-    query_string = '?userListId=%s&backgroundType=%s'
+    client = get_enrichr_client()
+    responses = client.map(lambda gene_set_library: client.enrich(user_list_id, gene_set_library), gene_set_libraries)
     results = []
-    for gene_set_library, label in gene_set_libraries.items():
-        response = requests.get(
-                    ENRICHR_URL +
-                       query_string % (user_list_id, gene_set_library)
-                )
-        if not response.ok:
-            raise Exception('Error fetching enrichment results')
-
-        data = json.loads(response.text)
-        resultDataframe = pd.DataFrame(data[gene_set_library], columns=[
+    for (gene_set_library, label), data in zip(gene_set_libraries.items(), responses):
+        resultDataframe = pd.DataFrame(data, columns=[
                                        'rank', 'term_name', 'pvalue', 'zscore', 'combined_score', 'overlapping_genes', 'FDR', 'old_pvalue', 'old_FDR'])
         selectedColumns = ['term_name', 'zscore', 'combined_score', 'pvalue', 'FDR'] if not overlappingGenes else [
             'term_name', 'zscore', 'combined_score', 'FDR', 'pvalue', 'overlapping_genes']
@@ -520,7 +500,8 @@ def get_enrichr_results_by_library(enrichr_results, signature_label, plot_type='
             'GWAS_Catalog_2019': 'GWAS Catalog',
         }
     # Get Enrichment Results
-    enrichment_results = {geneset: get_enrichr_results(enrichr_results[geneset]['userListId'], gene_set_libraries=libraries, geneset=geneset) for geneset in ['upregulated', 'downregulated']}
+    genesets = ['upregulated', 'downregulated']
+    enrichment_results = dict(zip(genesets, get_enrichr_client().map(lambda geneset: get_enrichr_results(enrichr_results[geneset]['userListId'], gene_set_libraries=libraries, geneset=geneset), genesets)))
     enrichment_results['signature_label'] = signature_label
     enrichment_results['plot_type'] = plot_type
     enrichment_results['sort_results_by'] = sort_results_by
@@ -550,86 +531,28 @@ def get_enrichr_result_tables_by_library(enrichr_results, signature_label, libra
         }
 
 
-    # Initialize results
-    results = []
-
-    # Loop through genesets
-    for geneset in ['upregulated', 'downregulated']:
-
-        # Append ChEA results
-        enrichment_dataframe = get_enrichr_results(enrichr_results[geneset]['userListId'], gene_set_libraries=libraries, geneset=geneset)
-        results.append(enrichment_dataframe)
+    # Get results of each geneset
+    results = get_enrichr_client().map(lambda geneset: get_enrichr_results(enrichr_results[geneset]['userListId'], gene_set_libraries=libraries, geneset=geneset), ['upregulated', 'downregulated'])
 
     # Concatenate results
     enrichment_dataframe = pd.concat(results)
 
     return {'enrichment_dataframe': enrichment_dataframe, 'signature_label': signature_label}
 
-# enrichment analysis for uploaded gmt
-def get_library(filename):
-    # processes library data
-    raw_library_data = []
-    library_data = []
-
-    
-    with open(filename, "r") as f:
-        for line in f.readlines():
-            raw_library_data.append(line.split("\t\t"))
-    name = []
-    gene_list = []
-
-    for i in range(len(raw_library_data)):
-        name += [raw_library_data[i][0]]
-        raw_genes = raw_library_data[i][1].replace('\t', ' ')
-        gene_list += [raw_genes[:-1]]
-
-    library_data = [list(a) for a in zip(name, gene_list)]
-    
-    return library_data
-
-def library_to_dict(library_data):
-    dictionary = dict()
-    for i in range(len(library_data)):
-        row = library_data[i]
-        dictionary[row[0]] = [x.upper() for x in row[1].split(" ")]
-    return dictionary
-
-def get_library_iter(library_data):
-    for term in library_data.keys():
-        single_set = library_data[term]
-        yield term, single_set
-
-def get_enrichment_results(items, library_data):
-    return sorted(enrich_crisp(items, get_library_iter(library_data), n_background_entities=20000, preserve_overlap=True), key=lambda r: r[1].pvalue)
-
-# Call enrichment results and return a plot and dataframe for Scatter Plot
-def get_values(obj_list):
-    pvals = []
-    odds_ratio = []
-    n_overlap = []
-    overlap = []
-    for i in obj_list:
-        pvals.append(i.pvalue)
-        odds_ratio.append(i.odds_ratio)
-        n_overlap.append(i.n_overlap)
-        overlap.append(i.overlap)
-    return pvals, odds_ratio, n_overlap, overlap
-
-def get_qvalue(p_vals):
-    r = multipletests(p_vals, method="fdr_bh")
-    return r[1]
-
-
-def enrichment_analysis(items, library_data):    
-    items = [x.upper() for x in items]
-    all_results = get_enrichment_results(items, library_data)
-    unzipped_results = list(zip(*all_results))
-    pvals, odds_ratio, n_overlap, overlap = get_values(unzipped_results[1])
-    df = pd.DataFrame({"term_name":unzipped_results[0], "pvalue": pvals, \
-                       "odds_ratio": odds_ratio, "n_overlap": n_overlap, "overlap": overlap})
+# Enrichment of many queries (label -> items) against the library at once, one dataframe per query
+def enrichment_analysis_many(queries, library_data):
+    queries = {label: [x.upper() for x in items] for label, items in queries.items()}
+    library = library_data if isinstance(library_data, GeneSetLibrary) else GeneSetLibrary.from_gene_sets(library_data.items())
+    df = enrichment_table(library, queries, n_background=20000)
+    df = df.rename(columns={"qvalue": "q value"})
     df["-log(p value)"] = -np.log10(df["pvalue"])
-    df["q value"] = get_qvalue(df["pvalue"].tolist())
-    return [list(unzipped_results[0])], [pvals], df
+    columns = ["term_name", "pvalue", "odds_ratio", "n_overlap", "overlap", "-log(p value)", "q value"]
+    groups = {label: group[columns].reset_index(drop=True) for label, group in df.groupby("query", sort=False)}
+    return {label: groups.get(label, pd.DataFrame(columns=columns)) for label in queries}
+
+def enrichment_analysis(items, library_data):
+    df = enrichment_analysis_many({0: items}, library_data)[0]
+    return [df["term_name"].tolist()], [df["pvalue"].tolist()], df
 
 
 import hashlib
@@ -899,7 +822,8 @@ def visualize_enrichment_analysis(adata, signatures, meta_class_column_name, dif
         
     results = {}    
     if libraries_tab == 'Yes' or libraries_tab == 'All':
-        results['enrichr'] = {}
+        # Submit the signatures to Enrichr in parallel
+        results['enrichr'] = dict(zip(signatures, get_enrichr_client().map(lambda label: run_enrichr(signature=signatures[label], signature_label=label, fc_colname=fc_colname, geneset_size=gene_topk), signatures)))
         for label, signature in signatures.items():
             # Run analysis
             if enrichment_groupby == "user_defined_class":
@@ -912,14 +836,18 @@ def visualize_enrichment_analysis(adata, signatures, meta_class_column_name, dif
                 case_name = label.split(" vs. ")[0]
                 col_name = "batch"
 
-            results['enrichr'][label] = run_enrichr(signature=signature, signature_label=label, fc_colname=fc_colname, geneset_size=gene_topk)
-            display(Markdown("*Enrichment Analysis Result: {} (Up-regulated in {})*".format(label, case_name)))
-            display_link("https://amp.pharm.mssm.edu/Enrichr/enrich?dataset={}".format(results['enrichr'][label]["upregulated"]["shortId"]))
-            display(Markdown("*Enrichment Analysis Result: {} (Down-regulated in {})*".format(label, case_name)))
-            display_link("https://amp.pharm.mssm.edu/Enrichr/enrich?dataset={}".format(results['enrichr'][label]["downregulated"]["shortId"]))
-        table_counter = display_object(table_counter, "The table displays links to Enrichr containing the results of enrichment analyses generated by analyzing the up-regulated and down-regulated genes from a differential expression analysis. By clicking on these links, users can interactively explore and download the enrichment results from the Enrichr website.", istable=True)
+            # Lists enriched locally have no Enrichr page to link to
+            if results['enrichr'][label]["upregulated"]["shortId"] is not None:
+                display(Markdown("*Enrichment Analysis Result: {} (Up-regulated in {})*".format(label, case_name)))
+                display_link("https://amp.pharm.mssm.edu/Enrichr/enrich?dataset={}".format(results['enrichr'][label]["upregulated"]["shortId"]))
+            if results['enrichr'][label]["downregulated"]["shortId"] is not None:
+                display(Markdown("*Enrichment Analysis Result: {} (Down-regulated in {})*".format(label, case_name)))
+                display_link("https://amp.pharm.mssm.edu/Enrichr/enrich?dataset={}".format(results['enrichr'][label]["downregulated"]["shortId"]))
+        if any(result[geneset]["shortId"] is not None for result in results['enrichr'].values() for geneset in ["upregulated", "downregulated"]):
+            table_counter = display_object(table_counter, "The table displays links to Enrichr containing the results of enrichment analyses generated by analyzing the up-regulated and down-regulated genes from a differential expression analysis. By clicking on these links, users can interactively explore and download the enrichment results from the Enrichr website.", istable=True)
     if libraries_tab == 'No' or libraries_tab == 'All':
         results['user_defined_enrichment'] = {}
+        up_genes = {}
         for label, signature in signatures.items():
 
             # Run analysis
@@ -933,63 +861,39 @@ def visualize_enrichment_analysis(adata, signatures, meta_class_column_name, dif
                 case_name = label.split(" vs. ")[1]
                 col_name = "batch"
 
-            user_library = library_to_dict(get_library(enrichr_libraries_filename))
-
             # Sort signature
             up_signature = signature[signature[fc_colname] > 0]
-            up_genes = [x.upper() for x in up_signature.index[:gene_topk].tolist()]
+            up_genes[label] = [x.upper() for x in up_signature.index[:gene_topk].tolist()]
 
-            results['user_defined_enrichment'][label] = dict()
-            _, _, results['user_defined_enrichment'][label]['enrichment_dataframe'] = enrichment_analysis(up_genes, user_library)
-            results['user_defined_enrichment'][label]['enrichment_dataframe']['gene_set_library'] = enrichr_libraries_filename
+        # Test every signature against the library at once
+        user_library = load_library(enrichr_libraries_filename, upper=True)
+        for label, enrichment_dataframe in enrichment_analysis_many(up_genes, user_library).items():
+            enrichment_dataframe['gene_set_library'] = enrichr_libraries_filename
+            results['user_defined_enrichment'][label] = {'enrichment_dataframe': enrichment_dataframe}
     
     if "Gene Ontology" in enrichr_libraries:
-        results['go_enrichment'] = {}
-        for label, signature in signatures.items():
-            # Run analysis
-            results['go_enrichment'][label] = get_enrichr_results_by_library(results['enrichr'][label], label, library_type='go', version='2018')
+        # Run analysis
+        results['go_enrichment'] = dict(zip(signatures, get_enrichr_client().map(lambda label: get_enrichr_results_by_library(results['enrichr'][label], label, library_type='go', version='2018'), signatures)))
             
     if "Pathway" in enrichr_libraries:
-        # Initialize results
-        results['pathway_enrichment'] = {}
-
-        # Loop through results
-        for label, signature in signatures.items():
-            # Run analysis
-            results['pathway_enrichment'][label] = get_enrichr_results_by_library(results['enrichr'][label], label, library_type='pathway')
+        # Run analysis
+        results['pathway_enrichment'] = dict(zip(signatures, get_enrichr_client().map(lambda label: get_enrichr_results_by_library(results['enrichr'][label], label, library_type='pathway'), signatures)))
     if "Transcription Factor" in enrichr_libraries:
-        # Initialize results
-        results['tf_enrichment'] = {}
-        # Loop through results
-        for label, signature in signatures.items():
-            # Run analysis
-            results['tf_enrichment'][label] = get_enrichr_result_tables_by_library(enrichr_results=results['enrichr'][label], signature_label=label, library_type='tf')
+        # Run analysis
+        results['tf_enrichment'] = dict(zip(signatures, get_enrichr_client().map(lambda label: get_enrichr_result_tables_by_library(enrichr_results=results['enrichr'][label], signature_label=label, library_type='tf'), signatures)))
     if "Kinase" in enrichr_libraries:
-        # Initialize results
-        results['kinase_enrichment'] = {}
-
-        # Loop through results
-        for label, enrichr_results in results['enrichr'].items():
-            # Run analysis
-            results['kinase_enrichment'][label] = get_enrichr_result_tables_by_library(enrichr_results=enrichr_results, signature_label=label, library_type="ke")
+        # Run analysis
+        results['kinase_enrichment'] = dict(zip(results['enrichr'], get_enrichr_client().map(lambda label: get_enrichr_result_tables_by_library(enrichr_results=results['enrichr'][label], signature_label=label, library_type="ke"), results['enrichr'])))
 
     if "miRNA" in enrichr_libraries:
-        results['mirna_enrichment'] = {}
-
-        # Loop through results
-        for label, enrichr_results in results['enrichr'].items():
-            # Run analysis
-            results['mirna_enrichment'][label] = get_enrichr_result_tables_by_library(enrichr_results=enrichr_results, signature_label=label, library_type="mirna")
+        # Run analysis
+        results['mirna_enrichment'] = dict(zip(results['enrichr'], get_enrichr_client().map(lambda label: get_enrichr_result_tables_by_library(enrichr_results=results['enrichr'][label], signature_label=label, library_type="mirna"), results['enrichr'])))
     if "Cell Type" in enrichr_libraries:
-        results['celltype_enrichment'] = {}
-        for label, signature in signatures.items():
-            # Run analysis
-            results['celltype_enrichment'][label] = get_enrichr_results_by_library(results['enrichr'][label], label, library_type='celltype')
+        # Run analysis
+        results['celltype_enrichment'] = dict(zip(signatures, get_enrichr_client().map(lambda label: get_enrichr_results_by_library(results['enrichr'][label], label, library_type='celltype'), signatures)))
     if "Disease" in enrichr_libraries:
-        results['disease_enrichment'] = {}
-        for label, signature in signatures.items():
-            # Run analysis
-            results['disease_enrichment'][label] = get_enrichr_results_by_library(results['enrichr'][label], label, library_type='disease', version='2018')
+        # Run analysis
+        results['disease_enrichment'] = dict(zip(signatures, get_enrichr_client().map(lambda label: get_enrichr_results_by_library(results['enrichr'][label], label, library_type='disease', version='2018'), signatures)))
     
     library_option_list = set()
     top3_enriched_terms_dict = defaultdict(list)
@@ -0,0 +1,220 @@
+''' Benchmark the catalog's appyter images: compressed & uncompressed size, layer count, the time
+until `appyter-catalog-helper entrypoint` answers with a 200 on APPYTER_PORT and the time until the
+first cell of the default notebook is executed. Each run is appended to a trend file so that
+catalog versions can be compared.
+'''
+
+import os
+import sys
+import json
+import time
+import glob
+import zlib
+import statistics
+
+root_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+metrics = ['size', 'compressed_size', 'layers', 'ready_seconds', 'kernel_seconds', 'first_cell_seconds']
+
+def get_image(config, environ=os.environ):
+  ''' The image of an appyter as tagged by docker-compose.yml
+  '''
+  return f"{environ.get('DOCKER_REGISTRY') or 'maayanlab'}/appyter-{config['name'].lower()}:{config['version']}-{environ.get('appyter_tag', '')}{environ.get('appyter_version', '')}"
+
+def docker(*args, check=True, **kwargs):
+  from subprocess import run, PIPE
+  proc = run(['docker', *args], stdout=PIPE, stderr=PIPE, **kwargs)
+  assert not check or proc.returncode == 0, f"`docker {' '.join(args)}` failed: {proc.stderr.decode(errors='replace')}"
+  return proc
+
+def ensure_image(image, appyter, build=False, pull=False):
+  ''' Build the image (through the build graph), pull it, or pull it only if it isn't available locally
+  '''
+  from subprocess import run
+  if build:
+    assert run([sys.executable, '-m', 'compose.build_graph', f"build:{appyter}"], cwd=root_dir).returncode == 0, f"Building {image} failed"
+  elif pull or docker('image', 'inspect', image, check=False).returncode != 0:
+    docker('pull', image)
+
+def compressed_size(image):
+  ''' The size of the image as pushed (the sum of its compressed layers) if it is in a registry,
+  otherwise that of `docker save` gzipped
+  '''
+  proc = docker('manifest', 'inspect', '-v', image, check=False)
+  if proc.returncode == 0:
+    manifests = json.loads(proc.stdout)
+    if type(manifests) == list: manifests = manifests[0]
+    return sum(layer['size'] for layer in manifests['SchemaV2Manifest']['layers'])
+  from subprocess import Popen, PIPE
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  size = 0
+  with Popen(['docker', 'save', image], stdout=PIPE) as p:
+    for chunk in iter(lambda: p.stdout.read(1024**2), b''):
+      size += len(compressor.compress(chunk))
+    assert p.wait() == 0, f"`docker save {image}` failed"
+  return size + len(compressor.flush())
+
+def image_sizes(image):
+  inspect = json.loads(docker('image', 'inspect', image).stdout)[0]
+  return dict(
+    size=inspect['Size'],
+    compressed_size=compressed_size(image),
+    layers=len(inspect['RootFS']['Layers']),
+  )
+
+def time_to_ready(image, timeout=600):
+  ''' Seconds from `docker run` until the catalog entrypoint serves a 200
+  '''
+  import urllib.request, urllib.error
+  start = time.time()
+  container = docker(
+    'run', '-d', '-p', '127.0.0.1::5000',
+    '-e', 'APPYTER_PORT=5000', '-e', 'APPYTER_PREFIX=/',
+    image, 'appyter-catalog-helper', 'entrypoint',
+  ).stdout.decode().strip()
+  try:
+    url = None
+    while time.time() - start < timeout:
+      if url is None:
+        port = docker('port', container, '5000', check=False).stdout.decode().strip().splitlines()
+        if port: url = f"http://{port[0]}/"
+      if url is not None:
+        try:
+          with urllib.request.urlopen(url, timeout=5) as resp:
+            if resp.status == 200:
+              return time.time() - start
+        except (urllib.error.URLError, ConnectionError, OSError):
+          pass
+      time.sleep(0.1)
+    raise Exception(f"{image} did not become ready within {timeout}s")
+  finally:
+    docker('rm', '-f', container, check=False)
+
+def default_notebook(image, nbfile, tmp_directory):
+  ''' Construct the default notebook of the appyter into tmp_directory
+  '''
+  inspect = json.loads(docker('run', '--rm', '-e', 'APPYTER_PREFIX=', image, 'appyter', 'nbinspect', nbfile).stdout)
+  default_args = {field['args']['name']: field['args'].get('default') for field in inspect}
+  docker(
+    'run', '--rm', '-i', '-v', f"{tmp_directory}:/data", image,
+    'appyter', 'nbconstruct', f"--output=/data/{nbfile}", nbfile,
+    input=json.dumps(default_args).encode(),
+  )
+
+def time_to_first_cell(image, nbfile, timeout=600):
+  ''' Seconds from `docker run` of `appyter nbexecute` on the default notebook until the kernel
+  is ready and until its first cell completed
+  '''
+  import uuid
+  import tempfile
+  from subprocess import Popen, PIPE, DEVNULL
+  with tempfile.TemporaryDirectory() as tmp_directory:
+    os.chmod(tmp_directory, 0o777)
+    default_notebook(image, nbfile, tmp_directory)
+    container = f"benchmark-{uuid.uuid4().hex[:8]}"
+    timings = dict(kernel_seconds=None, first_cell_seconds=None)
+    start = time.time()
+    with Popen([
+      'docker', 'run', '--name', container, '-v', f"{tmp_directory}:/data", '-e', 'PYTHONPATH=/app',
+      image, 'appyter', 'nbexecute', '--cwd=/data', nbfile,
+    ], stdout=PIPE, stderr=DEVNULL) as p:
+      try:
+        for line in p.stdout:
+          try:
+            msg = json.loads(line)
+          except ValueError:
+            continue
+          if msg.get('type') == 'status' and msg.get('data') == 'Executing...':
+            timings['kernel_seconds'] = time.time() - start
+          elif msg.get('type') == 'progress' and msg.get('data', 0) >= 1 or msg.get('type') == 'status' and msg.get('data') == 'Success':
+            timings['first_cell_seconds'] = time.time() - start
+            break
+          elif msg.get('type') == 'error' or time.time() - start > timeout:
+            break
+      finally:
+        docker('rm', '-f', container, check=False)
+    return timings
+
+def benchmark_image(image, nbfile, repeat=1):
+  result = dict(image=image, **image_sizes(image))
+  result['ready_seconds'] = statistics.median(time_to_ready(image) for _ in range(repeat))
+  runs = [time_to_first_cell(image, nbfile) for _ in range(repeat)]
+  for metric in ('kernel_seconds', 'first_cell_seconds'):
+    values = [run[metric] for run in runs if run[metric] is not None]
+    result[metric] = statistics.median(values) if values else None
+  return result
+
+def compare_runs(old, new, tolerance=0.1):
+  ''' Metrics of each appyter which changed by more than `tolerance` (relative) between two runs of the trend
+  '''
+  changes = []
+  for appyter, result in sorted(new['appyters'].items()):
+    previous = old['appyters'].get(appyter)
+    if previous is None: continue
+    for metric in metrics:
+      before, after = previous.get(metric), result.get(metric)
+      if before is None or after is None: continue
+      if before == 0 and after == 0: continue
+      if before == 0 or abs(after - before) / before > tolerance:
+        changes.append(dict(appyter=appyter, metric=metric, old=before, new=after))
+  return changes
+
+def read_trend(path):
+  try:
+    with open(path, 'r') as fr:
+      return [json.loads(line) for line in fr if line.strip()]
+  except FileNotFoundError:
+    return []
+
+def format_value(metric, value):
+  if value is None: return '-'
+  if metric.endswith('size'): return f"{value / 1024**2:.0f}MiB"
+  if metric.endswith('seconds'): return f"{value:.1f}s"
+  return str(value)
+
+if __name__ == '__main__':
+  import click
+
+  @click.command(help='Benchmark the size & cold start of appyter images, appending to a trend file')
+  @click.option('--build', default=False, is_flag=True, help='Build the images (with compose/build_graph.py) rather than using local or pulled ones')
+  @click.option('--pull', default=False, is_flag=True, help='Always pull the images')
+  @click.option('--repeat', default=1, type=int, help='Number of cold starts to take the median of')
+  @click.option('--trend', default=os.path.join(root_dir, 'benchmarks', 'images.jsonl'), type=click.Path(dir_okay=False), help='The trend file each run is appended to')
+  @click.option('--tolerance', default=0.1, type=float, help='Relative change reported when comparing with the previous catalog version')
+  @click.argument('appyters', nargs=-1)
+  def main(build, pull, repeat, trend, tolerance, appyters):
+    import datetime
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(root_dir, '.env'))
+    configs = {
+      os.path.basename(os.path.dirname(path)): json.load(open(path, 'r'))
+      for path in glob.glob(os.path.join(root_dir, 'appyters', '*', 'appyter.json'))
+    }
+    run = dict(
+      catalog_version=open(os.path.join(root_dir, 'VERSION'), 'r').read().strip(),
+      appyter_version=os.environ.get('appyter_version'),
+      date=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      appyters={},
+    )
+    for appyter in appyters or sorted(configs):
+      image = get_image(configs[appyter])
+      click.echo(f"{appyter}: {image}", err=True)
+      try:
+        ensure_image(image, appyter, build=build, pull=pull)
+        result = benchmark_image(image, configs[appyter]['appyter']['file'], repeat=repeat)
+      except Exception as e:
+        click.echo(f"{appyter}: {e}", err=True)
+        continue
+      run['appyters'][appyter] = result
+      click.echo(f"{appyter}: " + ', '.join(f"{metric}={format_value(metric, result[metric])}" for metric in metrics), err=True)
+    #
+    previous = [entry for entry in read_trend(trend) if entry['catalog_version'] != run['catalog_version']]
+    os.makedirs(os.path.dirname(os.path.abspath(trend)), exist_ok=True)
+    with open(trend, 'a') as fw:
+      print(json.dumps(run), file=fw)
+    if previous:
+      click.echo(f"Compared to {previous[-1]['catalog_version']} ({previous[-1]['date']}):")
+      for change in compare_runs(previous[-1], run, tolerance=tolerance):
+        click.echo(f"  {change['appyter']} {change['metric']}: {format_value(change['metric'], change['old'])} -> {format_value(change['metric'], change['new'])}")
+
+  main()
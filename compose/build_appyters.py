@@ -11,31 +11,152 @@ docker_org = os.environ['DOCKER_REGISTRY']
 library_version = os.environ['appyter_version']
 
 appyter_path = os.path.join(root_dir, 'appyters')
+git_cache_path = os.path.join(os.path.dirname(__file__), '.git-metadata-cache.json')
+
+def get_tree_hashes(appyter_path):
+  ''' Get the git tree hash of each committed appyter directory (one `git ls-tree` call)
+  '''
+  tree_hashes = {}
+  for line in str(sh.git('ls-tree', 'HEAD', os.path.relpath(appyter_path, root_dir) + '/', _cwd=root_dir, _tty_out=False)).splitlines():
+    info, _, path = line.partition('\t')
+    _mode, type, tree_hash = info.split()
+    if type == 'tree':
+      tree_hashes[path] = tree_hash
+  return tree_hashes
+
+def get_git_metadata(paths):
+  ''' Compute creation & update timestamps for several appyter directories (relative to root_dir)
+  in a single pass over the history (newest to oldest).
+
+  - creation_timestamp: the oldest commit touching the appyter's appyter.json, following renames
+  - update_timestamp: the most recent commit touching the appyter's directory
+  '''
+  metadata = {path: dict(creation_timestamp='', update_timestamp='') for path in paths}
+  # appyter.json path (as it was named at this point in history) => appyter directory
+  follow = {os.path.join(path, 'appyter.json'): path for path in paths}
+  log = str(sh.git(
+    '-c', 'core.quotePath=false',
+    'log', '-M', '--name-status', r'--pretty=format:%x00%aI',
+    _cwd=root_dir, _tty_out=False,
+  ))
+  for commit in log.split('\0')[1:]:
+    timestamp, *changes = commit.strip().splitlines()
+    for change in filter(None, changes):
+      status, *files = change.split('\t')
+      for file in files:
+        # the appyter directory (appyters/<name>) of files at any depth within it
+        path = '/'.join(file.split('/')[:2])
+        if path in metadata and not metadata[path]['update_timestamp']:
+          metadata[path]['update_timestamp'] = timestamp
+      if files[-1] in follow:
+        path = follow[files[-1]]
+        metadata[path]['creation_timestamp'] = timestamp
+        if status.startswith('R'):
+          # continue following the file under its previous name
+          follow[files[0]] = path
+  return metadata
+
+def load_git_cache():
+  try:
+    return json.load(open(git_cache_path, 'r'))
+  except (FileNotFoundError, json.JSONDecodeError):
+    return {}
+
+def save_git_cache(cache):
+  with open(git_cache_path, 'w') as fw:
+    json.dump(cache, fw, indent=2, sort_keys=True)
+
+def get_git_timestamps(paths):
+  ''' Retrieve git timestamps for the appyter paths using an on-disk cache keyed by
+  path + git tree hash, only cache misses are resolved with git.
+  '''
+  cache = load_git_cache()
+  tree_hashes = get_tree_hashes(appyter_path)
+  relpaths = {path: os.path.relpath(path, root_dir) for path in paths}
+  misses = [
+    relpath
+    for relpath in relpaths.values()
+    if cache.get(relpath, {}).get('tree') is None
+    or cache[relpath]['tree'] != tree_hashes.get(relpath)
+  ]
+  if misses:
+    for relpath, metadata in get_git_metadata(misses).items():
+      cache[relpath] = dict(metadata, tree=tree_hashes.get(relpath))
+    # uncommitted appyters have no tree hash and shouldn't be cached
+    save_git_cache({
+      relpath: entry
+      for relpath, entry in cache.items()
+      if entry.get('tree') is not None and relpath in tree_hashes
+    })
+  return {
+    path: dict(
+      creation_timestamp=cache[relpath]['creation_timestamp'],
+      update_timestamp=cache[relpath]['update_timestamp'],
+    )
+    for path, relpath in relpaths.items()
+  }
+
 def get_appyters(appyter_path):
-  for path in map(os.path.dirname, glob.glob(os.path.join(appyter_path, '*', 'appyter.json'))):
+  paths = sorted(map(os.path.dirname, glob.glob(os.path.join(appyter_path, '*', 'appyter.json'))))
+  timestamps = get_git_timestamps(paths)
+  for path in paths:
     appyter = json.load(open(os.path.join(path, 'appyter.json'), 'r'))
     yield dict(
       appyter,
       path=path,
       long_description=open(os.path.join(path, 'README.md'), 'r').read(),
-      # find the oldest commit containing the appyter's appyter.json (follow for detecting renames)
-      creation_timestamp=str(sh.tail(
-        sh.git.log(
-          '--follow', r'--pretty=format:%aI', '--', os.path.join(path, 'appyter.json'),
-          _tty_out=False,
-        ),
-        '-n1'
-      )).strip(),
-      # find the most recent commit containing the appyter's directory
-      update_timestamp=str(sh.head(
-        sh.git.log(
-          r'--pretty=format:%aI', '--', path,
-          _tty_out=False,
-        ),
-        '-n1'
-      )).strip(),
+      **timestamps[path],
     )
 
+def tokenize(text):
+  return [token for token in re.findall(r'[a-z0-9]+', (text or '').lower()) if len(token) > 1]
+
+def get_search_index(appyters):
+  ''' An inverted index over the searchable fields of the appyters: { token: [ids] }
+  with tag facets { tag: [ids] }, ids being positions in the appyters list.
+  '''
+  tokens = {}
+  tags = {}
+  for id, appyter in enumerate(appyters):
+    fields = [
+      appyter.get('name'),
+      appyter.get('title'),
+      ', '.join(f"{author.get('name', '')} ({author.get('email', '')})" for author in appyter.get('authors', [])),
+      appyter.get('description'),
+      # links in the README (images, references) aren't worth searching
+      re.sub(r'https?://\S+', ' ', appyter.get('long_description') or ''),
+      appyter.get('license'),
+      ' '.join(appyter.get('tags', [])),
+      appyter.get('url'),
+    ]
+    for token in set(token for field in fields for token in tokenize(field)):
+      tokens.setdefault(token, []).append(id)
+    for tag in appyter.get('tags', []):
+      tags.setdefault(tag, []).append(id)
+  return dict(
+    tokens=dict(sorted(tokens.items())),
+    tags=dict(sorted(tags.items())),
+  )
+
+def write_catalog(config, output_dir):
+  ''' Write the catalog app's data: a listing manifest without the long descriptions
+  (`appyters.json`), the search index (`search.json`) and each appyter's long description
+  for loading on demand (`long_descriptions/{name}.md`). Only files whose contents changed are written.
+  '''
+  from incremental import write_if_changed
+  manifest = dict(config, appyters=[
+    {
+      key: value
+      for key, value in appyter.items()
+      if key not in {'path', 'long_description'}
+    }
+    for appyter in config['appyters']
+  ])
+  write_if_changed(os.path.join(output_dir, 'appyters.json'), json.dumps(manifest, separators=(',', ':')))
+  write_if_changed(os.path.join(output_dir, 'search.json'), json.dumps(get_search_index(config['appyters']), separators=(',', ':')))
+  for appyter in config['appyters']:
+    write_if_changed(os.path.join(output_dir, 'long_descriptions', f"{appyter['name']}.md"), appyter['long_description'])
+
 appyters = list(get_appyters(appyter_path))
 
 config = json.load(open(os.path.join(os.path.dirname(__file__), 'templates', 'appyters.json'), 'r'))
@@ -44,4 +165,14 @@ config['docker_org'] = docker_org
 config['library_version'] = os.environ['appyter_version']
 
 if __name__ == '__main__':
-  print(json.dumps(config))
+  import click
+
+  @click.command(help='Build the appyters.json catalog, printing it or writing the catalog app files')
+  @click.option('--output-dir', default=None, type=click.Path(file_okay=False), help='Write the listing manifest, search index & long descriptions to this directory')
+  def main(output_dir):
+    if output_dir is None:
+      print(json.dumps(config))
+    else:
+      write_catalog(config, output_dir)
+
+  main()
@@ -5,6 +5,8 @@ import glob
 import yaml
 from io import StringIO
 from jinja2 import Environment, FileSystemLoader
+from incremental import write_if_changed
+from resources import get_pool_resources, parse_pools
 
 root_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
 version = open(os.path.join(root_dir, 'VERSION'), 'r').read().strip()
@@ -23,27 +25,30 @@ env = Environment(
 template = env.get_template('Chart.yaml.j2')
 chart_files_spec = template.render(
   appyters=appyters,
+  get_pool_resources=get_pool_resources,
+  # native pools `name=size,...` (see build_compose.py --native-pools)
+  pools=parse_pools(os.environ.get('APPYTER_NATIVE_POOLS')),
   version=version,
 )
 chart_files = re.compile(r'\n+---', re.MULTILINE).split(chart_files_spec)
 # load first two files (Chart.yaml & questions.yaml)
-chart_desc, chart_questions = yaml.load(StringIO(chart_files[0])), yaml.load(StringIO(chart_files[1]))
+chart_desc, chart_questions = yaml.safe_load(StringIO(chart_files[0])), yaml.safe_load(StringIO(chart_files[1]))
 chart_root = os.path.join(root_dir, 'charts', chart_desc['name'], chart_desc['version'])
 # create values.yaml from questions.yaml
-os.makedirs(chart_root, exist_ok=True)
-with open(os.path.join(chart_root, 'values.yaml'), 'w') as fw:
-  for question in chart_questions['questions']:
-    print(
-      f"# {question['description']} ({question['group']})",
-      f"{'' if question['required'] else '#'}{question['variable']}: \"{question['default']}\"",
-      sep='\n',
-      file=fw,
-    )
-# create templates
+write_if_changed(os.path.join(chart_root, 'values.yaml'), ''.join(
+  f"# {question['description']} ({question['group']})\n"
+  f"{'' if question['required'] else '#'}{question['variable']}: \"{question['default']}\"\n"
+  for question in chart_questions['questions']
+))
+# create templates, only rewriting those whose content changed
+changed_services = set()
 for chart_file in chart_files:
   m = re.compile(r'\n*# Source: ([^\n]+)\n(.+)', re.DOTALL | re.MULTILINE).match(chart_file)
   chart_file_path, chart_file_content = m.group(1), m.group(2)
-  chart_file_full_path = os.path.join(chart_root, chart_file_path)
-  os.makedirs(os.path.dirname(chart_file_full_path), exist_ok=True)
-  with open(chart_file_full_path, 'w') as fw:
-    fw.write(chart_file_content)
+  if write_if_changed(os.path.join(chart_root, chart_file_path), chart_file_content):
+    # templates/{service}/{resource}.yaml
+    chart_file_parts = chart_file_path.split('/')
+    if len(chart_file_parts) == 3 and chart_file_parts[0] == 'templates':
+      changed_services.add(chart_file_parts[1])
+# machine-readable list of services whose templates changed
+print(json.dumps(sorted(changed_services)))
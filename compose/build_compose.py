@@ -2,13 +2,19 @@ import click
 
 @click.command(help='Build the docker-compose.yml file')
 @click.option('--tls', default=False, type=bool, is_flag=True, help='Whether or not to build the docker-compose.yml with tls support')
-def build_compose(tls):
+@click.option('-o', '--output', default=None, type=click.Path(dir_okay=False), help='Write to this file (only if its contents changed) instead of stdout')
+@click.option('--changed', default=None, type=click.File('w'), help='Write a json list of the services whose rendered block changed (requires --output)')
+@click.option('--jobs-memory', envvar='APPYTER_JOBS_MEMORY', default=None, help='Memory available to dispatched jobs (e.g. 32G), sizes the orchestrator concurrency from the appyters\' resource profiles')
+@click.option('--native-pools', 'pools', envvar='APPYTER_NATIVE_POOLS', default=None, help='Native pools as `name=size,...`, each appyter listed dispatches to its own pre-started container which runs its jobs without isolating them (rather than a container per job)')
+def build_compose(tls, output, changed, jobs_memory, pools):
   import os
   import json
   import glob
   from math import log10
   from itertools import count
   from jinja2 import Environment, FileSystemLoader
+  from incremental import split_compose_services, changed_blocks, read_if_exists, write_if_changed
+  from resources import get_pool_resources, plan_dispatcher, parse_pools
   #
   root_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
   version = open(os.path.join(root_dir, 'VERSION'), 'r').read().strip()
@@ -28,7 +34,10 @@ def build_compose(tls):
   docker_compose = template.render(
     appyters=appyters,
     count=count,
+    dispatcher=plan_dispatcher(appyters, memory=jobs_memory),
     enumerate=enumerate,
+    get_pool_resources=get_pool_resources,
+    pools=parse_pools(pools),
     int=int,
     iter=iter,
     len=len,
@@ -39,8 +48,19 @@ def build_compose(tls):
     version=version,
     tls=tls,
   )
-  print(docker_compose)
-
+  if output is None:
+    assert changed is None, '--changed requires --output'
+    print(docker_compose)
+    return
+  #
+  docker_compose += '\n'
+  changed_services = changed_blocks(
+    split_compose_services(read_if_exists(output) or ''),
+    split_compose_services(docker_compose),
+  )
+  write_if_changed(output, docker_compose)
+  if changed is not None:
+    json.dump(changed_services, changed)
 
 if __name__ == '__main__':
   build_compose()
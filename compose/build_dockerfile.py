@@ -1,19 +1,245 @@
 import os
 import json
+import glob
+import hashlib
 from jinja2 import Environment, FileSystemLoader
 
-def build_dockerfile(appyter_path, config):
-  env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')))
-  template = env.get_template('Dockerfile.j2')
+root_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+# the base image clusters of the last `--bases` run, kept stable across runs
+clusters_path = os.path.join(root_dir, '.tmp', '.base-clusters.json')
+
+def get_env():
+  return Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')))
+
+def get_dependencies(appyter_path):
+  ''' The dependencies of an appyter which could be shared in a base image:
+  `apt:{package}` for deps.txt packages (& r-base for setup.R) and `pip:{line}` for requirements.txt
+  '''
+  dependencies = set()
+  if os.path.isfile(os.path.join(appyter_path, 'deps.txt')):
+    for line in open(os.path.join(appyter_path, 'deps.txt'), 'r'):
+      if line.startswith('#'): continue
+      dependencies.update(f"apt:{package}" for package in line.split())
+  if os.path.isfile(os.path.join(appyter_path, 'setup.R')):
+    dependencies.add('apt:r-base')
+  if os.path.isfile(os.path.join(appyter_path, 'requirements.txt')):
+    for line in map(str.strip, open(os.path.join(appyter_path, 'requirements.txt'), 'r')):
+      # options (-r, --index-url, ...) only make sense in the appyter's own requirements.txt
+      if not line or line.startswith('#') or line.startswith('-'): continue
+      dependencies.add(f"pip:{line}")
+  return dependencies
+
+def cluster_dependencies(appyter_dependencies, min_shared=3, min_similarity=0.5):
+  ''' Agglomerative clustering of appyters by shared dependencies: the two clusters
+  sharing the most dependencies are merged so long as they share at least `min_shared`
+  and the merge keeps at least `min_similarity` of the smaller cluster's shared dependencies.
+
+  Returns a list of (appyters, shared dependencies) for clusters with more than one appyter.
+  '''
+  clusters = [
+    (frozenset([appyter]), frozenset(dependencies))
+    for appyter, dependencies in sorted(appyter_dependencies.items())
+  ]
+  while True:
+    best = None
+    for i in range(len(clusters)):
+      for j in range(i + 1, len(clusters)):
+        shared = clusters[i][1] & clusters[j][1]
+        if len(shared) < min_shared: continue
+        if len(shared) < min_similarity * min(len(clusters[i][1]), len(clusters[j][1])): continue
+        if best is None or len(shared) > len(best[2]):
+          best = (i, j, shared)
+    if best is None: break
+    i, j, shared = best
+    merged = (clusters[i][0] | clusters[j][0], shared)
+    clusters = [cluster for k, cluster in enumerate(clusters) if k not in (i, j)] + [merged]
+  return [
+    (sorted(appyters), sorted(dependencies))
+    for appyters, dependencies in clusters
+    if len(appyters) > 1
+  ]
+
+def is_pinned(requirements):
+  ''' Whether every requirement is pinned to an exact version (`name==version`), only then
+  can the wheelhouse be trusted to hold the right wheels without consulting the index
+  '''
+  import re
+  pinned = re.compile(r'^[A-Za-z0-9._-]+(\[[^\]]*\])?\s*===?\s*[^\s;*,]+\s*(;.*)?$')
+  requirements = [line.strip() for line in requirements if line.strip() and not line.strip().startswith('#')]
+  return all(pinned.match(line) for line in requirements)
+
+def render_base(base, wheelhouse=False):
+  return get_env().get_template('Dockerfile.base.j2').render(
+    base=base,
+    pinned=is_pinned(base['pip']),
+    wheelhouse=wheelhouse and bool(base['pip']),
+  )
+
+def get_base_tag(base):
+  ''' The content hash of a base image (its parent, dependencies & template), which
+  unlike its list of appyters only changes when the image itself does
+  '''
+  content = json.dumps([base['parent'], base['apt'], base['pip'], render_base(base)])
+  return hashlib.sha256(content.encode()).hexdigest()[:12]
+
+def load_clusters(path=clusters_path):
+  try:
+    with open(path, 'r') as fr:
+      return [(appyters, dependencies) for appyters, dependencies in json.load(fr)]
+  except FileNotFoundError:
+    return []
+
+def save_clusters(clusters, path=clusters_path):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as fw:
+    json.dump(clusters, fw)
+
+def assign_clusters(appyter_dependencies, previous=(), **kwargs):
+  ''' Cluster the appyters, keeping the `previous` clusters (& thus their base images)
+  for the members which still have all of their shared dependencies. The other appyters
+  join the largest previous cluster they fit in or are clustered among themselves.
+
+  Returns a list of (appyters, shared dependencies) like cluster_dependencies.
+  '''
+  clusters = []
+  for appyters, dependencies in previous:
+    members = [
+      appyter
+      for appyter in appyters
+      if appyter in appyter_dependencies and set(dependencies) <= appyter_dependencies[appyter]
+    ]
+    if len(members) > 1:
+      clusters.append((members, sorted(dependencies)))
+  assigned = {appyter for appyters, _ in clusters for appyter in appyters}
+  for appyters, dependencies in cluster_dependencies({
+    appyter: dependencies
+    for appyter, dependencies in appyter_dependencies.items()
+    if appyter not in assigned
+  }, **kwargs):
+    same = [cluster for cluster in clusters if cluster[1] == dependencies]
+    if same:
+      same[0][0].extend(appyters)
+    else:
+      clusters.append((appyters, dependencies))
+  assigned = {appyter for appyters, _ in clusters for appyter in appyters}
+  for appyter, dependencies in sorted(appyter_dependencies.items()):
+    if appyter in assigned: continue
+    fits = [cluster for cluster in clusters if set(cluster[1]) <= dependencies]
+    if fits:
+      max(fits, key=lambda cluster: len(cluster[1]))[0].append(appyter)
+  return [(sorted(appyters), dependencies) for appyters, dependencies in clusters]
+
+def plan_base_images(appyters_path=os.path.join(root_dir, 'appyters'), previous=None):
+  ''' Analyze the dependencies of all appyters, producing the shared base images:
+  a `core` base with the layers all appyters share and one base per dependency cluster.
+  Each base is tagged by the hash of its content, the `previous` clusters (by default
+  those last saved by `--bases`) are kept where they still fit so that adding or changing
+  an appyter doesn't reshuffle the others.
+
+  Returns ({ tag: base }, { appyter: tag })
+  '''
+  appyter_dependencies = {
+    os.path.basename(os.path.dirname(path)): get_dependencies(os.path.dirname(path))
+    for path in glob.glob(os.path.join(appyters_path, '*', 'appyter.json'))
+  }
+  if previous is None: previous = load_clusters()
+  core = dict(parent=None, appyters=sorted(appyter_dependencies), apt=[], pip=[])
+  core['tag'] = 'core-' + get_base_tag(core)
+  bases = {core['tag']: core}
+  appyter_bases = {appyter: core['tag'] for appyter in appyter_dependencies}
+  for appyters, dependencies in assign_clusters(appyter_dependencies, previous):
+    base = dict(
+      parent=core['tag'],
+      appyters=appyters,
+      apt=[dependency[len('apt:'):] for dependency in dependencies if dependency.startswith('apt:')],
+      pip=[dependency[len('pip:'):] for dependency in dependencies if dependency.startswith('pip:')],
+    )
+    base['tag'] = get_base_tag(base)
+    bases[base['tag']] = base
+    appyter_bases.update({appyter: base['tag'] for appyter in appyters})
+  return bases, appyter_bases
+
+def write_base_images(bases, bases_path, wheelhouse=False):
+  ''' Write the docker build context of each base image to `{bases_path}/{tag}`
+  '''
+  for tag, base in bases.items():
+    os.makedirs(os.path.join(bases_path, tag), exist_ok=True)
+    with open(os.path.join(bases_path, tag, 'Dockerfile'), 'w') as fw:
+      print(render_base(base, wheelhouse=wheelhouse), file=fw)
+    if base['apt']:
+      with open(os.path.join(bases_path, tag, 'deps.txt'), 'w') as fw:
+        print(*base['apt'], sep='\n', file=fw)
+    if base['pip']:
+      with open(os.path.join(bases_path, tag, 'requirements.txt'), 'w') as fw:
+        print(*base['pip'], sep='\n', file=fw)
+
+def build_base_images(bases, bases_path, tags=None, registry=None, push=False):
+  ''' docker build (and optionally push) base images, parents before their children
+  '''
+  from subprocess import run
+  if registry is None: registry = os.environ.get('DOCKER_REGISTRY', 'maayanlab')
+  if tags is None: tags = list(bases)
+  # include parents and order them first
+  ordered = []
+  for tag in tags:
+    lineage = []
+    while tag is not None and tag not in ordered and tag not in lineage:
+      lineage.insert(0, tag)
+      tag = bases[tag]['parent']
+    ordered += lineage
+  for tag in ordered:
+    image = f"{registry}/appyter-base:{tag}"
+    assert run([
+      'docker', 'build',
+      '--build-arg', f"DOCKER_REGISTRY={registry}",
+      '-t', image,
+      os.path.join(bases_path, tag),
+    ], env=dict(os.environ, DOCKER_BUILDKIT='1')).returncode == 0, f"`docker build` of {image} failed"
+    if push:
+      assert run(['docker', 'push', image]).returncode == 0, f"`docker push` of {image} failed"
+
+def build_dockerfile(appyter_path, config, base=None, wheelhouse=False):
+  # installation steps which the base image already fully covers can be skipped
+  covered = {}
+  if base:
+    dependencies = get_dependencies(appyter_path)
+    shared = {f"apt:{dep}" for dep in base['apt']} | {f"pip:{dep}" for dep in base['pip']}
+    covered['deps.txt'] = {dep for dep in dependencies if dep.startswith('apt:') and dep != 'apt:r-base'} <= shared
+    covered['r-base'] = 'apt:r-base' in shared
+    covered['requirements.txt'] = {dep for dep in dependencies if dep.startswith('pip:')} <= shared
+    if os.path.isfile(os.path.join(appyter_path, 'requirements.txt')) \
+      and any(line.strip().startswith('-') for line in open(os.path.join(appyter_path, 'requirements.txt'), 'r')):
+      covered['requirements.txt'] = False
+  requirements_path = os.path.join(appyter_path, 'requirements.txt')
+  template = get_env().get_template('Dockerfile.j2')
   dockerfile = template.render(
     appyter_path=appyter_path,
+    base=base,
     config=config,
+    covered=covered,
     json=json,
     os=os,
+    pinned=os.path.isfile(requirements_path) and is_pinned(open(requirements_path, 'r')),
+    wheelhouse=wheelhouse and os.path.isfile(os.path.join(appyter_path, 'requirements.txt')),
   )
   return dockerfile
 
-def prepare_appyter(appyter_path, config):
+def uses_enrichr_client(appyter_path):
+  ''' Whether the appyter's code or notebooks import `enrichr_client`
+  '''
+  import re
+  for path in glob.glob(os.path.join(appyter_path, '*.py')) + glob.glob(os.path.join(appyter_path, '*.ipynb')):
+    if os.path.basename(path) == 'enrichr_client.py': continue
+    with open(path, 'r') as fr:
+      if re.search(r'\b(from|import) enrichr_client\b', fr.read()):
+        return True
+  return False
+
+def prepare_appyter(appyter_path, config, bases=None, wheelhouse=False):
+  ''' Prepare the appyter's directory for building, `bases` is the result of plan_base_images
+  to build the appyter from its shared base image, `wheelhouse` installs python dependencies
+  through a BuildKit cache mount of wheels shared by all appyters.
+  '''
   import shutil
   override_path = os.path.join(appyter_path, 'override')
   if os.path.exists(override_path):
@@ -26,11 +252,43 @@ def prepare_appyter(appyter_path, config):
     os.path.join(os.path.dirname(__file__), 'catalog_helper.py'),
     os.path.join(appyter_path, 'catalog_helper.py')
   )
-  return build_dockerfile(appyter_path, config)
+  if uses_enrichr_client(appyter_path):
+    shutil.copy(
+      os.path.join(os.path.dirname(__file__), 'enrichr_client.py'),
+      os.path.join(appyter_path, 'enrichr_client.py')
+    )
+  base = None
+  if bases is not None:
+    bases, appyter_bases = bases
+    base = bases.get(appyter_bases.get(os.path.basename(os.path.realpath(appyter_path))))
+  return build_dockerfile(appyter_path, config, base=base, wheelhouse=wheelhouse)
 
 if __name__ == '__main__':
-  import sys
-  appyter = sys.argv[1]
-  appyter_path = os.path.join(os.path.dirname(__file__), '..', 'appyters', appyter)
-  config = json.load(open(os.path.join(appyter_path, 'appyter.json'), 'r'))
-  print(prepare_appyter(appyter_path, config))
+  import click
+
+  @click.command(help='Build the Dockerfile for an appyter, or the shared base images with --bases')
+  @click.option('--bases', 'bases_path', default=None, type=click.Path(file_okay=False), help='Write the shared base image build contexts to this directory')
+  @click.option('--build', default=False, is_flag=True, help='docker build the base images written with --bases')
+  @click.option('--push', default=False, is_flag=True, help='docker push the base images built with --build')
+  @click.option('--no-base', default=False, is_flag=True, help='Build the appyter Dockerfile from scratch rather than from its shared base image')
+  @click.option('--no-wheelhouse', default=False, is_flag=True, help='Install python dependencies directly rather than through the BuildKit wheelhouse cache')
+  @click.argument('appyter', required=False)
+  def main(appyter, bases_path, build, push, no_base, no_wheelhouse):
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(root_dir, '.env'))
+    bases = None if no_base else plan_base_images()
+    if bases_path is not None:
+      save_clusters([
+        (base['appyters'], [f"apt:{dep}" for dep in base['apt']] + [f"pip:{dep}" for dep in base['pip']])
+        for base in bases[0].values()
+        if base['parent'] is not None
+      ])
+      write_base_images(bases[0], bases_path, wheelhouse=not no_wheelhouse)
+      if build:
+        build_base_images(bases[0], bases_path, push=push)
+    if appyter is not None:
+      appyter_path = os.path.join(os.path.dirname(__file__), '..', 'appyters', appyter)
+      config = json.load(open(os.path.join(appyter_path, 'appyter.json'), 'r'))
+      print(prepare_appyter(appyter_path, config, bases=bases, wheelhouse=not no_wheelhouse))
+
+  main()
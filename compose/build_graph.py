@@ -0,0 +1,350 @@
+''' The build graph of the catalog, replacing the Makefile's prerequisites: each task is keyed by
+the hash of its inputs and the keys of its dependencies. A task whose key is unchanged since its
+last successful run is skipped, the rest run in parallel (bounded by --jobs) as soon as their
+dependencies complete. Every appyter directory is hashed once per run and file contents are only
+re-read when their size or mtime changed.
+'''
+
+import os
+import sys
+import json
+import time
+import glob
+import hashlib
+import threading
+from compose.incremental import split_compose_services, fingerprint, read_if_exists, write_if_changed
+
+root_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+# files written into an appyter's directory by the build rather than by its authors
+generated = {'Dockerfile', 'override', 'catalog_helper.py', 'enrichr_client.py', '.build', '.publish', '.deploy', '__pycache__', '.ipynb_checkpoints'}
+
+class FileHasher:
+  ''' Content hashes of files & directories, file hashes are memoized by (size, mtime) in `cache`
+  (persisted across runs), directory hashes for the duration of the run.
+  '''
+  def __init__(self, cache=None):
+    self.cache = cache if cache is not None else {}
+    self.trees = {}
+    self.lock = threading.Lock()
+
+  def hash_file(self, path):
+    stat = os.stat(path)
+    with self.lock:
+      cached = self.cache.get(path)
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+      return cached[2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as fr:
+      for chunk in iter(lambda: fr.read(1024**2), b''):
+        h.update(chunk)
+    with self.lock:
+      self.cache[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+  def hash_paths(self, *paths, exclude=frozenset()):
+    ''' Hash the relative paths & contents of all files under `paths` (files or directories, missing
+    paths hash as such), skipping any file or directory whose name is in `exclude`
+    '''
+    h = hashlib.sha256()
+    for path in paths:
+      h.update(f"\0{os.path.relpath(path, root_dir)}\0".encode())
+      if os.path.isfile(path):
+        h.update(self.hash_file(path).encode())
+      elif os.path.isdir(path):
+        h.update(self.hash_tree(path, exclude=frozenset(exclude)).encode())
+    return h.hexdigest()
+
+  def hash_tree(self, path, exclude=frozenset()):
+    with self.lock:
+      if (path, exclude) in self.trees:
+        return self.trees[(path, exclude)]
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+      dirs[:] = sorted(d for d in dirs if d not in exclude)
+      for f in sorted(files):
+        if f in exclude: continue
+        h.update(f"\0{os.path.relpath(os.path.join(root, f), path)}\0".encode())
+        h.update(self.hash_file(os.path.join(root, f)).encode())
+    with self.lock:
+      self.trees[(path, exclude)] = h.hexdigest()
+    return h.hexdigest()
+
+class Task:
+  ''' A node of the build graph, `inputs` returns what the task depends on (besides its
+  dependencies) when it is about to run and `action` performs it, raising on failure.
+  Tasks in `after` run first but, unlike `deps`, their keys aren't part of this task's key
+  (i.e. tasks producing a shared file of which this task only hashes its own part).
+  '''
+  def __init__(self, name, deps=(), inputs=None, action=None, after=()):
+    self.name = name
+    self.deps = list(deps)
+    self.after = list(after)
+    self.inputs = inputs or (lambda: [])
+    self.action = action
+
+  def key(self, dep_keys):
+    return hashlib.sha256(json.dumps([self.name, self.inputs(), dep_keys]).encode()).hexdigest()
+
+def select_tasks(tasks, targets):
+  ''' The targets and all of their (transitive) dependencies in a dependency respecting order
+  '''
+  order = []
+  visiting = set()
+  def visit(name):
+    assert name in tasks, f"Unknown task {name}"
+    if name in order: return
+    assert name not in visiting, f"Dependency cycle through {name}"
+    visiting.add(name)
+    for dep in tasks[name].deps + tasks[name].after:
+      visit(dep)
+    visiting.discard(name)
+    order.append(name)
+  for target in targets:
+    visit(target)
+  return order
+
+def run_graph(tasks, targets, state, jobs=4, dry_run=False, echo=print, save=None):
+  ''' Run the stale tasks needed for `targets` with at most `jobs` at once. `state` maps
+  task names to the `key` & `duration` of their last successful run and is updated in place
+  (calling `save` after each update).
+
+  Returns { name: dict(status, key, duration) } with status ran, skipped, failed or blocked
+  (a dependency failed), or with dry_run, stale or fresh.
+  '''
+  from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+  order = select_tasks(tasks, targets)
+  results = {}
+  lock = threading.Lock()
+
+  def execute(name):
+    task = tasks[name]
+    key = task.key([results[dep]['key'] for dep in task.deps])
+    last = state.get(name, {})
+    if dry_run:
+      stale = key != last.get('key') or any(results[dep]['status'] == 'stale' for dep in task.deps)
+      return dict(status='stale' if stale else 'fresh', key=key, duration=last.get('duration', 0) if stale else 0)
+    if key == last.get('key'):
+      return dict(status='skipped', key=key, duration=0)
+    echo(f"[start] {name}")
+    start = time.time()
+    try:
+      if task.action is not None:
+        task.action()
+    except Exception as e:
+      echo(f"[failed] {name}: {e}")
+      return dict(status='failed', key=key, duration=time.time() - start)
+    duration = time.time() - start
+    echo(f"[done] {name} ({duration:.1f}s)")
+    with lock:
+      state[name] = dict(key=key, duration=duration)
+      if save is not None: save(state)
+    return dict(status='ran', key=key, duration=duration)
+
+  with ThreadPoolExecutor(max_workers=jobs) as pool:
+    running = {}
+    def submit_ready():
+      for name in order:
+        if name in results or name in running.values(): continue
+        if any(dep not in results for dep in tasks[name].deps + tasks[name].after): continue
+        if any(results[dep]['status'] in {'failed', 'blocked'} for dep in tasks[name].deps + tasks[name].after):
+          results[name] = dict(status='blocked', key=None, duration=0)
+          continue
+        running[pool.submit(execute, name)] = name
+    submit_ready()
+    while running:
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        results[running.pop(future)] = future.result()
+      submit_ready()
+  return results
+
+def critical_path(tasks, results):
+  ''' The chain of dependencies with the largest total duration: ([names...], seconds)
+  '''
+  finish = {}
+  via = {}
+  for name in select_tasks(tasks, list(results)):
+    deps = [dep for dep in tasks[name].deps + tasks[name].after if dep in finish]
+    via[name] = max(deps, key=lambda dep: finish[dep]) if deps else None
+    finish[name] = (finish[via[name]] if via[name] else 0) + results[name]['duration']
+  if not finish:
+    return [], 0
+  name = max(finish, key=finish.get)
+  total = finish[name]
+  path = []
+  while name is not None:
+    path.insert(0, name)
+    name = via[name]
+  return path, total
+
+def run_command(args, cwd=root_dir, stdout=None):
+  ''' Run a command, raising with its output if it fails
+  '''
+  from subprocess import run, PIPE, STDOUT
+  proc = run(args, cwd=cwd, stdout=PIPE, stderr=STDOUT if stdout is None else PIPE)
+  if proc.returncode != 0:
+    output = (proc.stdout if stdout is None else proc.stderr).decode(errors='replace')
+    raise Exception(f"`{' '.join(args)}` exited with {proc.returncode}\n{output}")
+  if stdout is not None:
+    write_if_changed(stdout, proc.stdout.decode())
+
+def plan_graph(hasher, python=sys.executable, compose_args=()):
+  ''' The tasks of the catalog, equivalent to the Makefile's former targets:
+  bases:{build,publish}, dockerfile:*, docker-compose.yml, {build,publish,deploy}:*, app:{appyters.json,build,publish,deploy}
+  '''
+  appyters = sorted(
+    os.path.basename(os.path.dirname(path))
+    for path in glob.glob(os.path.join(root_dir, 'appyters', '*', 'appyter.json'))
+  )
+  path = lambda *p: os.path.join(root_dir, *p)
+  files = lambda *paths: hasher.hash_paths(*[path(*p.split('/')) for p in paths])
+  env = lambda: files('.env')
+  # the Dockerfiles (of the appyters & their shared base images)
+  dockerfile_templates = lambda: files(
+    'compose/build_dockerfile.py',
+    'compose/templates/Dockerfile.j2', 'compose/templates/Dockerfile.base.j2', 'compose/templates/Dockerfile.core.j2',
+  )
+  # what build_dockerfile.py injects into every appyter's image
+  injected = lambda: hasher.hash_paths(path('override'), path('compose', 'catalog_helper.py'), path('compose', 'enrichr_client.py'), exclude={'__pycache__'})
+  # the shared base images depend on the dependencies of all appyters
+  appyter_deps = lambda: hasher.hash_paths(*[
+    path('appyters', appyter, f)
+    for appyter in appyters
+    for f in ('deps.txt', 'setup.R', 'requirements.txt')
+  ])
+  # but an appyter only on the tag of the base it uses (a hash of that base's content)
+  planned = {}
+  def base_tag(appyter):
+    from compose.build_dockerfile import plan_base_images, clusters_path
+    # re-planned once bases:build saved new clusters
+    stamp = os.stat(clusters_path).st_mtime_ns if os.path.exists(clusters_path) else None
+    with hasher.lock:
+      if planned.get('stamp', ()) != stamp:
+        planned.update(stamp=stamp, bases=plan_base_images()[1])
+      return planned['bases'].get(appyter)
+  appyter_dir = lambda appyter: hasher.hash_paths(path('appyters', appyter), exclude=generated)
+  dockerfile = lambda appyter: read_if_exists(path('appyters', appyter, 'Dockerfile'))
+  def services(appyter):
+    service = f"appyter-{appyter.lower()}"
+    blocks = split_compose_services(read_if_exists(path('docker-compose.yml')) or '')
+    return [fingerprint(blocks.get(service, '')), fingerprint(blocks.get(f"{service}-pool", ''))]
+  #
+  tasks = {}
+  def add(name, deps=(), inputs=None, action=None, after=()):
+    tasks[name] = Task(name, deps=deps, inputs=inputs, action=action, after=after)
+  #
+  add('bases:build',
+    inputs=lambda: [dockerfile_templates(), env(), appyter_deps()],
+    action=lambda: run_command([python, 'compose/build_dockerfile.py', '--bases', 'bases', '--build']))
+  add('bases:publish', ['bases:build'],
+    action=lambda: run_command([python, 'compose/build_dockerfile.py', '--bases', 'bases', '--build', '--push']))
+  for appyter in appyters:
+    add(f"dockerfile:{appyter}", after=['bases:build'],
+      inputs=lambda appyter=appyter: [dockerfile_templates(), injected(), appyter_dir(appyter), base_tag(appyter)],
+      action=lambda appyter=appyter: run_command([python, 'compose/build_dockerfile.py', appyter], stdout=path('appyters', appyter, 'Dockerfile')))
+  add('docker-compose.yml', [f"dockerfile:{appyter}" for appyter in appyters],
+    inputs=lambda: [
+      files('compose/build_compose.py', 'compose/incremental.py', 'compose/resources.py', 'compose/templates/docker-compose.yml.j2'),
+      hasher.hash_paths(path('VERSION'), *[path('appyters', appyter, 'appyter.json') for appyter in appyters]),
+      list(compose_args),
+      os.environ.get('APPYTER_JOBS_MEMORY'),
+      os.environ.get('APPYTER_NATIVE_POOLS'),
+    ],
+    action=lambda: run_command([python, 'compose/build_compose.py', *compose_args, '--output', 'docker-compose.yml', '--changed', '.compose-changed.json']))
+  for appyter in appyters:
+    service = f"appyter-{appyter.lower()}"
+    # the base images & docker-compose.yml are built first but only this appyter's base tag (in its
+    #  Dockerfile) & services are part of the key
+    add(f"build:{appyter}", [f"dockerfile:{appyter}"], after=['bases:build', 'docker-compose.yml'],
+      inputs=lambda appyter=appyter: [appyter_dir(appyter), dockerfile(appyter), injected(), env(), services(appyter)],
+      action=lambda service=service: run_command(['docker-compose', 'build', service]))
+    add(f"publish:{appyter}", [f"build:{appyter}"], after=['bases:publish'],
+      action=lambda service=service: run_command(['docker-compose', 'push', service]))
+    add(f"deploy:{appyter}", [f"build:{appyter}"],
+      inputs=lambda appyter=appyter: [env(), services(appyter)],
+      action=lambda service=service: run_command(['docker-compose', 'up', '-d', service]))
+  add('app:appyters.json',
+    inputs=lambda: [
+      files('compose/build_appyters.py', 'compose/incremental.py', 'compose/templates/appyters.json'), env(),
+      hasher.hash_paths(*[path('appyters', appyter, f) for appyter in appyters for f in ('appyter.json', 'README.md')]),
+    ],
+    action=lambda: run_command([python, 'compose/build_appyters.py', '--output-dir', 'app/public']))
+  add('app:build', ['app:appyters.json'],
+    inputs=lambda: [hasher.hash_paths(path('app', 'package.json'), path('app', 'public'))],
+    action=lambda: (
+      run_command(['npm', 'i'], cwd=path('app')),
+      run_command(['npm', 'run', 'build'], cwd=path('app')),
+      run_command(['docker-compose', 'build', 'appyters-catalog']),
+    ))
+  add('app:publish', ['app:build'],
+    action=lambda: run_command(['docker-compose', 'push', 'appyters-catalog']))
+  add('app:deploy', ['app:build'],
+    inputs=lambda: [env()],
+    action=lambda: run_command(['docker-compose', 'up', '-d', 'appyters-catalog']))
+  return tasks
+
+def expand_targets(tasks, targets):
+  ''' `build`, `publish` and `deploy` stand for the app and every appyter
+  '''
+  expanded = []
+  for target in targets:
+    if target in {'build', 'publish', 'deploy'}:
+      expanded += [f"app:{target}"] + sorted(name for name in tasks if name.startswith(f"{target}:"))
+    elif target == 'dockerfiles':
+      expanded += sorted(name for name in tasks if name.startswith('dockerfile:'))
+    else:
+      expanded.append(target)
+  return expanded
+
+if __name__ == '__main__':
+  import click
+
+  @click.command(help='Build, publish or deploy the catalog, running only what is stale in parallel')
+  @click.option('-j', '--jobs', default=4, type=int, help='Maximum number of tasks to run at once')
+  @click.option('-n', '--dry-run', default=False, is_flag=True, help='Only report which tasks are stale & the expected critical path')
+  @click.option('--state', default=os.path.join(root_dir, '.tmp', '.build-graph.json'), type=click.Path(dir_okay=False), help='Where the keys of the last successful runs are recorded')
+  @click.option('--report', default=None, type=click.Path(dir_okay=False), help='Write a json report of each task\'s status & duration and the critical path')
+  @click.option('--compose-args', default='', type=str, help='Extra arguments for compose/build_compose.py (i.e. --tls)')
+  @click.argument('targets', nargs=-1)
+  def main(jobs, dry_run, state, report, compose_args, targets):
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(root_dir, '.env'))
+    state_path = state
+    try:
+      state = json.load(open(state_path, 'r'))
+    except FileNotFoundError:
+      state = {}
+    hasher = FileHasher(state.get('files', {}))
+    tasks = plan_graph(hasher, compose_args=compose_args.split())
+    task_state = state.get('tasks', {})
+    def save(task_state):
+      with hasher.lock:
+        files = dict(hasher.cache)
+      os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+      with open(state_path + '.tmp', 'w') as fw:
+        json.dump(dict(tasks=task_state, files=files), fw)
+      os.replace(state_path + '.tmp', state_path)
+    results = run_graph(
+      tasks, expand_targets(tasks, targets or ['build']), task_state,
+      jobs=jobs, dry_run=dry_run, echo=click.echo,
+      save=None if dry_run else save,
+    )
+    if not dry_run:
+      save(task_state)
+    counts = {}
+    for result in results.values():
+      counts[result['status']] = counts.get(result['status'], 0) + 1
+    click.echo(', '.join(f"{count} {status}" for status, count in sorted(counts.items())))
+    if dry_run:
+      for name, result in results.items():
+        if result['status'] == 'stale':
+          click.echo(f"  {name}")
+    path, total = critical_path(tasks, results)
+    click.echo(f"critical path{' (expected)' if dry_run else ''}: {total:.1f}s {' -> '.join(name for name in path if results[name]['duration'] > 0) or '-'}")
+    if report is not None:
+      with open(report, 'w') as fw:
+        json.dump(dict(tasks=results, critical_path=dict(tasks=path, duration=total)), fw, indent=2)
+    sys.exit(1 if any(result['status'] in {'failed', 'blocked'} for result in results.values()) else 0)
+
+  main()
@@ -4,8 +4,10 @@ import os
 import re
 import sys
 import json
+import time
 import click
 import shutil
+import contextlib
 
 def insert_info(ipynb, info):
   ''' Given an ipynb, insert { 'metadata': { 'appyter': 'info': info } } }
@@ -19,6 +21,36 @@ def insert_info(ipynb, info):
   with open(ipynb, 'w') as fw:
     nbf.write(nb, fw)
 
+_j2_extends = re.compile(r'\{%-? *extends (?P<extend>.+?) *-?%\}')
+_j2_block_tag = re.compile(r'\{%-? *(?:block +(?P<block_name>[^ %-]+)(?: +scoped)?|endblock(?: +[^ %-]+)?) *-?%\}')
+_j2_super = re.compile(r'\{\{-? *super\(\) *-?\}\}')
+_j2_placeholder = re.compile('\0(?P<block_name>[^\0]+)\0')
+
+def parse_j2_blocks(j2):
+  ''' Parse a jinja2 template into { block_name: (parent_block_name, content) } (in order of appearance)
+  with nested blocks replaced by a `\\0block_name\\0` placeholder in their parent's content.
+  '''
+  blocks = {}
+  stack = [] # [(block_name, [content...])]
+  pos = 0
+  for m in _j2_block_tag.finditer(j2):
+    if stack:
+      stack[-1][1].append(j2[pos:m.start()])
+    pos = m.end()
+    block_name = m.group('block_name')
+    if block_name is not None:
+      assert block_name not in blocks and block_name not in [name for name, _ in stack], f"Block {block_name} defined twice"
+      blocks[block_name] = None # reserve position
+      if stack:
+        stack[-1][1].append(f"\0{block_name}\0")
+      stack.append((block_name, []))
+    else:
+      assert stack, 'Unexpected endblock'
+      block_name, content = stack.pop()
+      blocks[block_name] = (stack[-1][0] if stack else None, ''.join(content))
+  assert not stack, f"Unclosed block {stack[-1][0]}" if stack else ''
+  return blocks
+
 def merge_j2(*j2s):
   ''' Given a set of independent jinja2 templates, under certain conditions, we can merge the two together into one template.
   '''
@@ -26,7 +58,7 @@ def merge_j2(*j2s):
   # ensure extends are the same and present
   extends = set()
   for j2 in j2s:
-    m = re.search(r'\{% *extends (?P<extend>.+?) *%\}', j2)
+    m = _j2_extends.search(j2)
     if m:
       extends.add(m.group('extend'))
     else:
@@ -34,17 +66,17 @@ def merge_j2(*j2s):
   assert len(extends) == 1, f"Expected extends to be the same, got {extends}"
   extend = next(iter(extends))
   assert extend != None, f"Can only merge extended j2s"
-  # locate blocks
+  # locate blocks & where they are nested
   blocks = {}
+  parents = {}
   for ind, j2 in enumerate(j2s):
-    # WARNING: this would fail on nested blocks
-    for black_match in re.finditer(r'\{% *block *(?P<block_name>.+?) *%\}(?P<block_content>(.|\r|\n)+?)\{% *endblock *%\}', j2, re.MULTILINE):
-      block_name = black_match.group('block_name')
-      block_content = black_match.group('block_content')
+    for block_name, (parent, block_content) in parse_j2_blocks(j2).items():
       if block_name not in blocks:
         blocks[block_name] = {}
+        parents[block_name] = set()
+      parents[block_name].add(parent)
       # capture location of super
-      super_match = re.search(r'\{\{ *super\(\) *\}\}', block_content)
+      super_match = _j2_super.search(block_content)
       if super_match:
         start_super, end_super = super_match.span()
         blocks[block_name][ind] = {
@@ -55,6 +87,11 @@ def merge_j2(*j2s):
         blocks[block_name][ind] = {
           'no_super': block_content,
         }
+  # a block nested in one template and at the top-level in another is nested in the merged result
+  for block_name, block_parents in parents.items():
+    nested_in = block_parents - {None}
+    assert len(nested_in) <= 1, f"Block {block_name} is nested in different blocks {nested_in}"
+    parents[block_name] = next(iter(nested_in)) if nested_in else None
   # merge blocks, combining contents of blocks relative to super
   merged_blocks = {}
   for block_name, block_contents in blocks.items():
@@ -73,26 +110,73 @@ def merge_j2(*j2s):
         merged_blocks[block_name].get('post_super', '').strip(),
         block_content.get('post_super', '').strip(),
       ])).strip()
+  # render blocks, substituting nested blocks at their first placeholder
+  rendered = set()
+  def render_block(block_name):
+    rendered.add(block_name)
+    block_content = merged_blocks[block_name]
+    merged_block = '\n'.join(filter(None, [
+      f"{{% block {block_name} %}}",
+      block_content['pre_super'].strip(),
+      block_content['no_super'].strip() if block_content.get('no_super') else '{{ super() }}',
+      block_content['post_super'].strip(),
+      f"{{% endblock %}}"
+    ]))
+    def render_nested(m):
+      nested_block_name = m.group('block_name')
+      if nested_block_name in rendered:
+        return ''
+      return render_block(nested_block_name)
+    return _j2_placeholder.sub(render_nested, merged_block)
   # merge into final template
   merged = '\n\n'.join([
     f"{{% extends {extend} %}}",
     *[
-      '\n'.join(filter(None, [
-        f"{{% block {block_name} %}}",
-        block_content['pre_super'].strip(),
-        block_content['no_super'].strip() if block_content.get('no_super') else '{{ super() }}',
-        block_content['post_super'].strip(),
-        f"{{% endblock %}}"
-      ]))
-      for block_name, block_content in merged_blocks.items()
+      render_block(block_name)
+      for block_name in merged_blocks
+      if parents[block_name] is None
     ],
   ])
   return merged
 
+def merge_j2_cached(primary, override, cache_dir=None):
+  ''' merge_j2 with the result stored in `cache_dir` under the hash of its inputs
+  '''
+  if cache_dir is None:
+    return merge_j2(primary, override)
+  import hashlib
+  key = hashlib.sha256(b'\0'.join([primary.encode(), override.encode()])).hexdigest()
+  cache_path = os.path.join(cache_dir, f"{key}.j2")
+  if os.path.isfile(cache_path):
+    return open(cache_path, 'r').read()
+  merged = merge_j2(primary, override)
+  os.makedirs(cache_dir, exist_ok=True)
+  with open(cache_path + '.tmp', 'w') as fw:
+    fw.write(merged)
+  os.replace(cache_path + '.tmp', cache_path)
+  return merged
+
+def hash_directories(*dirs):
+  ''' A hash of the relative paths & contents of all files in the directories
+  '''
+  import hashlib
+  h = hashlib.sha256()
+  for directory in dirs:
+    h.update(b'\0\0')
+    for dirpath, dirnames, filenames in os.walk(directory):
+      dirnames.sort()
+      for filename in sorted(filenames):
+        file_path = os.path.join(dirpath, filename)
+        h.update(os.path.relpath(file_path, directory).encode() + b'\0')
+        with open(file_path, 'rb') as fr:
+          h.update(fr.read())
+        h.update(b'\0')
+  return h.hexdigest()
 
-def merge_j2_directories(primary_dir, override_dir, merged_dir):
+
+def merge_j2_directories(primary_dir, override_dir, merged_dir, cache_dir=None):
   ''' Given a primary directory and an override directory, recursively
-  copy over or merge and overrides
+  copy over or merge and overrides (optionally caching merges in `cache_dir`)
   '''
   if primary_dir != merged_dir:
     for dirpath, dirnames, filenames in os.walk(primary_dir):
@@ -115,9 +199,10 @@ def merge_j2_directories(primary_dir, override_dir, merged_dir):
       if os.path.exists(os.path.join(primary_dir, file_path)):
         # join j2 and update
         if os.path.splitext(filename)[1] == '.j2':
-          merged = merge_j2(
+          merged = merge_j2_cached(
             open(os.path.join(primary_dir, file_path), 'r').read(),
             open(os.path.join(override_dir, file_path), 'r').read(),
+            cache_dir=cache_dir,
           )
           os.makedirs(os.path.join(merged_dir, file_dir), exist_ok=True)
           with open(os.path.join(merged_dir, file_path), 'w') as fw:
@@ -132,6 +217,58 @@ def merge_j2_directories(primary_dir, override_dir, merged_dir):
           os.path.join(merged_dir, file_path)
         )
 
+j2_cache_dir = '/app/.j2cache'
+# the hash of the original templates & overrides which /app/templates were merged from
+templates_hash_file = '.templates.sha256'
+
+def get_templates_hash(app_dir='/app'):
+  ''' The hash of the appyter's original templates & the catalog overrides
+  '''
+  templates_sav = os.path.join(app_dir, 'templates.sav')
+  return hash_directories(
+    templates_sav if os.path.isdir(templates_sav) else os.path.join(app_dir, 'templates'),
+    os.path.join(app_dir, 'override'),
+  )
+
+def templates_overridden(app_dir='/app', templates_hash=None):
+  ''' Whether the templates were already overridden from the current templates & overrides
+  '''
+  hash_file = os.path.join(app_dir, templates_hash_file)
+  if not os.path.isdir(os.path.join(app_dir, 'templates')) or not os.path.isfile(hash_file):
+    return False
+  if templates_hash is None: templates_hash = get_templates_hash(app_dir)
+  with open(hash_file, 'r') as fr:
+    return fr.read() == templates_hash
+
+def override_templates(app_dir='/app', templates_hash=None, trace=None, cache_dir=j2_cache_dir):
+  ''' Restore the appyter's original templates (backing them up the first time) and merge
+  the catalog overrides into them, recording the hash they were merged from
+  '''
+  if trace is None: trace = StartupTrace(enabled=False)
+  if templates_hash is None: templates_hash = get_templates_hash(app_dir)
+  templates, templates_sav = os.path.join(app_dir, 'templates'), os.path.join(app_dir, 'templates.sav')
+  hash_file = os.path.join(app_dir, templates_hash_file)
+  if os.path.exists(hash_file):
+    os.remove(hash_file)
+  with trace.phase('restore templates'):
+    if os.path.isdir(templates):
+      if not os.path.isdir(templates_sav):
+        click.echo('Backing up appyter template...')
+        shutil.copytree(templates, templates_sav)
+      else:
+        click.echo('Restoring appyter template...')
+        shutil.rmtree(templates)
+        shutil.copytree(templates_sav, templates)
+    else:
+      os.mkdir(templates)
+      os.mkdir(templates_sav)
+  #
+  with trace.phase('merge templates'):
+    click.echo('Overriding appyter template...')
+    merge_j2_directories(app_dir, os.path.join(app_dir, 'override'), app_dir, cache_dir=cache_dir)
+    with open(hash_file, 'w') as fw:
+      fw.write(templates_hash)
+
 @click.group()
 def cli():
   pass
@@ -153,50 +290,392 @@ def insert_info_cli(ipynb, info):
 def setup_cli():
   ''' This will be used to setup the docker image
   '''
-  import tempfile
   click.echo('Loading `appyter.json`...')
   appyter = json.load(open('/app/appyter.json', 'r'))
   #
   click.echo('Inserting appyter info into ipynb...')
   insert_info(appyter['appyter']['file'], appyter)
   #
-  click.echo('Testing appyter override...')
-  # this will perform merge_j2_directories *now* at docker build time
-  #  but throw away the result and do it in-place at docker run time.
-  with tempfile.TemporaryDirectory() as tmpdir:
-    merge_j2_directories('/app', '/app/override', tmpdir)
+  # the templates are overridden *now* at docker build time so that the entrypoint
+  #  of a fresh container only has to verify that they're current
+  override_templates('/app')
   #
   click.echo('Done')
 
-@cli.command(name='entrypoint')
-def entrypoint_cli():
-  ''' The catalog will use this entrypoint so that the standard
-  docker image does not contain the overrides and
-  does not use the catalog-integration extra.
+class StartupTrace:
+  ''' Collect a structured timing trace of the phases of starting an appyter
   '''
-  from subprocess import run
-  if os.path.isdir('/app/templates'):
-    if not os.path.isdir('/app/templates.sav'):
-      click.echo('Backing up appyter template...')
-      shutil.copytree('/app/templates', '/app/templates.sav')
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.started = time.time()
+    self.phases = []
+    self.imports = {}
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    start = time.time()
+    try:
+      yield
+    finally:
+      if self.enabled:
+        self.phases.append(dict(name=name, start=start - self.started, duration=time.time() - start))
+
+  def to_dict(self):
+    return dict(
+      appyter=os.environ.get('APPYTER_IPYNB'),
+      started=self.started,
+      total=sum(phase['duration'] for phase in self.phases),
+      phases=self.phases,
+      imports=dict(sorted(self.imports.items(), key=lambda kv: -kv[1])),
+    )
+
+  def dump(self, output):
+    if not self.enabled: return
+    if output == '-':
+      click.echo(json.dumps(self.to_dict()))
     else:
-      click.echo('Restoring appyter template...')
-      shutil.rmtree('/app/templates')
-      shutil.copytree('/app/templates.sav', '/app/templates')
+      with open(output, 'w') as fw:
+        json.dump(self.to_dict(), fw)
+
+def get_notebook_imports(ipynb):
+  ''' Top-level modules imported in the code cells of a notebook
+  '''
+  import nbformat as nbf
+  with open(ipynb, 'r') as fr:
+    nb = nbf.read(fr, as_version=4)
+  modules = []
+  for cell in nb.cells:
+    if cell['cell_type'] != 'code': continue
+    for m in re.finditer(r'^[ \t]*(?:from[ \t]+(?P<from>[A-Za-z_]\w*)[\w.]*[ \t]+import|import[ \t]+(?P<import>[^#\n]+))', cell['source'], re.MULTILINE):
+      if m.group('from'):
+        candidates = [m.group('from')]
+      else:
+        candidates = [name.strip().split(' ')[0].split('.')[0] for name in m.group('import').split(',')]
+      for module in candidates:
+        if re.match(r'^[A-Za-z_]\w*$', module) and module not in modules:
+          modules.append(module)
+  return modules
+
+def measure_import_times(modules):
+  ''' Cumulative import time (in seconds) of each module in a fresh interpreter (using `-X importtime`)
+  '''
+  from subprocess import run, PIPE, DEVNULL
+  proc = run(
+    [sys.executable, '-X', 'importtime', '-c', f"""
+for module in {modules!r}:
+  try: __import__(module)
+  except Exception: pass
+"""],
+    stdout=DEVNULL, stderr=PIPE, cwd='/app' if os.path.isdir('/app') else None,
+  )
+  import_times = {}
+  for line in proc.stderr.decode().splitlines():
+    m = re.match(r'^import time:\s*(?P<self>\d+)\s*\|\s*(?P<cumulative>\d+)\s*\|(?P<indent> *)(?P<module>\S+)$', line)
+    # top-level imports are not indented
+    if m and len(m.group('indent')) <= 1 and m.group('module') in modules:
+      import_times[m.group('module')] = int(m.group('cumulative')) / 1e6
+  return import_times
+
+def wait_for_ready(proc, timeout=600):
+  ''' Poll the appyter until it serves its first http response, returns whether it became ready
+  '''
+  import urllib.request, urllib.error
+  url = f"http://localhost:{os.environ.get('APPYTER_PORT', '5000')}{os.environ.get('APPYTER_PREFIX', '/')}"
+  start = time.time()
+  while proc.poll() is None and time.time() - start < timeout:
+    try:
+      urllib.request.urlopen(url, timeout=5).close()
+      return True
+    except urllib.error.HTTPError:
+      # the server responded, even if not with a 200
+      return True
+    except Exception:
+      time.sleep(0.1)
+  return False
+
+def persist_enrichr_settings(path=os.path.expanduser('~/.enrichr.json'), environ=os.environ):
+  ''' Notebook kernels only inherit PATH & PYTHONPATH, the container's ENRICHR_* variables
+  are persisted for `enrichr_client` (compose/enrichr_client.py) to read
+  '''
+  settings = {key: value for key, value in environ.items() if key.startswith('ENRICHR_')}
+  if settings:
+    with open(path, 'w') as fw:
+      json.dump(settings, fw)
+  elif os.path.exists(path):
+    os.remove(path)
+
+def prepare_entrypoint(trace):
+  ''' Restore & override the appyter's templates and inject the catalog extras
+  '''
+  # the templates are overridden when the image is built (setup), only if they or the
+  #  overrides were changed since (i.e. mounted over) are they merged again
+  with trace.phase('verify templates'):
+    templates_hash = get_templates_hash('/app')
+    overridden = templates_overridden('/app', templates_hash)
+  if overridden:
+    click.echo('Appyter template already overridden...')
   else:
-    os.mkdir('/app/templates')
-    os.mkdir('/app/templates.sav')
-  #
-  click.echo('Overriding appyter template...')
-  merge_j2_directories('/app', '/app/override', '/app')
+    override_templates('/app', templates_hash, trace=trace)
   #
-  click.echo('Injecting `catalog-integration` extra...')
-  extras = json.loads(os.environ.get('APPYTER_EXTRAS', '[]'))
-  extras.append('catalog-integration')
-  os.environ['APPYTER_EXTRAS'] = json.dumps(extras)
+  with trace.phase('inject extras'):
+    click.echo('Injecting `catalog-integration` extra...')
+    extras = json.loads(os.environ.get('APPYTER_EXTRAS', '[]'))
+    extras.append('catalog-integration')
+    os.environ['APPYTER_EXTRAS'] = json.dumps(extras)
+  persist_enrichr_settings()
+  configure_transfers()
+
+def trace_imports(trace):
+  ipynb = os.environ.get('APPYTER_IPYNB')
+  if not ipynb or not os.path.isfile(ipynb): return
+  with trace.phase('notebook imports'):
+    click.echo('Measuring notebook import times...')
+    trace.imports.update(measure_import_times(['appyter', *get_notebook_imports(ipynb)]))
+
+@cli.command(name='entrypoint')
+@click.option('--trace', envvar='APPYTER_STARTUP_TRACE', default=None, type=str, help='Write a json timing trace of the startup phases to this file (- for stdout)')
+def entrypoint_cli(trace):
+  ''' The catalog will use this entrypoint so that the standard
+  docker image does not use the catalog-integration extra.
+  '''
+  from subprocess import run, Popen
+  trace_output, trace = trace, StartupTrace(enabled=bool(trace))
+  prepare_entrypoint(trace)
   #
   click.echo('Starting appyter...')
-  sys.exit(run(['appyter', 'flask-app'], env=os.environ).returncode)
+  if not trace.enabled:
+    sys.exit(run(['appyter', 'flask-app'], env=os.environ).returncode)
+  #
+  trace_imports(trace)
+  with trace.phase('flask-app ready'):
+    proc = Popen(['appyter', 'flask-app'], env=os.environ)
+    wait_for_ready(proc)
+  trace.dump(trace_output)
+  sys.exit(proc.wait())
+
+@cli.command(name='native-pool')
+@click.option('--jobs', envvar='APPYTER_JOBS', default=1, type=int, help='Number of executions this container runs concurrently')
+def native_pool_cli(jobs):
+  ''' A native pool for this appyter: a dispatcher which executes the jobs it receives
+  natively in this already started container, so jobs skip the container startup of
+  dispatched jobs but share this container (there is no isolation between them). Each
+  job still starts its own kernel, the notebook's imports are only prewarmed once
+  (bytecode compiled, modules & shared libraries in the page cache) in a throwaway process.
+  '''
+  import tempfile
+  from subprocess import run
+  appyter = json.load(open('/app/appyter.json', 'r'))
+  click.echo('Prewarming notebook imports...')
+  import_times = measure_import_times(['appyter', *get_notebook_imports(os.path.join('/app', appyter['appyter']['file']))])
+  for module, seconds in sorted(import_times.items(), key=lambda item: -item[1]):
+    click.echo(f"{module}: {seconds:.2f}s")
+  #
+  persist_enrichr_settings()
+  configure_transfers()
+  bin_dir = tempfile.mkdtemp()
+  write_rclone_wrapper(bin_dir, {key: os.environ[key] for key in transfer_env_settings})
+  click.echo('Starting native pool dispatcher...')
+  os.environ.update(
+    PATH=os.pathsep.join([bin_dir, os.environ.get('PATH', '')]),
+    APPYTER_DISPATCH='native',
+    APPYTER_JOBS=str(jobs),
+    # every job of the pool uses the same image
+    APPYTER_JOBS_PER_IMAGE=str(jobs),
+  )
+  sys.exit(run(['appyter', 'orchestration', 'dispatcher'], env=os.environ).returncode)
+
+transfer_defaults = dict(
+  # multipart part size, files under upload_cutoff are uploaded in a single part
+  chunk_size='16M',
+  upload_cutoff='32M',
+  # parts uploaded / streams downloaded concurrently
+  concurrency='4',
+  # ranged reads (and read-ahead) when downloading from a mount
+  read_chunk_size='32M',
+)
+
+def get_memory_limit():
+  ''' The memory limit of this container (cgroup v2 or v1), None if it isn't limited
+  '''
+  for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+    try:
+      limit = open(path, 'r').read().strip()
+    except OSError:
+      continue
+    # unlimited: `max` (v2) or close to the maximum int64 (v1)
+    if limit.isdigit() and int(limit) < 2**60:
+      return int(limit)
+  return None
+
+def get_transfer_settings(environ=os.environ, memory=None):
+  ''' The s3 transfer settings, `APPYTER_S3_{SETTING}` overrides the defaults. rclone allocates
+  a buffer of `buffer_size` for each open file & concurrent transfer so given the `memory`
+  available, the buffers of all the concurrent transfers are kept within 1/16th of it.
+  '''
+  settings = {
+    key: environ.get(f"APPYTER_S3_{key.upper()}", value)
+    for key, value in transfer_defaults.items()
+  }
+  buffer_size = parse_size(settings['read_chunk_size'])
+  if memory is not None:
+    buffer_size = max(1024**2, min(buffer_size, memory // (16 * int(settings['concurrency']))))
+  settings['buffer_size'] = environ.get('APPYTER_S3_BUFFER_SIZE', f"{buffer_size // 1024}K")
+  return settings
+
+# the rclone variable of each transfer setting
+transfer_env_settings = dict(
+  RCLONE_S3_CHUNK_SIZE='chunk_size',
+  RCLONE_S3_UPLOAD_CUTOFF='upload_cutoff',
+  RCLONE_S3_UPLOAD_CONCURRENCY='concurrency',
+  RCLONE_TRANSFERS='concurrency',
+  RCLONE_MULTI_THREAD_STREAMS='concurrency',
+  RCLONE_VFS_READ_CHUNK_SIZE='read_chunk_size',
+  RCLONE_BUFFER_SIZE='buffer_size',
+)
+
+def get_transfer_env(settings, environ=os.environ):
+  ''' The rclone environment for the transfer settings, `RCLONE_*` variables which are already set
+  (explicitly or by the image, see Dockerfile.j2) are kept unless the setting is overridden with `APPYTER_S3_*`
+  '''
+  return {
+    key: environ[key] if key in environ and f"APPYTER_S3_{setting.upper()}" not in environ else settings[setting]
+    for key, setting in transfer_env_settings.items()
+  }
+
+def configure_transfers():
+  ''' appyter mounts `APPYTER_DATA_DIR` with rclone, which reads its transfer settings from the
+  environment: they're set (sized to the container's memory) for the processes started from here.
+  '''
+  os.environ.update(get_transfer_env(get_transfer_settings(memory=get_memory_limit())))
+
+def write_rclone_wrapper(directory, env):
+  ''' Natively dispatched jobs are started with only the PATH & PYTHONPATH of the native pool, an `rclone`
+  in `directory` (put ahead of the real one on PATH) applies the transfer settings `env` to their mounts
+  '''
+  import shlex
+  rclone = shutil.which('rclone')
+  assert rclone, 'rclone is not installed'
+  path = os.path.join(directory, 'rclone')
+  with open(path, 'w') as fw:
+    print('#!/bin/sh', file=fw)
+    for key, value in env.items():
+      print(f"export {key}={shlex.quote(value)}", file=fw)
+    print(f"exec {shlex.quote(rclone)} \"$@\"", file=fw)
+  os.chmod(path, 0o755)
+  return path
+
+def parse_size(size):
+  ''' Parse an rclone style size (e.g. 16M) into bytes
+  '''
+  m = re.match(r'^(?P<value>[0-9]+(\.[0-9]+)?)(?P<unit>[KMG]?)i?B?$', str(size).strip(), re.IGNORECASE)
+  assert m, f"Invalid size {size}"
+  return int(float(m.group('value')) * 1024**' KMG'.index(m.group('unit').upper() or ' '))
+
+def get_s3_remote_env(data_dir, remote='benchmark'):
+  ''' rclone remote configuration (as environment variables) for an `s3://key:secret@host:port/bucket/path` uri,
+  returns (env, path)
+  '''
+  import urllib.parse
+  uri = urllib.parse.urlparse(data_dir)
+  assert uri.scheme == 's3', f"Expected an s3:// uri, got {data_dir}"
+  config = dict(urllib.parse.parse_qsl(uri.query))
+  prefix = f"RCLONE_CONFIG_{remote.upper()}_"
+  env = {
+    prefix + 'TYPE': 's3',
+    prefix + 'PROVIDER': 'AWS' if uri.hostname.endswith('s3.amazonaws.com') else 'Minio',
+    prefix + 'ENV_AUTH': 'false',
+  }
+  if not uri.hostname.endswith('s3.amazonaws.com'):
+    env[prefix + 'ENDPOINT'] = f"{'https' if config.get('use_ssl') else 'http'}://{uri.hostname}" + (f":{uri.port}" if uri.port else '')
+  if uri.username:
+    env[prefix + 'ACCESS_KEY_ID'] = urllib.parse.unquote(uri.username)
+  if uri.password:
+    env[prefix + 'SECRET_ACCESS_KEY'] = urllib.parse.unquote(uri.password)
+  return env, f"{remote}:{uri.path.strip('/')}"
+
+def benchmark_transfer(src, dst, env):
+  ''' Time an `rclone copyto`, returns the elapsed seconds
+  '''
+  from subprocess import run
+  start = time.time()
+  assert run(['rclone', 'copyto', src, dst], env=env).returncode == 0, f"rclone copyto {src} {dst} failed"
+  return time.time() - start
+
+@cli.command(name='benchmark-s3')
+@click.option('--data-dir', envvar='APPYTER_DATA_DIR', required=True, type=str, help='The s3:// uri to benchmark against, defaults to the appyter\'s data dir')
+@click.option('--size', default='256M', type=str, help='Size of the file transferred')
+@click.option('-c', '--chunk-size', 'chunk_sizes', multiple=True, type=str, help='Multipart chunk sizes to try (default: the current setting)')
+@click.option('-j', '--concurrency', 'concurrencies', multiple=True, type=str, help='Concurrencies to try (default: the current setting)')
+@click.option('--baseline', default=False, is_flag=True, help='Also measure rclone\'s own defaults (what jobs used without the image\'s transfer settings)')
+@click.option('-o', '--output', default='-', type=str, help='Where to write the json results (- for stdout)')
+def benchmark_s3_cli(data_dir, size, chunk_sizes, concurrencies, baseline, output):
+  ''' Measure upload & download throughput of APPYTER_DATA_DIR for combinations of the transfer settings.
+  i.e. `docker-compose run --rm appyter-example appyter-catalog-helper benchmark-s3 -c 8M -c 64M -j 1 -j 8`
+  '''
+  import uuid
+  import itertools
+  import tempfile
+  settings = get_transfer_settings()
+  remote_env, remote_path = get_s3_remote_env(data_dir)
+  remote_path = f"{remote_path}/.benchmark-{uuid.uuid4()}"
+  size = parse_size(size)
+  # rclone's own environment must not take precedence over the combination being measured
+  environ = {key: value for key, value in os.environ.items() if not key.startswith('RCLONE_')}
+  runs = []
+  if baseline:
+    # a job container without any transfer settings
+    runs.append(('rclone-defaults', dict(chunk_size=None, concurrency=None), {}))
+  for chunk_size, concurrency in itertools.product(chunk_sizes or [settings['chunk_size']], concurrencies or [settings['concurrency']]):
+    transfer_env = get_transfer_env(dict(settings, chunk_size=chunk_size, concurrency=concurrency), environ=environ)
+    runs.append((f"{chunk_size}-{concurrency}", dict(chunk_size=chunk_size, concurrency=int(concurrency)), transfer_env))
+  results = []
+  with tempfile.TemporaryDirectory() as tmpdir:
+    src = os.path.join(tmpdir, 'upload')
+    with open(src, 'wb') as fw:
+      for offset in range(0, size, 1024**2):
+        fw.write(os.urandom(min(1024**2, size - offset)))
+    for name, params, transfer_env in runs:
+      env = dict(environ, **remote_env, **transfer_env)
+      remote_file = f"{remote_path}/{name}"
+      upload = benchmark_transfer(src, remote_file, env)
+      download = benchmark_transfer(remote_file, os.path.join(tmpdir, 'download'), env)
+      os.remove(os.path.join(tmpdir, 'download'))
+      results.append(dict(
+        params,
+        size=size,
+        upload=upload,
+        download=download,
+        upload_mbps=size / 1024**2 / upload,
+        download_mbps=size / 1024**2 / download,
+      ))
+      click.echo(f"{name}: up {results[-1]['upload_mbps']:.1f} MiB/s, down {results[-1]['download_mbps']:.1f} MiB/s", err=True)
+    from subprocess import run
+    run(['rclone', 'purge', remote_path], env=dict(os.environ, **remote_env))
+  if output == '-':
+    click.echo(json.dumps(results))
+  else:
+    with open(output, 'w') as fw:
+      json.dump(results, fw)
+
+@cli.command(name='profile-startup')
+@click.option('-o', '--output', default='-', type=str, help='Where to write the json timing trace (- for stdout)')
+@click.option('--timeout', default=600, type=int, help='Maximum number of seconds to wait for the appyter to serve requests')
+def profile_startup_cli(output, timeout):
+  ''' Profile the catalog entrypoint: run its startup phases, wait for
+  the appyter to serve its first request, write the trace and stop.
+  i.e. `docker run --rm <image> appyter-catalog-helper profile-startup`
+  '''
+  from subprocess import Popen
+  trace = StartupTrace()
+  prepare_entrypoint(trace)
+  trace_imports(trace)
+  with trace.phase('flask-app ready'):
+    proc = Popen(['appyter', 'flask-app'], env=os.environ)
+    ready = wait_for_ready(proc, timeout=timeout)
+  proc.terminate()
+  proc.wait()
+  trace.dump(output)
+  sys.exit(0 if ready else 1)
 
 if __name__ == '__main__':
   cli()
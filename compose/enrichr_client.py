@@ -0,0 +1,634 @@
+''' A shared Enrichr client for the appyters, copied by `compose/build_dockerfile.py` (like
+catalog_helper.py) next to the code of each appyter importing `enrichr_client`.
+
+Requests go through keep-alive sessions with a bounded number of concurrent requests, an adaptive
+rate limit which backs off when Enrichr throttles (429/5xx) and relaxes as requests succeed, and
+`map` which fans out per-library & per-geneset queries in parallel. Responses are cached
+(ResponseCache) by the content of the gene list so repeated runs on the same data skip the network.
+
+With ENRICHR_LOCAL=true, `get_client` returns a LocalEnrichr instead, which computes enrichment
+against gene set libraries indexed locally (downloaded from Enrichr once into ENRICHR_LIBRARIES).
+
+Notebook kernels only inherit PATH & PYTHONPATH from appyter, the catalog entrypoint persists
+the ENRICHR_* variables of the container to `settings_path` where they are read from.
+'''
+
+import os
+import time
+import hashlib
+import threading
+import functools
+
+default_url = 'https://amp.pharm.mssm.edu/Enrichr'
+throttle_statuses = {429, 500, 502, 503, 504}
+settings_path = os.path.expanduser('~/.enrichr.json')
+
+def get_settings(environ=os.environ, path=settings_path):
+  ''' ENRICHR_* settings persisted in `path`, overridden by those in the environment
+  '''
+  import json
+  try:
+    with open(path, 'r') as fr:
+      settings = json.load(fr)
+  except (FileNotFoundError, ValueError):
+    settings = {}
+  settings.update({key: value for key, value in environ.items() if key.startswith('ENRICHR_')})
+  return settings
+
+class RateLimiter:
+  ''' Spaces out the start of requests (across threads) by an interval which doubles
+  when requests are throttled and halves when they succeed
+  '''
+  def __init__(self, min_interval=0., backoff_interval=0.5, max_interval=30.):
+    self.min_interval = min_interval
+    self.backoff_interval = backoff_interval
+    self.max_interval = max_interval
+    self.interval = min_interval
+    self.next_start = 0.
+    self.lock = threading.Lock()
+
+  def wait(self):
+    with self.lock:
+      now = time.monotonic()
+      start = max(now, self.next_start)
+      self.next_start = start + self.interval
+    if start > now:
+      time.sleep(start - now)
+
+  def throttled(self, retry_after=None):
+    with self.lock:
+      self.interval = min(self.max_interval, max(self.interval * 2, self.backoff_interval))
+      self.next_start = max(self.next_start, time.monotonic() + max(self.interval, retry_after or 0))
+
+  def succeeded(self):
+    with self.lock:
+      self.interval /= 2
+      if self.interval < self.backoff_interval / 8:
+        self.interval = self.min_interval
+
+def parse_retry_after(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+def get_s3_filesystem(uri):
+  ''' An s3fs filesystem for an appyter storage uri `s3://key:secret@host:port/bucket/path`
+  (configured like appyter's), returns (fs, path)
+  '''
+  import s3fs
+  import urllib.parse
+  uri = urllib.parse.urlparse(uri)
+  config = dict(urllib.parse.parse_qsl(uri.query))
+  use_ssl = config.get('use_ssl', 'false').lower() == 'true'
+  fs = s3fs.S3FileSystem(
+    key=urllib.parse.unquote(uri.username) if uri.username else None,
+    secret=urllib.parse.unquote(uri.password) if uri.password else None,
+    anon=not uri.username,
+    client_kwargs=dict(endpoint_url=f"{'https' if use_ssl else 'http'}://{uri.hostname}:{uri.port or (443 if use_ssl else 80)}"),
+  )
+  return fs, uri.path.strip('/')
+
+def get_job_data_dir(pid=None):
+  ''' Dispatched jobs run in a container started from the appyter's image and their kernels only
+  inherit PATH & PYTHONPATH, the data dir of the job is found from the `appyter orchestration job <job>`
+  process which started the kernel (its cwd is `<data dir>/output/<session>`), None if there isn't one
+  '''
+  import json
+  try:
+    with open(f"/proc/{pid or os.getppid()}/cmdline", 'rb') as fr:
+      args = fr.read().decode().split('\0')
+  except OSError:
+    return None
+  for i in range(len(args) - 2):
+    if args[i:i+2] == ['orchestration', 'job']:
+      job = json.loads(args[i+2])
+      break
+  else:
+    return None
+  cwd = job['cwd'].rstrip('/')
+  output = f"/output/{job['session']}"
+  return cwd[:-len(output)] if cwd.endswith(output) else None
+
+class ResponseCache:
+  ''' Enrichr responses by the hash of their request as json files in `root`, a directory or an
+  `s3://` uri (e.g. under the catalog's data dir). Entries older than `ttl` seconds are ignored
+  (a `ttl` of 0 disables the cache) and once they exceed `max_size` bytes the least recently used
+  are evicted first (on s3, where reads don't update them, the least recently written).
+  '''
+  def __init__(self, root, ttl=7*24*60*60, max_size=512*1024**2, fs=None):
+    self.root = root
+    self.ttl = ttl
+    self.max_size = max_size
+    self.local = '://' not in root
+    assert self.local or root.startswith('s3://'), f"Unsupported response cache {root}, expected a directory or an s3:// uri"
+    self._fs = fs
+    self.size = None
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def key(*parts):
+    import json
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+  @property
+  def fs(self):
+    ''' The s3 filesystem of the root & the root's path in it
+    '''
+    if self._fs is None:
+      self._fs = get_s3_filesystem(self.root)
+    return self._fs
+
+  def path(self, key):
+    if self.local:
+      return os.path.join(self.root, key[:2], f"{key}.json")
+    fs, root = self.fs
+    return f"{root}/{key[:2]}/{key}.json"
+
+  def get(self, key):
+    import json
+    if self.ttl <= 0: return None
+    try:
+      path = self.path(key)
+      if self.local:
+        with open(path, 'r') as fr:
+          entry = json.load(fr)
+        # the mtime orders entries for eviction
+        os.utime(path)
+      else:
+        fs, _ = self.fs
+        entry = json.loads(fs.cat_file(path))
+    except Exception:
+      return None
+    if time.time() - entry['ts'] > self.ttl: return None
+    return entry['response']
+
+  def set(self, key, response):
+    import json
+    if self.ttl <= 0: return
+    data = json.dumps(dict(ts=time.time(), response=response))
+    try:
+      path = self.path(key)
+      if self.local:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as fw:
+          fw.write(data)
+        os.replace(tmp_path, path)
+      else:
+        fs, _ = self.fs
+        fs.pipe_file(path, data.encode())
+      with self.lock:
+        if self.size is not None: self.size += len(data)
+        if self.size is None or self.size > self.max_size: self.evict()
+    except Exception:
+      pass
+
+  def entries(self):
+    ''' The (mtime, size, path) of every entry
+    '''
+    entries = []
+    if self.local:
+      for dirpath, _, filenames in os.walk(self.root):
+        for filename in filenames:
+          if not filename.endswith('.json'): continue
+          try:
+            stat = os.stat(os.path.join(dirpath, filename))
+          except FileNotFoundError:
+            continue
+          entries.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+    else:
+      fs, root = self.fs
+      for path, info in fs.find(root, detail=True).items():
+        if not path.endswith('.json'): continue
+        entries.append((info['LastModified'].timestamp(), info['size'], path))
+    return entries
+
+  def evict(self):
+    ''' Remove expired entries & the least recently used ones beyond max_size
+    '''
+    entries = sorted(self.entries())
+    self.size = sum(size for _, size, _ in entries)
+    now = time.time()
+    remove = os.remove if self.local else self.fs[0].rm_file
+    for mtime, size, path in entries:
+      if self.size <= self.max_size and now - mtime <= self.ttl: break
+      try:
+        remove(path)
+      except FileNotFoundError:
+        pass
+      self.size -= size
+
+def get_response_cache():
+  ''' The response cache configured by ENRICHR_RESPONSES (by default `.cache/enrichr/responses` in
+  the data dir of the job executing the notebook, or ~/.cache/enrichr/responses outside of jobs),
+  ENRICHR_RESPONSES_TTL (seconds) & ENRICHR_RESPONSES_SIZE (bytes)
+  '''
+  settings = get_settings()
+  root = settings.get('ENRICHR_RESPONSES')
+  if not root:
+    data_dir = get_job_data_dir()
+    if data_dir and ('://' not in data_dir or data_dir.startswith('s3://')):
+      root = f"{data_dir}/.cache/enrichr/responses"
+    else:
+      root = os.path.expanduser('~/.cache/enrichr/responses')
+  return ResponseCache(
+    root,
+    ttl=float(settings.get('ENRICHR_RESPONSES_TTL', 7*24*60*60)),
+    max_size=int(settings.get('ENRICHR_RESPONSES_SIZE', 512*1024**2)),
+  )
+
+class EnrichrClient:
+  ''' Enrichr's addList & enrich endpoints, `url` defaults to ENRICHR_URL and `max_workers`
+  (the number of concurrent requests) to ENRICHR_CONCURRENCY. Enrichment results are cached in
+  `cache` by the sorted gene list & library, so identical lists skip the network. Submissions
+  (whose userListId & shortId identify the submitted list) are only cached in a local `cache`,
+  by the gene list & its description.
+  '''
+  def __init__(self, url=None, max_workers=None, retries=5, timeout=60, limiter=None, cache=None):
+    settings = get_settings()
+    self.url = (url or settings.get('ENRICHR_URL') or default_url).rstrip('/')
+    self.max_workers = max_workers or int(settings.get('ENRICHR_CONCURRENCY', 4))
+    self.retries = retries
+    self.timeout = timeout
+    self.limiter = limiter or RateLimiter()
+    self.cache = cache or get_response_cache()
+    # userListId -> the key of its gene list
+    self.list_keys = {}
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.executor = None
+
+  @property
+  def session(self):
+    ''' A keep-alive session per thread
+    '''
+    session = getattr(self.local, 'session', None)
+    if session is None:
+      import requests
+      from requests.adapters import HTTPAdapter
+      session = requests.Session()
+      session.mount('http://', HTTPAdapter(pool_maxsize=self.max_workers))
+      session.mount('https://', HTTPAdapter(pool_maxsize=self.max_workers))
+      self.local.session = session
+    return session
+
+  def request(self, method, path, error='Error contacting Enrichr', **kwargs):
+    import requests
+    for attempt in range(self.retries + 1):
+      self.limiter.wait()
+      try:
+        response = self.session.request(method, self.url + path, timeout=self.timeout, **kwargs)
+      except (requests.ConnectionError, requests.Timeout):
+        if attempt == self.retries: raise
+        self.limiter.throttled()
+        continue
+      if response.status_code in throttle_statuses and attempt < self.retries:
+        self.limiter.throttled(parse_retry_after(response.headers.get('Retry-After')))
+        continue
+      if not response.ok:
+        raise Exception(f"{error} ({response.status_code})")
+      self.limiter.succeeded()
+      return response
+
+  def add_list(self, genes, description=''):
+    ''' Submit a gene list, returning its `userListId` & `shortId`
+    '''
+    genes = list(genes)
+    list_key = self.cache.key(self.url, sorted(set(genes)))
+    # a store shared between users (e.g. s3) would hand out another user's submission
+    add_key = self.cache.key('addList', list_key, description) if self.cache.local else None
+    result = self.cache.get(add_key) if add_key is not None else None
+    if result is None:
+      result = self.request('POST', '/addList', error='Error analyzing gene list', files={
+        'list': (None, '\n'.join(genes)),
+        'description': (None, description),
+      }).json()
+      if add_key is not None:
+        self.cache.set(add_key, result)
+    with self.lock:
+      self.list_keys[result['userListId']] = list_key
+    return result
+
+  def enrich(self, user_list_id, library):
+    ''' The enrichment results of a submitted gene list against a gene set library
+    '''
+    list_key = self.list_keys.get(user_list_id)
+    if list_key is not None:
+      result = self.cache.get(self.cache.key('enrich', list_key, library))
+      if result is not None: return result
+    result = self.request('GET', '/enrich', error='Error fetching enrichment results', params={
+      'userListId': user_list_id,
+      'backgroundType': library,
+    }).json()[library]
+    if list_key is not None:
+      self.cache.set(self.cache.key('enrich', list_key, library), result)
+    return result
+
+  def map(self, fn, items):
+    ''' [fn(item) for item in items] with up to max_workers items at a time. Items which haven't
+    started by the time the caller waits on them run in the calling thread, so maps can be nested
+    (e.g. per-geneset maps of per-library maps) without starving the pool.
+    '''
+    items = list(items)
+    if len(items) < 2 or self.max_workers < 2:
+      return [fn(item) for item in items]
+    with self.lock:
+      if self.executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='enrichr')
+    futures = [self.executor.submit(fn, item) for item in items]
+    return [
+      fn(item) if future.cancel() else future.result()
+      for item, future in zip(items, futures)
+    ]
+
+def read_gmt(path):
+  ''' The (term, genes) of each line of a GMT file, streamed. Enrichr's libraries have an empty
+  description column and some annotate genes with a weight (`GENE,1.0`) which is dropped.
+  '''
+  with open(path, 'r') as fr:
+    for line in fr:
+      term, *rest = line.rstrip('\r\n').split('\t')
+      if not term or not rest: continue
+      yield term, [gene.split(',', 1)[0] for gene in rest[1:] if gene]
+
+def benjamini_hochberg(pvalues):
+  ''' Benjamini-Hochberg adjusted p-values (q-values)
+  '''
+  import numpy as np
+  pvalues = np.asarray(pvalues, dtype=float)
+  if len(pvalues) == 0: return pvalues
+  order = np.argsort(pvalues, kind='stable')
+  ranked = pvalues[order] * len(pvalues) / np.arange(1, len(pvalues) + 1)
+  qvalues = np.empty(len(pvalues))
+  qvalues[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+  return qvalues
+
+def hypergeom_sf(k, N, K, n, budget=2**22):
+  ''' P(X >= k) for X ~ Hypergeometric(N, K, n) elementwise, equal to the one-sided Fisher exact
+  p-value of an overlap of k. The shorter of the tails (lower when k is at most the mode) is summed
+  in log space, in blocks of rows of a similar tail length of at most `budget` values.
+  '''
+  import numpy as np
+  from scipy.special import gammaln, logsumexp
+  k, N, K, n = (np.asarray(v, dtype=np.int64).ravel() for v in np.broadcast_arrays(k, N, K, n))
+  log_choose = lambda a, b: gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1)
+  use_lower = k <= (n + 1) * (K + 1) // (N + 2)
+  start = np.where(use_lower, np.maximum(0, n + K - N), k)
+  stop = np.where(use_lower, k - 1, np.minimum(n, K))
+  width = np.maximum(stop - start + 1, 0)
+  tail = np.zeros(len(k))
+  nonempty = np.flatnonzero(width)
+  buckets = np.ceil(np.log2(width[nonempty])).astype(int)
+  for bucket in np.unique(buckets):
+    rows = nonempty[buckets == bucket]
+    step = max(1, budget // 2**bucket)
+    for i in range(0, len(rows), step):
+      block = rows[i:i+step]
+      x = start[block, np.newaxis] + np.arange(width[block].max())
+      valid = x <= stop[block, np.newaxis]
+      x = np.minimum(x, stop[block, np.newaxis])
+      Nb, Kb, nb = N[block, np.newaxis], K[block, np.newaxis], n[block, np.newaxis]
+      log_pmf = log_choose(Kb, x) + log_choose(Nb - Kb, nb - x) - log_choose(Nb, nb)
+      tail[block] = np.exp(logsumexp(np.where(valid, log_pmf, -np.inf), axis=1))
+  return np.clip(np.where(use_lower, 1 - tail, tail), 0, 1)
+
+class GeneSetLibrary:
+  ''' The terms of a gene set library & their genes, indexed as a sparse (terms x genes) matrix
+  '''
+  def __init__(self, terms, genes, indptr, indices):
+    import numpy as np
+    import scipy.sparse
+    self.terms = list(terms)
+    self.genes = list(genes)
+    self.gene_index = {gene: i for i, gene in enumerate(self.genes)}
+    self.indptr = np.asarray(indptr, dtype=np.int64)
+    self.indices = np.asarray(indices, dtype=np.int32)
+    self.sizes = np.diff(self.indptr)
+    self.matrix = scipy.sparse.csr_matrix(
+      (np.ones(len(self.indices), dtype=np.int32), self.indices, self.indptr),
+      shape=(len(self.terms), len(self.genes)),
+    )
+
+  @classmethod
+  def from_gene_sets(cls, gene_sets):
+    ''' Index an iterable of (term, genes)
+    '''
+    terms, genes, indptr, indices = [], {}, [0], []
+    for term, term_genes in gene_sets:
+      terms.append(term)
+      indices.extend(sorted({genes.setdefault(gene, len(genes)) for gene in term_genes}))
+      indptr.append(len(indices))
+    return cls(terms, genes, indptr, indices)
+
+  def query_matrix(self, queries):
+    ''' The genes of each query (a collection of genes) which are in the library, as a sparse (queries x genes) matrix
+    '''
+    import numpy as np
+    import scipy.sparse
+    rows, cols = [], []
+    for i, query in enumerate(queries):
+      ids = {self.gene_index[gene] for gene in query if gene in self.gene_index}
+      rows.extend([i] * len(ids))
+      cols.extend(ids)
+    return scipy.sparse.csr_matrix(
+      (np.ones(len(cols), dtype=np.int32), (rows, cols)),
+      shape=(len(queries), len(self.genes)),
+    )
+
+  def fisher(self, queries, n_background=20000):
+    ''' One-sided Fisher exact tests of each query against each term in one pass, returning
+    (queries x terms) arrays of the overlap, p-value, odds ratio, z-score (of the overlap under
+    the hypergeometric distribution) and combined score (-ln(p-value) * odds ratio). Each query
+    is tested on its own background, so its results don't depend on the other queries.
+    '''
+    import numpy as np
+    queries = [set(query) for query in queries]
+    Q = self.query_matrix(queries)
+    a = np.asarray((Q @ self.matrix.T).todense())
+    n = np.array([len(query) for query in queries])[:, np.newaxis]
+    K = self.sizes[np.newaxis, :]
+    # the background of each query must at least cover the library & its genes outside of it
+    N = np.maximum(n_background, len(self.genes) + n - np.asarray(Q.sum(axis=1)))
+    b, c, d = n - a, K - a, N - n - K + a
+    # p-values of the distinct (overlap, term size, query size & background) of overlapping terms
+    _, group = np.unique(np.concatenate([n, N], axis=1), axis=0, return_inverse=True)
+    group = group.reshape(-1, 1)
+    hits = a > 0
+    a_hits, K_hits = a[hits], np.broadcast_to(K, a.shape)[hits]
+    n_hits, N_hits = np.broadcast_to(n, a.shape)[hits], np.broadcast_to(N, a.shape)[hits]
+    group_hits = np.broadcast_to(group, a.shape)[hits]
+    keys, first, inverse = np.unique((a_hits * (int(K.max(initial=0)) + 1) + K_hits) * (int(group.max(initial=0)) + 1) + group_hits, return_index=True, return_inverse=True)
+    pvalue = np.ones(a.shape)
+    pvalue[hits] = hypergeom_sf(a_hits[first], N_hits[first], K_hits[first], n_hits[first])[inverse]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      odds_ratio = (a * d) / (b * c)
+      expected = n * K / N
+      zscore = (a - expected) / np.sqrt(expected * (1 - K / N) * (N - n) / (N - 1))
+      combined_score = -np.log(pvalue) * odds_ratio
+    return dict(overlap=a, pvalue=pvalue, odds_ratio=odds_ratio, zscore=zscore, combined_score=combined_score)
+
+  def overlapping_genes(self, query, terms):
+    ''' The genes of the query in each of `terms` (term indices)
+    '''
+    import numpy as np
+    mask = np.zeros(len(self.genes), dtype=bool)
+    mask[[self.gene_index[gene] for gene in set(query) if gene in self.gene_index]] = True
+    hits = mask[self.indices]
+    offsets = np.concatenate([[0], np.cumsum(hits)])[self.indptr]
+    genes = np.array(self.genes, dtype=object)[self.indices[hits]]
+    return [genes[offsets[term]:offsets[term+1]].tolist() for term in terms]
+
+def get_compiled_path(path, mtime_ns, size, upper, cache_dir):
+  ''' The compiled library of a GMT file as of its mtime & size, in `cache_dir`
+  '''
+  prefix = hashlib.sha1(f"{os.path.realpath(path)}:{upper}".encode()).hexdigest()
+  version = hashlib.sha1(f"{mtime_ns}:{size}".encode()).hexdigest()[:16]
+  return os.path.join(cache_dir, f"{prefix}-{version}.npz")
+
+def save_library(library, compiled_path):
+  import glob
+  import numpy as np
+  os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+  with open(compiled_path + '.tmp', 'wb') as fw:
+    np.savez(fw, terms=np.array(library.terms, dtype=str), genes=np.array(library.genes, dtype=str), indptr=library.indptr, indices=library.indices)
+  os.replace(compiled_path + '.tmp', compiled_path)
+  # compiled versions of the GMT file which it has since replaced
+  for stale in glob.glob(compiled_path.rsplit('-', 1)[0] + '-*.npz'):
+    if stale != compiled_path:
+      os.remove(stale)
+
+@functools.lru_cache(maxsize=8)
+def _load_library(path, mtime_ns, size, upper, cache_dir):
+  import numpy as np
+  compiled_path = get_compiled_path(path, mtime_ns, size, upper, cache_dir) if cache_dir else None
+  if compiled_path and os.path.exists(compiled_path):
+    with np.load(compiled_path) as compiled:
+      return GeneSetLibrary(compiled['terms'].tolist(), compiled['genes'].tolist(), compiled['indptr'], compiled['indices'])
+  library = GeneSetLibrary.from_gene_sets(
+    (term, [gene.upper() for gene in genes]) if upper else (term, genes)
+    for term, genes in read_gmt(path)
+  )
+  if compiled_path:
+    try:
+      save_library(library, compiled_path)
+    except OSError:
+      pass
+  return library
+
+def load_library(path, upper=False, cache_dir=None):
+  ''' A GMT file as a GeneSetLibrary (with upper cased genes if `upper`), parsed once: libraries are
+  kept in memory by path & mtime (the 8 most recently used) and compiled to `cache_dir`
+  (ENRICHR_CACHE, ~/.cache/enrichr/compiled by default) for subsequent processes
+  '''
+  if cache_dir is None:
+    cache_dir = get_settings().get('ENRICHR_CACHE') or os.path.expanduser('~/.cache/enrichr/compiled')
+  stat = os.stat(path)
+  return _load_library(os.path.realpath(path), stat.st_mtime_ns, stat.st_size, upper, cache_dir)
+
+def enrichment_table(library, queries, n_background=20000):
+  ''' The enrichment of many queries (label -> genes, or a list of genes) against an indexed library
+  in one pass, as a long format DataFrame with a row for each query & term overlapping it sorted
+  by query & p-value, q-values are Benjamini-Hochberg adjusted p-values of each query
+  '''
+  import numpy as np
+  import pandas as pd
+  if not isinstance(queries, dict): queries = dict(enumerate(queries))
+  labels = list(queries)
+  stats = library.fisher([queries[label] for label in labels], n_background=n_background)
+  query_index, terms = np.nonzero(stats['overlap'])
+  order = np.lexsort((stats['pvalue'][query_index, terms], query_index))
+  query_index, terms = query_index[order], terms[order]
+  pvalue = stats['pvalue'][query_index, terms]
+  qvalue = np.empty(len(pvalue))
+  overlap = []
+  bounds = np.searchsorted(query_index, np.arange(len(labels) + 1))
+  for i, label in enumerate(labels):
+    qvalue[bounds[i]:bounds[i+1]] = benjamini_hochberg(pvalue[bounds[i]:bounds[i+1]])
+    overlap.extend(library.overlapping_genes(queries[label], terms[bounds[i]:bounds[i+1]]))
+  return pd.DataFrame({
+    'query': np.array(labels, dtype=object)[query_index],
+    'term_name': np.array(library.terms, dtype=object)[terms],
+    'pvalue': pvalue,
+    'qvalue': qvalue,
+    'odds_ratio': stats['odds_ratio'][query_index, terms],
+    'zscore': stats['zscore'][query_index, terms],
+    'combined_score': stats['combined_score'][query_index, terms],
+    'n_overlap': stats['overlap'][query_index, terms],
+    'overlap': overlap,
+  })
+
+def enrichr_rows(library, queries, n_background=20000):
+  ''' The results of each query in the format of Enrichr's enrich endpoint, for each term overlapping
+  the query by p-value: [rank, term, p-value, odds ratio, combined score, overlapping genes,
+  adjusted p-value, old p-value, old adjusted p-value] (Enrichr reports the odds ratio where it
+  used to report its z-score)
+  '''
+  table = enrichment_table(library, list(queries), n_background=n_background)
+  table['rank'] = table.groupby('query').cumcount() + 1
+  columns = ['rank', 'term_name', 'pvalue', 'odds_ratio', 'combined_score', 'overlap', 'qvalue', 'pvalue', 'qvalue']
+  results = [[] for _ in queries]
+  for query, *row in zip(table['query'].tolist(), *(table[column].tolist() for column in columns)):
+    results[query].append(row)
+  return results
+
+class LocalEnrichr(EnrichrClient):
+  ''' Enrichr's addList & enrich computed locally against the gene set libraries in `libraries`
+  (ENRICHR_LIBRARIES, as `<library>.gmt`), missing libraries are downloaded from Enrichr once.
+  All gene lists submitted so far are tested against a library together when it is first queried.
+  '''
+  def __init__(self, libraries=None, n_background=20000, cache_dir=None, **kwargs):
+    super().__init__(**kwargs)
+    self.libraries = libraries or get_settings().get('ENRICHR_LIBRARIES') or os.path.expanduser('~/.cache/enrichr')
+    self.cache_dir = cache_dir
+    self.n_background = n_background
+    self.lists = {}
+    self.results = {}
+    self.library_locks = {}
+
+  def add_list(self, genes, description=''):
+    with self.lock:
+      user_list_id = len(self.lists) + 1
+      self.lists[user_list_id] = [gene.upper() for gene in genes]
+    return dict(userListId=user_list_id, shortId=None)
+
+  def download_library(self, library):
+    path = os.path.join(self.libraries, f"{library}.gmt")
+    if not os.path.exists(path):
+      os.makedirs(self.libraries, exist_ok=True)
+      response = self.request('GET', '/geneSetLibrary', error=f"Error downloading {library}", params={
+        'mode': 'text',
+        'libraryName': library,
+      })
+      with open(path + '.tmp', 'w') as fw:
+        fw.write(response.text)
+      os.replace(path + '.tmp', path)
+    return path
+
+  def get_library(self, library):
+    return load_library(self.download_library(library), upper=True, cache_dir=self.cache_dir)
+
+  def enrich(self, user_list_id, library):
+    with self.lock:
+      library_lock = self.library_locks.setdefault(library, threading.Lock())
+    with library_lock:
+      results = self.results.setdefault(library, {})
+      if user_list_id not in results:
+        gene_set_library = self.get_library(library)
+        with self.lock:
+          pending = {i: genes for i, genes in self.lists.items() if i not in results}
+        results.update(zip(pending, enrichr_rows(gene_set_library, list(pending.values()), n_background=self.n_background)))
+      return results[user_list_id]
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+  ''' The process wide client, sharing its sessions & rate limit
+  '''
+  global _client
+  with _client_lock:
+    if _client is None:
+      _client = LocalEnrichr() if get_settings().get('ENRICHR_LOCAL', 'false').lower() in ('1', 'true') else EnrichrClient()
+    return _client
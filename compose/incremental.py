@@ -0,0 +1,59 @@
+''' Helpers for regenerating build outputs incrementally: rendered outputs are split
+into per-service blocks which are fingerprinted so that only services whose block
+actually changed are reported (and rewritten) as changed.
+'''
+
+import os
+import re
+import hashlib
+
+def fingerprint(content):
+  return hashlib.sha256(content.encode()).hexdigest()
+
+def split_compose_services(docker_compose):
+  ''' Split a rendered docker-compose.yml into { service_name: block } using the
+  two-space indented keys under `services:`
+  '''
+  services = {}
+  service = None
+  in_services = False
+  for line in docker_compose.splitlines(keepends=True):
+    if re.match(r'^\S', line):
+      in_services = line.rstrip() == 'services:'
+      service = None
+      continue
+    if in_services:
+      m = re.match(r'^  (?P<service>[^\s:#][^:]*):\s*$', line)
+      if m:
+        service = m.group('service')
+        services[service] = ''
+    if service is not None:
+      services[service] += line
+  return services
+
+def changed_blocks(old_blocks, new_blocks):
+  ''' Names of blocks which were added or whose fingerprint differs
+  '''
+  old_fingerprints = {name: fingerprint(block) for name, block in old_blocks.items()}
+  return [
+    name
+    for name, block in new_blocks.items()
+    if old_fingerprints.get(name) != fingerprint(block)
+  ]
+
+def read_if_exists(path):
+  try:
+    return open(path, 'r').read()
+  except FileNotFoundError:
+    return None
+
+def write_if_changed(path, content):
+  ''' Only write content to path if it differs from what's already there,
+  returns whether or not a write happened.
+  '''
+  if read_if_exists(path) == content:
+    return False
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(path, 'w') as fw:
+    fw.write(content)
+  return True
@@ -0,0 +1,61 @@
+''' Per-appyter resource profiles: the optional `resources` block of appyter.json
+(`memory` like 512M/4G, `cpus` & expected `runtime` in seconds) of a single job, used
+for sizing the orchestrator's dispatcher and the native pools which execute the jobs.
+'''
+
+import re
+
+default_profile = dict(memory='2G', cpus=1, runtime=3600)
+
+def parse_memory(memory):
+  ''' Parse docker style memory (`512M`, `4G`, binary units) into bytes
+  '''
+  m = re.match(r'^(?P<value>[0-9]+(\.[0-9]+)?)(?P<unit>[KMG])$', memory)
+  assert m, f"Unrecognized memory {memory}"
+  return int(float(m.group('value')) * 1024 ** ('KMG'.index(m.group('unit')) + 1))
+
+def get_profile(appyter):
+  ''' The appyter's resource profile with defaults filled in and memory in bytes,
+  None if the appyter doesn't declare one
+  '''
+  if not appyter.get('resources'): return None
+  profile = dict(default_profile, **appyter['resources'])
+  profile['memory'] = parse_memory(profile['memory'])
+  return profile
+
+def get_pool_resources(appyter, size):
+  ''' The resources of a native pool running up to `size` of the appyter's jobs at once,
+  None if the appyter doesn't declare a profile
+  '''
+  profile = get_profile(appyter)
+  if profile is None: return None
+  return dict(memory=profile['memory'] * size, cpus=profile['cpus'] * size)
+
+def plan_dispatcher(appyters, memory=None, jobs=3, jobs_per_image=1):
+  ''' Concurrency of the orchestrator's dispatcher (APPYTER_JOBS & APPYTER_JOBS_PER_IMAGE).
+  The dispatcher admits jobs by count, not by their memory, so given the `memory` available
+  to dispatched jobs, as many jobs run concurrently as fit with the heaviest profile: any mix
+  of jobs then stays within it. A single image may use at most half of the jobs so that one
+  appyter can't hold all of them. Without it the defaults are kept.
+  '''
+  if memory is None:
+    return dict(jobs=jobs, jobs_per_image=jobs_per_image)
+  budget = parse_memory(memory)
+  default_memory = parse_memory(default_profile['memory'])
+  reserved = max([(get_profile(appyter) or {}).get('memory', default_memory) for appyter in appyters] or [default_memory])
+  jobs = max(1, budget // reserved)
+  return dict(
+    jobs=jobs,
+    jobs_per_image=max(1, jobs // 2),
+  )
+
+def parse_pools(pools):
+  ''' Parse native pool sizes `name=size,...` (comma or whitespace separated) into { name: size }
+  '''
+  sizes = {}
+  for pool in re.split(r'[\s,]+', pools or ''):
+    if not pool: continue
+    name, _, size = pool.partition('=')
+    sizes[name] = int(size or 1)
+    assert sizes[name] > 0, f"Pool size of {name} should be positive"
+  return sizes
@@ -0,0 +1,19 @@
+-- flush staged hits before restoring direct increments
+select pagehits_rollup();
+
+create or replace function api.pagehit(pageurl varchar) returns void as
+$$
+begin
+  insert into api.pagehits (url, hits)
+  values (pageurl, 1)
+  on conflict (url)
+  do update
+  set hits = api.pagehits.hits + 1;
+end
+$$
+language 'plpgsql' security definer;
+
+drop function api.pagehit_batch;
+drop function pagehits_rollup;
+drop table pagehits_rollup;
+drop table pagehits_staging;
@@ -0,0 +1,68 @@
+-- page hits are appended to an unlogged staging table rather than incrementing
+--  the (hot) api.pagehits rows directly, they are periodically rolled up into
+--  api.pagehits so counts are eventually consistent. being unlogged, a crash
+--  loses at most the hits staged since the last roll-up.
+create unlogged table pagehits_staging (
+  url varchar not null,
+  ts timestamp default CURRENT_TIMESTAMP
+);
+
+-- when pagehits_staging was last rolled up
+create table pagehits_rollup (
+  id boolean primary key default true check (id),
+  ts timestamp not null default CURRENT_TIMESTAMP
+);
+insert into pagehits_rollup default values;
+
+-- move staged hits into api.pagehits, a single session does this at a time
+create or replace function pagehits_rollup() returns void as
+$$
+begin
+  if not pg_try_advisory_xact_lock(hashtext('pagehits_rollup')) then
+    return;
+  end if;
+  with staged as (
+    delete from pagehits_staging
+    returning url
+  )
+  insert into api.pagehits (url, hits)
+  select url, count(*)
+  from staged
+  group by url
+  on conflict (url)
+  do update
+  set hits = api.pagehits.hits + excluded.hits;
+  update pagehits_rollup set ts = CURRENT_TIMESTAMP;
+end
+$$
+language 'plpgsql';
+grant all privileges on function pagehits_rollup() to appyters;
+
+-- add public pagehit_batch function for recording several page hits at once
+--  staging the hits and rolling them up if the last roll-up is older than a minute,
+--  a batch is limited to 100 hits as it's open to anonymous requests
+create or replace function api.pagehit_batch(pageurls varchar[]) returns void as
+$$
+begin
+  if array_length(pageurls, 1) > 100 then
+    raise exception 'pagehit_batch accepts at most 100 page hits, got %', array_length(pageurls, 1);
+  end if;
+  insert into pagehits_staging (url)
+  select unnest(pageurls);
+  if (select ts from pagehits_rollup) < CURRENT_TIMESTAMP - interval '1 minute' then
+    perform pagehits_rollup();
+  end if;
+end
+$$
+language 'plpgsql' security definer;
+grant all privileges on function api.pagehit_batch(varchar[]) to appyters;
+grant execute on function api.pagehit_batch(varchar[]) to guest;
+
+-- existing clients record single hits through the same staging table
+create or replace function api.pagehit(pageurl varchar) returns void as
+$$
+begin
+  perform api.pagehit_batch(array[pageurl]);
+end
+$$
+language 'plpgsql' security definer;
@@ -0,0 +1,24 @@
+create or replace function pagehits_rollup() returns void as
+$$
+begin
+  if not pg_try_advisory_xact_lock(hashtext('pagehits_rollup')) then
+    return;
+  end if;
+  with staged as (
+    delete from pagehits_staging
+    returning url
+  )
+  insert into api.pagehits (url, hits)
+  select url, count(*)
+  from staged
+  group by url
+  on conflict (url)
+  do update
+  set hits = api.pagehits.hits + excluded.hits;
+  update pagehits_rollup set ts = CURRENT_TIMESTAMP;
+end
+$$
+language 'plpgsql';
+
+drop materialized view api.pagehits_by_appyter;
+drop index api.pagehits_url_pattern_idx;
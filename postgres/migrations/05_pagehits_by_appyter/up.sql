@@ -0,0 +1,57 @@
+-- index prefix (like 'https://host%') lookups on pagehits regardless of collation
+create index pagehits_url_pattern_idx on api.pagehits (url text_pattern_ops);
+
+-- page hits aggregated per appyter, urls are recorded as:
+--  {host}/#{appyter} (catalog views), {host}/{appyter} (form views),
+--  {host}/{appyter}#view (persistent views), {host}/{appyter}#execute (runs)
+create materialized view api.pagehits_by_appyter as
+select
+  host,
+  appyter,
+  coalesce(sum(hits) filter (where kind = 'views'), 0)::bigint as views,
+  coalesce(sum(hits) filter (where kind = 'form_views'), 0)::bigint as form_views,
+  coalesce(sum(hits) filter (where kind = 'persistent_views'), 0)::bigint as persistent_views,
+  coalesce(sum(hits) filter (where kind = 'runs'), 0)::bigint as runs
+from (
+  select
+    m[1] as host,
+    m[3] as appyter,
+    case
+      when m[2] = '#' then 'views'
+      when m[4] = 'view' then 'persistent_views'
+      when m[4] = 'execute' then 'runs'
+      else 'form_views'
+    end as kind,
+    hits
+  from api.pagehits, regexp_match(url, '^([a-z]+://[^/]+)/(#)?([^/#?]+)(?:#(view|execute))?$') m
+) pagehits
+group by host, appyter;
+-- unique to permit concurrent refreshes, covering to answer the catalog with an index-only scan
+create unique index pagehits_by_appyter_idx on api.pagehits_by_appyter (host, appyter)
+  include (views, form_views, persistent_views, runs);
+grant all privileges on api.pagehits_by_appyter to appyters;
+grant select on api.pagehits_by_appyter to guest;
+
+-- refresh the aggregate whenever staged hits are rolled up
+create or replace function pagehits_rollup() returns void as
+$$
+begin
+  if not pg_try_advisory_xact_lock(hashtext('pagehits_rollup')) then
+    return;
+  end if;
+  with staged as (
+    delete from pagehits_staging
+    returning url
+  )
+  insert into api.pagehits (url, hits)
+  select url, count(*)
+  from staged
+  group by url
+  on conflict (url)
+  do update
+  set hits = api.pagehits.hits + excluded.hits;
+  update pagehits_rollup set ts = CURRENT_TIMESTAMP;
+  refresh materialized view concurrently api.pagehits_by_appyter;
+end
+$$
+language 'plpgsql';
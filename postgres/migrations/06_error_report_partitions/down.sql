@@ -0,0 +1,48 @@
+create table error_report_unpartitioned (
+  id uuid default uuid_generate_v4(),
+  appyter jsonb,
+  url varchar,
+  type varchar,
+  error jsonb,
+  ts timestamp default CURRENT_TIMESTAMP,
+  addressed boolean default false,
+  primary key (id)
+);
+insert into error_report_unpartitioned (id, appyter, url, type, error, ts, addressed)
+  select id, appyter, url, type, error, ts, addressed
+  from error_report;
+
+create or replace function api.report_error(
+  appyter jsonb,
+  url varchar,
+  type varchar,
+  error jsonb
+) returns uuid as
+$$
+declare
+  _id uuid;
+begin
+  insert into error_report (
+    appyter,
+    url,
+    type,
+    error
+  ) values (
+    appyter,
+    url,
+    type,
+    error
+  ) returning id
+  into _id;
+  return _id;
+end
+$$
+language 'plpgsql' security definer;
+
+drop view error_report_daily;
+drop function error_report_maintain;
+drop table error_report_maintenance;
+drop table error_report;
+drop function error_report_fingerprint;
+drop function error_report_message;
+alter table error_report_unpartitioned rename to error_report;
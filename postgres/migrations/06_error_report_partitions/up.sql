@@ -0,0 +1,160 @@
+-- error reports are partitioned by month on ts so that triage queries only touch
+--  recent partitions and reports past their retention are dropped a partition at a time
+alter table error_report rename to error_report_unpartitioned;
+
+-- the error message normalized such that recurrences of an error compare equal
+--  (uuids & numbers masked, whitespace collapsed)
+create or replace function error_report_message(error jsonb) returns text as
+$$
+  select left(
+    regexp_replace(
+      regexp_replace(
+        regexp_replace(
+          coalesce(error->>'ename' || ': ' || coalesce(error->>'evalue', ''), error->>'message', error #>> '{}', ''),
+          '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', '<uuid>', 'gi'
+        ),
+        '0x[0-9a-f]+|[0-9]+([.][0-9]+)?', '<n>', 'gi'
+      ),
+      '\s+', ' ', 'g'
+    ),
+    1000
+  )
+$$
+language sql immutable;
+
+-- reports of the same error (appyter name, error type & normalized message) share a fingerprint
+create or replace function error_report_fingerprint(appyter jsonb, type varchar, error jsonb) returns text as
+$$
+  select md5(concat_ws(E'\n', coalesce(appyter->>'name', ''), coalesce(type, ''), error_report_message(error)))
+$$
+language sql immutable;
+
+create table error_report (
+  id uuid default uuid_generate_v4(),
+  appyter jsonb,
+  url varchar,
+  type varchar,
+  error jsonb,
+  ts timestamp not null default CURRENT_TIMESTAMP,
+  addressed boolean default false,
+  fingerprint text generated always as (error_report_fingerprint(appyter, type, error)) stored,
+  primary key (id, ts)
+) partition by range (ts);
+-- catches reports for months without a partition until maintenance creates it
+create table error_report_default partition of error_report default;
+create index error_report_fingerprint_idx on error_report (fingerprint, ts);
+create index error_report_unaddressed_idx on error_report (ts) where not addressed;
+
+-- partition maintenance settings & when it last ran
+create table error_report_maintenance (
+  id boolean primary key default true check (id),
+  ts timestamp,
+  retention interval not null default '1 year',
+  premake integer not null default 2
+);
+insert into error_report_maintenance default values;
+
+-- create monthly partitions up to `premake` months ahead (moving any reports
+--  which landed in the default partition into them) and drop those past `retention`
+create or replace function error_report_maintain() returns void as
+$$
+declare
+  _settings error_report_maintenance;
+  _month date;
+  _partition text;
+begin
+  if not pg_try_advisory_xact_lock(hashtext('error_report_maintain')) then
+    return;
+  end if;
+  select * into _settings from error_report_maintenance;
+  delete from error_report_default where ts < LOCALTIMESTAMP - _settings.retention;
+  _month := date_trunc('month', least(LOCALTIMESTAMP, (select min(ts) from error_report_default)));
+  while _month <= date_trunc('month', LOCALTIMESTAMP + make_interval(months => _settings.premake)) loop
+    _partition := 'error_report_' || to_char(_month, '"y"YYYY"m"MM');
+    if to_regclass(_partition) is null then
+      create temporary table error_report_moved as
+        select id, appyter, url, type, error, ts, addressed
+        from error_report_default
+        where ts >= _month and ts < _month + interval '1 month';
+      delete from error_report_default where ts >= _month and ts < _month + interval '1 month';
+      execute format(
+        'create table %I partition of error_report for values from (%L) to (%L)',
+        _partition, _month, _month + interval '1 month'
+      );
+      insert into error_report (id, appyter, url, type, error, ts, addressed)
+        select id, appyter, url, type, error, ts, addressed
+        from error_report_moved;
+      drop table error_report_moved;
+    end if;
+    _month := _month + interval '1 month';
+  end loop;
+  for _partition in
+    select c.relname
+    from pg_inherits i
+    join pg_class c on c.oid = i.inhrelid
+    where i.inhparent = 'error_report'::regclass
+      and c.relname ~ '^error_report_y[0-9]{4}m[0-9]{2}$'
+  loop
+    if to_date(substring(_partition from 'y([0-9]{4}m[0-9]{2})$'), 'YYYY"m"MM') + interval '1 month'
+      <= LOCALTIMESTAMP - _settings.retention then
+      execute format('drop table %I', _partition);
+    end if;
+  end loop;
+  update error_report_maintenance set ts = LOCALTIMESTAMP;
+end
+$$
+language 'plpgsql';
+
+-- move the existing reports into their partitions
+insert into error_report (id, appyter, url, type, error, ts, addressed)
+  select id, appyter, url, type, error, coalesce(ts, CURRENT_TIMESTAMP), addressed
+  from error_report_unpartitioned;
+select error_report_maintain();
+drop table error_report_unpartitioned;
+
+-- report counts per error fingerprint per day, for triage
+create view error_report_daily as
+select
+  fingerprint,
+  date_trunc('day', ts)::date as day,
+  min(appyter->>'name') as appyter,
+  min(type) as type,
+  min(error_report_message(error)) as message,
+  count(*) as reports,
+  count(*) filter (where not addressed) as unaddressed,
+  min(ts) as first_seen,
+  max(ts) as last_seen
+from error_report
+group by fingerprint, date_trunc('day', ts)::date;
+
+-- add public report_error function for reporting an error
+--  running partition maintenance if it hasn't run for a day
+create or replace function api.report_error(
+  appyter jsonb,
+  url varchar,
+  type varchar,
+  error jsonb
+) returns uuid as
+$$
+declare
+  _id uuid;
+begin
+  insert into error_report (
+    appyter,
+    url,
+    type,
+    error
+  ) values (
+    appyter,
+    url,
+    type,
+    error
+  ) returning id
+  into _id;
+  if coalesce((select ts from error_report_maintenance), '-infinity') < CURRENT_TIMESTAMP - interval '1 day' then
+    perform error_report_maintain();
+  end if;
+  return _id;
+end
+$$
+language 'plpgsql' security definer;
@@ -0,0 +1,20 @@
+-- roll up staged hits from pagehit_batch again, when the last roll-up is older than a minute
+create or replace function api.pagehit_batch(pageurls varchar[]) returns void as
+$$
+begin
+  if array_length(pageurls, 1) > 100 then
+    raise exception 'pagehit_batch accepts at most 100 page hits, got %', array_length(pageurls, 1);
+  end if;
+  insert into pagehits_staging (url)
+  select unnest(pageurls);
+  if (select ts from pagehits_rollup) < CURRENT_TIMESTAMP - interval '1 minute' then
+    perform pagehits_rollup();
+  end if;
+end
+$$
+language 'plpgsql' security definer;
+
+select current_database() as appyters_database \gset
+\connect postgres
+select cron.unschedule('pagehits_rollup');
+\connect :appyters_database
@@ -0,0 +1,22 @@
+-- roll up staged page hits (and refresh api.pagehits_by_appyter) every minute with pg_cron
+--  rather than only when a later hit arrives, so counts don't go stale once traffic stops.
+--  pg_cron is loaded by the image (shared_preload_libraries) and lives in the postgres
+--  database from where it runs the job in this one.
+select current_database() as appyters_database \gset
+\connect postgres
+create extension if not exists pg_cron;
+select cron.schedule_in_database('pagehits_rollup', '* * * * *', 'select pagehits_rollup()', :'appyters_database');
+\connect :appyters_database
+
+-- recording hits only stages them
+create or replace function api.pagehit_batch(pageurls varchar[]) returns void as
+$$
+begin
+  if array_length(pageurls, 1) > 100 then
+    raise exception 'pagehit_batch accepts at most 100 page hits, got %', array_length(pageurls, 1);
+  end if;
+  insert into pagehits_staging (url)
+  select unnest(pageurls);
+end
+$$
+language 'plpgsql' security definer;
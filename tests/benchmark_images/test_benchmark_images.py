@@ -0,0 +1,27 @@
+def test_get_image():
+  from compose.benchmark_images import get_image
+  config = dict(name='Example', version='0.1.0')
+  assert get_image(config, dict(appyter_version='0.13.0')) == 'maayanlab/appyter-example:0.1.0-0.13.0'
+  assert get_image(config, dict(DOCKER_REGISTRY='registry', appyter_tag='v', appyter_version='0.13.0')) == 'registry/appyter-example:0.1.0-v0.13.0'
+
+def test_compare_runs():
+  from compose.benchmark_images import compare_runs
+  old = dict(appyters=dict(
+    a=dict(size=1000, layers=10, ready_seconds=10.0, first_cell_seconds=None),
+    b=dict(size=1000),
+  ))
+  new = dict(appyters=dict(
+    a=dict(size=1050, layers=12, ready_seconds=5.0, first_cell_seconds=3.0),
+    c=dict(size=1000),
+  ))
+  assert compare_runs(old, new, tolerance=0.1) == [
+    dict(appyter='a', metric='layers', old=10, new=12),
+    dict(appyter='a', metric='ready_seconds', old=10.0, new=5.0),
+  ]
+
+def test_read_trend(tmp_path):
+  import json
+  from compose.benchmark_images import read_trend
+  assert read_trend(str(tmp_path / 'missing.jsonl')) == []
+  (tmp_path / 'images.jsonl').write_text('\n'.join(json.dumps(dict(catalog_version=v)) for v in ['0.1.0', '0.1.1']) + '\n')
+  assert [run['catalog_version'] for run in read_trend(str(tmp_path / 'images.jsonl'))] == ['0.1.0', '0.1.1']
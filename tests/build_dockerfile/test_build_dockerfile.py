@@ -0,0 +1,98 @@
+def test_cluster_dependencies():
+  from compose.build_dockerfile import cluster_dependencies
+  clusters = cluster_dependencies({
+    'a': {'pip:numpy', 'pip:pandas', 'pip:scanpy', 'pip:anndata'},
+    'b': {'pip:numpy', 'pip:pandas', 'pip:scanpy', 'pip:anndata', 'apt:r-base'},
+    'c': {'pip:numpy', 'pip:pandas', 'pip:requests'},
+    'd': {'pip:flask'},
+  })
+  assert clusters == [
+    (['a', 'b'], ['pip:anndata', 'pip:numpy', 'pip:pandas', 'pip:scanpy']),
+  ]
+
+def test_build_dockerfile_from_base():
+  import os, json
+  from compose.build_dockerfile import build_dockerfile, plan_base_images
+  appyter_path = os.path.join(os.path.dirname(__file__), '..', '..', 'appyters', 'example')
+  config = json.load(open(os.path.join(appyter_path, 'appyter.json'), 'r'))
+  bases, appyter_bases = plan_base_images()
+  base = bases[appyter_bases['example']]
+  dockerfile = build_dockerfile(appyter_path, config, base=base)
+  assert f"appyter-base:{base['tag']}" in dockerfile
+  assert 'FROM ubuntu' not in dockerfile
+  assert 'FROM ubuntu' in build_dockerfile(appyter_path, config)
+
+def test_build_dockerfile_transfer_env():
+  import os, re, json
+  from compose.build_dockerfile import build_dockerfile
+  from compose.catalog_helper import transfer_defaults, transfer_env_settings
+  appyter_path = os.path.join(os.path.dirname(__file__), '..', '..', 'appyters', 'example')
+  config = json.load(open(os.path.join(appyter_path, 'appyter.json'), 'r'))
+  dockerfile = build_dockerfile(appyter_path, config)
+  # dispatched jobs get the entrypoint's default transfer settings from the image
+  args = dict(re.findall(r'^ARG APPYTER_S3_(\w+)=(.+)$', dockerfile, re.MULTILINE))
+  env = dict(re.findall(r'^ENV (RCLONE_\w+) "\$\{APPYTER_S3_(\w+)\}"$', dockerfile, re.MULTILINE))
+  assert {key.lower(): value for key, value in args.items()} == transfer_defaults
+  assert {key: value.lower() for key, value in env.items()} == {
+    key: setting for key, setting in transfer_env_settings.items() if setting != 'buffer_size'
+  }
+
+def test_assign_clusters_stable():
+  from compose.build_dockerfile import assign_clusters
+  dependencies = {
+    'a': {'pip:numpy', 'pip:pandas', 'pip:scanpy'},
+    'b': {'pip:numpy', 'pip:pandas', 'pip:scanpy', 'apt:r-base'},
+    'c': {'pip:flask'},
+  }
+  clusters = assign_clusters(dependencies)
+  assert clusters == [(['a', 'b'], ['pip:numpy', 'pip:pandas', 'pip:scanpy'])]
+  # new appyters don't pull the members of existing clusters away
+  dependencies['d'] = {'pip:numpy', 'pip:pandas', 'pip:scanpy', 'apt:r-base', 'pip:anndata'}
+  dependencies['e'] = {'pip:numpy', 'pip:pandas', 'pip:scanpy', 'apt:r-base', 'pip:anndata'}
+  assert assign_clusters(dependencies, clusters) == [
+    (['a', 'b'], ['pip:numpy', 'pip:pandas', 'pip:scanpy']),
+    (['d', 'e'], ['apt:r-base', 'pip:anndata', 'pip:numpy', 'pip:pandas', 'pip:scanpy']),
+  ]
+  del dependencies['d'], dependencies['e']
+  # and join those they fit
+  dependencies['f'] = {'pip:numpy', 'pip:pandas', 'pip:scanpy', 'pip:requests'}
+  assert assign_clusters(dependencies, clusters) == [(['a', 'b', 'f'], ['pip:numpy', 'pip:pandas', 'pip:scanpy'])]
+  del dependencies['f']
+  # members which no longer fit leave, clusters left with one member are dissolved
+  dependencies['b'] = {'pip:flask'}
+  assert assign_clusters(dependencies, clusters) == []
+  # the result is stable when re-applied
+  dependencies = {appyter: {'pip:numpy', 'pip:pandas', 'pip:scanpy', f"pip:{appyter}"} for appyter in 'abcd'}
+  clusters = assign_clusters(dependencies)
+  assert assign_clusters(dependencies, clusters) == clusters
+
+def test_base_tag_ignores_members():
+  from compose.build_dockerfile import get_base_tag
+  base = dict(parent='core-0', appyters=['a', 'b'], apt=[], pip=['numpy'])
+  assert get_base_tag(base) == get_base_tag(dict(base, appyters=['a', 'b', 'c']))
+  assert get_base_tag(base) != get_base_tag(dict(base, pip=['numpy', 'pandas']))
+
+def test_wheelhouse_pinned(tmp_path):
+  import json
+  from compose.build_dockerfile import is_pinned, build_dockerfile
+  assert is_pinned(['numpy==1.19.5', 'scanpy[leiden]==1.7.2 ; python_version >= "3.7"', '# comment', ''])
+  assert not is_pinned(['numpy==1.19.5', 'pandas'])
+  assert not is_pinned(['numpy>=1.19'])
+  assert not is_pinned(['numpy==1.*'])
+  assert not is_pinned(['-r other.txt'])
+  (tmp_path / 'requirements.txt').write_text('numpy==1.19.5\n')
+  config = {'appyter': {'file': 'appyter.ipynb'}}
+  # only fully pinned requirements are installed from the wheelhouse without the index
+  pinned = build_dockerfile(str(tmp_path), config, wheelhouse=True)
+  (tmp_path / 'requirements.txt').write_text('numpy\n')
+  unpinned = build_dockerfile(str(tmp_path), config, wheelhouse=True)
+  assert 'pip3 install --no-cache-dir --no-index --find-links /wheelhouse -r /app/requirements.txt \\\n    ||' in pinned
+  assert 'pip3 wheel --no-cache-dir --find-links /wheelhouse --wheel-dir /wheelhouse -r /app/requirements.txt \\\n  && pip3 install' in unpinned
+
+def test_uses_enrichr_client():
+  import os
+  from compose.build_dockerfile import uses_enrichr_client
+  appyters = os.path.join(os.path.dirname(__file__), '..', '..', 'appyters')
+  assert uses_enrichr_client(os.path.join(appyters, 'scRNA_seq'))
+  assert uses_enrichr_client(os.path.join(appyters, 'Independent_Enrichment_Analysis'))
+  assert not uses_enrichr_client(os.path.join(appyters, 'example'))
@@ -0,0 +1,94 @@
+import time
+
+def make_tasks(inputs, ran, fail=()):
+  from compose.build_graph import Task
+  def action(name):
+    def run():
+      time.sleep(0.05 if name == 'slow' else 0)
+      ran.append(name)
+      if name in fail: raise Exception('failed')
+    return run
+  deps = {'base': [], 'a': ['base'], 'slow': ['base'], 'b': ['a', 'slow'], 'other': []}
+  return {
+    name: Task(name, deps=deps[name], inputs=lambda name=name: inputs.get(name), action=action(name))
+    for name in deps
+  }
+
+def test_run_graph_incremental():
+  from compose.build_graph import run_graph
+  inputs, ran, state = {}, [], {}
+  results = run_graph(make_tasks(inputs, ran), ['b'], state, jobs=2, echo=lambda *args: None)
+  assert set(ran) == {'base', 'a', 'slow', 'b'}
+  assert ran.index('base') < ran.index('a') < ran.index('b')
+  assert {result['status'] for result in results.values()} == {'ran'}
+  # nothing changed
+  ran.clear()
+  results = run_graph(make_tasks(inputs, ran), ['b'], state, jobs=2, echo=lambda *args: None)
+  assert ran == [] and {result['status'] for result in results.values()} == {'skipped'}
+  # a changed input reruns the task & its dependents only
+  inputs['a'] = 'changed'
+  results = run_graph(make_tasks(inputs, ran), ['b'], state, jobs=2, dry_run=True, echo=lambda *args: None)
+  assert ran == [] and sorted(name for name, result in results.items() if result['status'] == 'stale') == ['a', 'b']
+  results = run_graph(make_tasks(inputs, ran), ['b'], state, jobs=2, echo=lambda *args: None)
+  assert ran == ['a', 'b']
+
+def test_run_graph_after():
+  from compose.build_graph import Task, run_graph
+  inputs, ran, state = {}, [], {}
+  def make_tasks():
+    return {
+      'shared': Task('shared', inputs=lambda: inputs.get('shared'), action=lambda: ran.append('shared')),
+      'part': Task('part', after=['shared'], inputs=lambda: inputs.get('part'), action=lambda: ran.append('part')),
+    }
+  run_graph(make_tasks(), ['part'], state, echo=lambda *args: None)
+  assert ran == ['shared', 'part']
+  # tasks in `after` run first without making this task stale
+  ran.clear()
+  inputs['shared'] = 'changed'
+  run_graph(make_tasks(), ['part'], state, echo=lambda *args: None)
+  assert ran == ['shared']
+
+def test_run_graph_failure():
+  from compose.build_graph import run_graph
+  ran, state = [], {}
+  results = run_graph(make_tasks({}, ran, fail={'a'}), ['b', 'other'], state, jobs=2, echo=lambda *args: None)
+  assert results['a']['status'] == 'failed'
+  assert results['b']['status'] == 'blocked'
+  assert results['other']['status'] == 'ran'
+  assert 'a' not in state and 'b' not in state
+
+def test_critical_path():
+  from compose.build_graph import critical_path
+  tasks = make_tasks({}, [])
+  results = {
+    'base': dict(duration=1), 'a': dict(duration=1), 'slow': dict(duration=5),
+    'b': dict(duration=2), 'other': dict(duration=3),
+  }
+  assert critical_path(tasks, results) == (['base', 'slow', 'b'], 8)
+
+def test_file_hasher(tmp_path):
+  from compose.build_graph import FileHasher
+  (tmp_path / 'appyter').mkdir()
+  (tmp_path / 'appyter' / 'appyter.json').write_text('{}')
+  (tmp_path / 'appyter' / 'Dockerfile').write_text('FROM scratch')
+  cache = {}
+  h = FileHasher(cache).hash_paths(str(tmp_path / 'appyter'), exclude={'Dockerfile'})
+  assert len(cache) == 1
+  (tmp_path / 'appyter' / 'Dockerfile').write_text('FROM ubuntu')
+  assert FileHasher(cache).hash_paths(str(tmp_path / 'appyter'), exclude={'Dockerfile'}) == h
+  (tmp_path / 'appyter' / 'appyter.json').write_text('{"a": 1}')
+  assert FileHasher(cache).hash_paths(str(tmp_path / 'appyter'), exclude={'Dockerfile'}) != h
+
+def test_plan_graph_keys_per_appyter():
+  import os
+  from compose.build_graph import FileHasher, plan_graph, root_dir
+  inputs = lambda tasks: {name: task.inputs() for name, task in tasks.items() if name.startswith('dockerfile:')}
+  before = inputs(plan_graph(FileHasher()))
+  # an edit of one appyter's requirements.txt (as seen by the hasher)
+  requirements = os.path.join(root_dir, 'appyters', 'scRNA_seq', 'requirements.txt')
+  stat = os.stat(requirements)
+  hasher = FileHasher({requirements: [stat.st_size, stat.st_mtime_ns, 'edited']})
+  tasks = plan_graph(hasher)
+  after = inputs(tasks)
+  assert [name for name in before if before[name] != after[name]] == ['dockerfile:scRNA_seq']
+  assert tasks['build:scRNA_seq'].deps == ['dockerfile:scRNA_seq']
@@ -10,10 +10,121 @@ def test_merge_j2():
   print(result)
   assert expectation == result
 
+def test_merge_j2_nested():
+  from compose.catalog_helper import merge_j2
+  result = merge_j2(
+    '\n'.join([
+      '{% extends "base.j2" %}',
+      '{% block body %}',
+      '{{ super() }}',
+      '{% block inner %}<inner0 />{% endblock %}',
+      '{% endblock %}',
+    ]),
+    '\n'.join([
+      '{% extends "base.j2" %}',
+      '{% block inner %}',
+      '{{ super() }}',
+      '<inner1 />',
+      '{% endblock %}',
+    ]),
+  )
+  print(result)
+  assert result == '\n'.join([
+    '{% extends "base.j2" %}',
+    '',
+    '{% block body %}',
+    '{{ super() }}',
+    '{% block inner %}',
+    '<inner0 />',
+    '<inner1 />',
+    '{% endblock %}',
+    '{% endblock %}',
+  ])
+
+def test_merge_j2_cached(tmp_path):
+  from compose.catalog_helper import merge_j2, merge_j2_cached
+  test_0 = open(os.path.join(os.path.dirname(__file__), 'test_merge_j2_0.j2'), 'r').read()
+  test_1 = open(os.path.join(os.path.dirname(__file__), 'test_merge_j2_1.j2'), 'r').read()
+  assert merge_j2_cached(test_0, test_1, cache_dir=str(tmp_path)) == merge_j2(test_0, test_1)
+  assert len(os.listdir(tmp_path)) == 1
+  assert merge_j2_cached(test_0, test_1, cache_dir=str(tmp_path)) == merge_j2(test_0, test_1)
+
 def test_merge_j2_directories():
   from compose.catalog_helper import merge_j2_directories
   test_primary = os.path.join(os.path.dirname(__file__), 'primary')
   test_override = os.path.join(os.path.dirname(__file__), 'override')
   test_merged = os.path.join(os.path.dirname(__file__), 'merged')
-  shutil.rmtree(test_merged)
+  shutil.rmtree(test_merged, ignore_errors=True)
   merge_j2_directories(test_primary, test_override, test_merged)
+
+def test_override_templates(tmp_path):
+  from compose.catalog_helper import override_templates, templates_overridden
+  app = tmp_path / 'app'
+  shutil.copytree(os.path.join(os.path.dirname(__file__), 'primary'), str(app))
+  shutil.copytree(os.path.join(os.path.dirname(__file__), 'override'), str(app / 'override'))
+  original = (app / 'templates' / 'base.j2').read_text()
+  assert not templates_overridden(str(app))
+  # at image build time
+  override_templates(str(app), cache_dir=str(tmp_path / 'cache'))
+  assert (app / 'templates.sav' / 'base.j2').read_text() == original
+  assert (app / 'templates' / 'fields' / 'field1.j2').exists()
+  # a fresh container only verifies them
+  assert templates_overridden(str(app))
+  # until the overrides change
+  (app / 'override' / 'templates' / 'fields' / 'field1.j2').write_text('changed')
+  assert not templates_overridden(str(app))
+  override_templates(str(app), cache_dir=str(tmp_path / 'cache'))
+  assert (app / 'templates' / 'fields' / 'field1.j2').read_text() == 'changed'
+  assert templates_overridden(str(app))
+
+def test_get_transfer_env():
+  from compose.catalog_helper import get_transfer_settings, get_transfer_env
+  settings = get_transfer_settings({'APPYTER_S3_CHUNK_SIZE': '64M', 'APPYTER_S3_CONCURRENCY': '8'})
+  assert settings['chunk_size'] == '64M' and settings['concurrency'] == '8'
+  env = get_transfer_env(settings, environ={'RCLONE_TRANSFERS': '2'})
+  assert env['RCLONE_S3_CHUNK_SIZE'] == '64M'
+  assert env['RCLONE_S3_UPLOAD_CONCURRENCY'] == '8'
+  # explicitly configured rclone settings are kept
+  assert env['RCLONE_TRANSFERS'] == '2'
+  # unless the setting is overridden
+  env = get_transfer_env(settings, environ={'RCLONE_TRANSFERS': '2', 'APPYTER_S3_CONCURRENCY': '8'})
+  assert env['RCLONE_TRANSFERS'] == '8'
+  # the buffers of concurrent transfers are sized to the memory available
+  assert get_transfer_settings({})['buffer_size'] == '32768K'
+  assert get_transfer_settings({}, memory=512 * 1024**2)['buffer_size'] == '8192K'
+  assert get_transfer_settings({}, memory=32 * 1024**2)['buffer_size'] == '1024K'
+
+def test_write_rclone_wrapper(tmp_path, monkeypatch):
+  import subprocess
+  from compose.catalog_helper import write_rclone_wrapper
+  (tmp_path / 'real').mkdir()
+  rclone = tmp_path / 'real' / 'rclone'
+  rclone.write_text('#!/bin/sh\necho "$RCLONE_S3_CHUNK_SIZE $@"\n')
+  rclone.chmod(0o755)
+  monkeypatch.setenv('PATH', os.pathsep.join([str(tmp_path / 'real'), os.environ['PATH']]))
+  (tmp_path / 'bin').mkdir()
+  write_rclone_wrapper(str(tmp_path / 'bin'), {'RCLONE_S3_CHUNK_SIZE': '16M'})
+  # natively dispatched jobs only get the PATH, the wrapper supplies the transfer settings
+  proc = subprocess.run(['rclone', 'mount', 'remote:', '/mnt'], env={'PATH': os.pathsep.join([str(tmp_path / 'bin'), os.environ['PATH']])}, stdout=subprocess.PIPE)
+  assert proc.stdout.decode().strip() == '16M mount remote: /mnt'
+
+def test_get_s3_remote_env():
+  from compose.catalog_helper import get_s3_remote_env, parse_size
+  env, path = get_s3_remote_env('s3://access:secret@appyters-s3:9000/storage/appyters/')
+  assert path == 'benchmark:storage/appyters'
+  assert env['RCLONE_CONFIG_BENCHMARK_PROVIDER'] == 'Minio'
+  assert env['RCLONE_CONFIG_BENCHMARK_ENDPOINT'] == 'http://appyters-s3:9000'
+  assert env['RCLONE_CONFIG_BENCHMARK_ACCESS_KEY_ID'] == 'access'
+  assert env['RCLONE_CONFIG_BENCHMARK_SECRET_ACCESS_KEY'] == 'secret'
+  assert parse_size('16M') == 16 * 1024**2
+  assert parse_size('1.5G') == int(1.5 * 1024**3)
+  assert parse_size('512') == 512
+
+def test_persist_enrichr_settings(tmp_path):
+  from compose.catalog_helper import persist_enrichr_settings
+  from compose.enrichr_client import get_settings
+  path = str(tmp_path / '.enrichr.json')
+  persist_enrichr_settings(path, environ={'ENRICHR_LOCAL': 'true', 'ENRICHR_CONCURRENCY': '2', 'HOME': '/app'})
+  assert get_settings(environ={'ENRICHR_CONCURRENCY': '8'}, path=path) == {'ENRICHR_LOCAL': 'true', 'ENRICHR_CONCURRENCY': '8'}
+  persist_enrichr_settings(path, environ={})
+  assert get_settings(environ={}, path=path) == {}
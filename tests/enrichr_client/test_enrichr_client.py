@@ -0,0 +1,275 @@
+import time
+import threading
+
+class FakeResponse:
+  def __init__(self, status_code, data=None, headers={}):
+    self.status_code = status_code
+    self.ok = status_code < 400
+    self.data = data
+    self.headers = headers
+
+  def json(self):
+    return self.data
+
+class FakeSession:
+  def __init__(self, responses):
+    self.responses = list(responses)
+    self.requests = []
+
+  def request(self, method, url, **kwargs):
+    self.requests.append((method, url, kwargs))
+    return self.responses.pop(0)
+
+def test_rate_limiter():
+  from compose.enrichr_client import RateLimiter
+  limiter = RateLimiter(backoff_interval=0.5, max_interval=2.)
+  assert limiter.interval == 0.
+  limiter.throttled()
+  assert limiter.interval == 0.5
+  limiter.throttled()
+  limiter.throttled()
+  limiter.throttled()
+  assert limiter.interval == 2.
+  for _ in range(6):
+    limiter.succeeded()
+  assert limiter.interval == 0.
+
+def test_request_retries_throttled(tmp_path):
+  from compose.enrichr_client import EnrichrClient, RateLimiter, ResponseCache
+  client = EnrichrClient(url='https://enrichr.test/Enrichr/', retries=2, limiter=RateLimiter(backoff_interval=0.), cache=ResponseCache(str(tmp_path)))
+  client.local.session = FakeSession([
+    FakeResponse(429, headers={'Retry-After': '0'}),
+    FakeResponse(200, {'userListId': 1, 'shortId': 'a'}),
+  ])
+  assert client.add_list(['A', 'B'], description='test') == {'userListId': 1, 'shortId': 'a'}
+  method, url, kwargs = client.local.session.requests[-1]
+  assert (method, url) == ('POST', 'https://enrichr.test/Enrichr/addList')
+  assert kwargs['files']['list'] == (None, 'A\nB')
+  #
+  client.local.session = FakeSession([FakeResponse(503)] * 3)
+  try:
+    client.enrich(1, 'KEGG_2019_Human')
+  except Exception as e:
+    assert 'Error fetching enrichment results' in str(e)
+  else:
+    assert False, 'Expected the request to fail'
+
+def test_response_cache(tmp_path):
+  import os
+  from compose.enrichr_client import EnrichrClient, ResponseCache
+  cache = ResponseCache(str(tmp_path))
+  client = EnrichrClient(url='https://enrichr.test/Enrichr', cache=cache)
+  client.local.session = FakeSession([
+    FakeResponse(200, {'userListId': 1, 'shortId': 'a'}),
+    FakeResponse(200, {'KEGG_2019_Human': [[1, 'term']]}),
+  ])
+  assert client.add_list(['B', 'A'], description='up') == {'userListId': 1, 'shortId': 'a'}
+  assert client.enrich(1, 'KEGG_2019_Human') == [[1, 'term']]
+  # the same genes (in any order) & description are answered from the cache
+  client = EnrichrClient(url='https://enrichr.test/Enrichr', cache=cache)
+  client.local.session = FakeSession([])
+  assert client.add_list(['A', 'B', 'A'], description='up') == {'userListId': 1, 'shortId': 'a'}
+  assert client.enrich(1, 'KEGG_2019_Human') == [[1, 'term']]
+  assert client.local.session.requests == []
+  # another description is a new submission, its enrichment results are still shared
+  client.local.session = FakeSession([FakeResponse(200, {'userListId': 2, 'shortId': 'b'})])
+  assert client.add_list(['A', 'B'], description='other') == {'userListId': 2, 'shortId': 'b'}
+  assert client.enrich(2, 'KEGG_2019_Human') == [[1, 'term']]
+  assert len(client.local.session.requests) == 1
+  # expired entries are ignored
+  assert ResponseCache(str(tmp_path), ttl=1e-9).get(cache.key('enrich', client.list_keys[1], 'KEGG_2019_Human')) is None
+  # the least recently used entries are evicted beyond max_size
+  cache = ResponseCache(str(tmp_path / 'bounded'))
+  paths = [os.path.join(cache.root, cache.key(i)[:2], cache.key(i) + '.json') for i in range(5)]
+  for i in range(4):
+    cache.set(cache.key(i), 'x' * 20)
+    os.utime(paths[i], (time.time() - 100 + i,) * 2)
+  # entry sizes vary with the length of their timestamp
+  cache.max_size = 3 * max(os.path.getsize(path) for path in paths[:4])
+  assert cache.get(cache.key(0)) == 'x' * 20
+  cache.set(cache.key(4), 'x' * 20)
+  assert [os.path.exists(path) for path in paths] == [True, False, False, True, True]
+  assert cache.size <= cache.max_size
+
+class FakeS3FileSystem:
+  def __init__(self):
+    self.files = {}
+
+  def cat_file(self, path):
+    return self.files[path][1]
+
+  def pipe_file(self, path, data):
+    self.files[path] = (time.time(), data)
+
+  def find(self, path, detail=False):
+    import datetime
+    return {
+      key: {'size': len(data), 'LastModified': datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)}
+      for key, (mtime, data) in self.files.items()
+      if key.startswith(path + '/')
+    }
+
+  def rm_file(self, path):
+    del self.files[path]
+
+def test_response_cache_s3():
+  import pytest
+  from compose.enrichr_client import ResponseCache
+  fs = FakeS3FileSystem()
+  cache = ResponseCache('s3://key:secret@appyters-s3:9000/storage/appyters/.cache/enrichr/responses', fs=(fs, 'storage/appyters/.cache/enrichr/responses'))
+  cache.set(cache.key(0), 'x' * 20)
+  assert cache.get(cache.key(0)) == 'x' * 20
+  assert list(fs.files) == [f"storage/appyters/.cache/enrichr/responses/{cache.key(0)[:2]}/{cache.key(0)}.json"]
+  # the least recently written entries are evicted beyond max_size
+  for i in range(4):
+    cache.set(cache.key(i), 'x' * 20)
+    path = cache.path(cache.key(i))
+    fs.files[path] = (time.time() - 100 + i, fs.files[path][1])
+  cache.max_size = 3 * max(len(data) for _, data in fs.files.values())
+  cache.set(cache.key(4), 'x' * 20)
+  assert [cache.get(cache.key(i)) is not None for i in range(5)] == [False, False, True, True, True]
+  assert cache.size <= cache.max_size
+  # other storage uris can't be bounded
+  with pytest.raises(AssertionError):
+    ResponseCache('gs://bucket/responses')
+
+def test_get_job_data_dir():
+  import sys, json, subprocess
+  from compose.enrichr_client import get_job_data_dir
+  job = dict(cwd='s3://key:secret@appyters-s3:9000/storage/appyters/output/abc', session='abc')
+  # a process like the one appyter dispatches to execute a job
+  proc = subprocess.Popen([sys.executable, '-c', 'import time; print(flush=True); time.sleep(30)', 'orchestration', 'job', json.dumps(job)], stdout=subprocess.PIPE)
+  try:
+    proc.stdout.readline()
+    assert get_job_data_dir(proc.pid) == 's3://key:secret@appyters-s3:9000/storage/appyters'
+  finally:
+    proc.kill()
+    proc.wait()
+  assert get_job_data_dir() is None
+
+def test_map_nested():
+  from compose.enrichr_client import EnrichrClient
+  client = EnrichrClient(max_workers=2)
+  threads = set()
+  def inner(item):
+    threads.add(threading.current_thread().name)
+    return item * 2
+  def outer(items):
+    return client.map(inner, items)
+  # nested maps with more work than workers must not starve the pool
+  assert client.map(outer, [range(3), range(4), range(2)]) == [[0, 2, 4], [0, 2, 4, 6], [0, 2]]
+  assert len(threads) > 1
+
+def test_read_gmt(tmp_path):
+  from compose.enrichr_client import read_gmt
+  gmt = tmp_path / 'library.gmt'
+  gmt.write_text('A\t\tG1\tG2\nB\tdescription\tG2,1.0\tG3\t\n\n')
+  assert list(read_gmt(str(gmt))) == [('A', ['G1', 'G2']), ('B', ['G2', 'G3'])]
+
+def test_benjamini_hochberg():
+  import numpy as np
+  from compose.enrichr_client import benjamini_hochberg
+  assert np.allclose(benjamini_hochberg([0.01, 0.04, 0.03, 0.5]), [0.04, 0.16 / 3, 0.16 / 3, 0.5])
+  assert len(benjamini_hochberg([])) == 0
+
+def test_gene_set_library_fisher():
+  import numpy as np
+  import scipy.stats
+  from compose.enrichr_client import GeneSetLibrary
+  gene_sets = {
+    'A': ['G1', 'G2', 'G3', 'G4'],
+    'B': ['G3', 'G4', 'G5'],
+    'C': ['G6'],
+  }
+  library = GeneSetLibrary.from_gene_sets(gene_sets.items())
+  queries = [['G1', 'G2', 'G3', 'X1'], ['G5', 'G6']]
+  stats = library.fisher(queries, n_background=100)
+  for i, query in enumerate(queries):
+    for j, term in enumerate(gene_sets):
+      a = len(set(query) & set(gene_sets[term]))
+      b, c = len(query) - a, len(gene_sets[term]) - a
+      odds_ratio, pvalue = scipy.stats.fisher_exact([[a, b], [c, 100 - a - b - c]], 'greater')
+      assert stats['overlap'][i, j] == a
+      assert np.isclose(stats['pvalue'][i, j], pvalue)
+      assert np.isclose(stats['odds_ratio'][i, j], odds_ratio)
+  assert library.overlapping_genes(queries[0], [0, 1]) == [['G1', 'G2', 'G3'], ['G3']]
+  # a query's results don't depend on the queries it's tested with
+  alone = library.fisher(queries[:1], n_background=10)
+  batched = library.fisher([queries[0], ['G6'] + [f"X{i}" for i in range(50)]], n_background=10)
+  for stat in ('pvalue', 'odds_ratio', 'zscore'):
+    assert np.allclose(alone[stat][0], batched[stat][0], equal_nan=True)
+
+def test_local_enrichr(tmp_path):
+  from compose.enrichr_client import LocalEnrichr
+  (tmp_path / 'Test_Library.gmt').write_text('A\t\tG1\tG2\tG3\nB\t\tG4\tG5\nC\t\tG6\n')
+  client = LocalEnrichr(libraries=str(tmp_path), max_workers=1, cache_dir=str(tmp_path / 'compiled'))
+  up = client.add_list(['g1', 'g2', 'g4'])
+  down = client.add_list(['g6'])
+  assert up['userListId'] != down['userListId']
+  rows = client.enrich(up['userListId'], 'Test_Library')
+  assert [row[:2] for row in rows] == [[1, 'A'], [2, 'B']]
+  assert rows[0][5] == ['G1', 'G2'] and rows[0][2] < rows[1][2]
+  # every submitted list was tested when the library was first queried
+  assert set(client.results['Test_Library']) == {up['userListId'], down['userListId']}
+  assert [row[1] for row in client.enrich(down['userListId'], 'Test_Library')] == ['C']
+
+def test_load_library(tmp_path):
+  import os
+  from compose.enrichr_client import load_library, _load_library
+  gmt = tmp_path / 'library.gmt'
+  gmt.write_text('A\t\tg1\tg2\nB\t\tg3\n')
+  cache_dir = str(tmp_path / 'compiled')
+  library = load_library(str(gmt), upper=True, cache_dir=cache_dir)
+  assert library.terms == ['A', 'B'] and sorted(library.genes) == ['G1', 'G2', 'G3']
+  assert load_library(str(gmt), upper=True, cache_dir=cache_dir) is library
+  compiled, = os.listdir(cache_dir)
+  # a new process loads the compiled library rather than parsing the file
+  _load_library.cache_clear()
+  reloaded = load_library(str(gmt), upper=True, cache_dir=cache_dir)
+  assert reloaded is not library and reloaded.terms == library.terms and reloaded.genes == library.genes
+  # changes to the file are picked up & replace its compiled version
+  gmt.write_text('A\t\tg1\tg2\nB\t\tg3\nC\t\tg4\n')
+  os.utime(gmt, ns=(0, 0))
+  assert load_library(str(gmt), upper=True, cache_dir=cache_dir).terms == ['A', 'B', 'C']
+  assert os.listdir(cache_dir) != [compiled] and len(os.listdir(cache_dir)) == 1
+
+def test_load_library_mixed_case(tmp_path):
+  from compose.enrichr_client import load_library, enrichment_table
+  # e.g. mouse gene symbols, matched against the upper-cased queries of the appyters
+  gmt = tmp_path / 'mouse.gmt'
+  gmt.write_text('A\t\tTrp53\tCdkn1a\tMdm2\nB\t\tActb\n')
+  queries = {'up': ['TRP53', 'MDM2']}
+  table = enrichment_table(load_library(str(gmt), upper=True, cache_dir=str(tmp_path / 'compiled')), queries)
+  assert table['term_name'].tolist() == ['A'] and set(table['overlap'][0]) == {'TRP53', 'MDM2'}
+  assert len(enrichment_table(load_library(str(gmt), cache_dir=str(tmp_path / 'compiled')), queries)) == 0
+
+def test_appyters_load_libraries_upper():
+  import ast, glob
+  # the appyters upper-case their queries so their libraries must be loaded upper-cased too
+  for path in glob.glob('appyters/*/utils.py'):
+    with open(path, 'r') as fr:
+      tree = ast.parse(fr.read())
+    for node in ast.walk(tree):
+      if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'load_library':
+        assert any(kw.arg == 'upper' and getattr(kw.value, 'value', None) is True for kw in node.keywords), f"{path}:{node.lineno}"
+
+def test_enrichment_table():
+  import numpy as np
+  import scipy.stats
+  from compose.enrichr_client import GeneSetLibrary, enrichment_table, benjamini_hochberg
+  gene_sets = {f"T{i}": [f"G{j}" for j in range(i, i + 5)] for i in range(20)}
+  library = GeneSetLibrary.from_gene_sets(gene_sets.items())
+  queries = {'first': ['G0', 'G1', 'G2', 'G3'], 'second': ['G10', 'G12', 'X'], 'none': ['X']}
+  table = enrichment_table(library, queries, n_background=1000)
+  assert set(table['query']) == {'first', 'second'}
+  for label, rows in table.groupby('query', sort=False):
+    expected = {
+      term: scipy.stats.fisher_exact([[a, len(queries[label]) - a], [5 - a, 1000 - len(queries[label]) - 5 + a]], 'greater')[1]
+      for term, genes in gene_sets.items()
+      for a in [len(set(genes) & set(queries[label]))]
+      if a > 0
+    }
+    assert rows['term_name'].tolist() == sorted(expected, key=lambda term: (expected[term], int(term[1:])))
+    assert np.allclose(rows['pvalue'], [expected[term] for term in rows['term_name']])
+    assert np.allclose(rows['qvalue'], benjamini_hochberg(rows['pvalue']))
+    assert all(set(overlap) == set(gene_sets[term]) & set(queries[label]) for term, overlap in zip(rows['term_name'], rows['overlap']))
@@ -0,0 +1,22 @@
+def test_split_compose_services():
+  from compose.incremental import split_compose_services
+  services = split_compose_services('\n'.join([
+    "version: '3'",
+    "services:",
+    "  a:",
+    "    image: a:1",
+    "  b:",
+    "    image: b:1",
+    "volumes:",
+    "  c:",
+    "",
+  ]))
+  assert list(services) == ['a', 'b']
+  assert services['a'] == '  a:\n    image: a:1\n'
+
+def test_changed_blocks():
+  from compose.incremental import changed_blocks
+  assert changed_blocks(
+    {'a': '1', 'b': '2'},
+    {'a': '1', 'b': '3', 'c': '4'},
+  ) == ['b', 'c']
@@ -0,0 +1,30 @@
+def test_parse_memory():
+  from compose.resources import parse_memory
+  assert parse_memory('512M') == 512 * 1024**2
+  assert parse_memory('1.5G') == 1536 * 1024**2
+
+def test_get_profile():
+  from compose.resources import get_profile
+  assert get_profile({'name': 'a'}) is None
+  assert get_profile({'name': 'a', 'resources': {'memory': '4G'}}) == dict(memory=4 * 1024**3, cpus=1, runtime=3600)
+
+def test_get_pool_resources():
+  from compose.resources import get_pool_resources
+  assert get_pool_resources({'name': 'a'}, 2) is None
+  assert get_pool_resources({'name': 'a', 'resources': {'memory': '4G', 'cpus': 2}}, 2) == dict(memory=8 * 1024**3, cpus=4)
+
+def test_plan_dispatcher():
+  from compose.resources import plan_dispatcher
+  light = {'resources': {'memory': '512M'}}
+  heavy = {'resources': {'memory': '8G'}}
+  assert plan_dispatcher([light, heavy]) == dict(jobs=3, jobs_per_image=1)
+  # every job may be heavy, an image may only use half of them
+  assert plan_dispatcher([light, light, heavy], memory='16G') == dict(jobs=2, jobs_per_image=1)
+  assert plan_dispatcher([light, light, heavy], memory='32G') == dict(jobs=4, jobs_per_image=2)
+  # appyters without a profile reserve the default memory
+  assert plan_dispatcher([light, {}], memory='16G') == dict(jobs=8, jobs_per_image=4)
+
+def test_parse_pools():
+  from compose.resources import parse_pools
+  assert parse_pools(None) == {}
+  assert parse_pools('scRNA_seq=2, CITEseq') == {'scRNA_seq': 2, 'CITEseq': 1}
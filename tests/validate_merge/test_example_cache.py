@@ -0,0 +1,66 @@
+import os
+import threading
+import tempfile
+import functools
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+def test_get_example_urls(monkeypatch):
+  from validate.validate_merge import get_example_urls
+  monkeypatch.chdir(os.path.join(os.path.dirname(__file__), '..', '..'))
+  assert get_example_urls('Bulk_RNA_seq') == {
+    'https://appyters.maayanlab.cloud/storage/Bulk_RNA_seq/GSE70466-metadata.txt',
+    'https://appyters.maayanlab.cloud/storage/Bulk_RNA_seq/GSE70466-expression.txt',
+  }
+
+def test_example_cache():
+  from validate.validate_merge import ExampleCache
+  with tempfile.TemporaryDirectory() as tmp:
+    os.makedirs(os.path.join(tmp, 'remote'))
+    with open(os.path.join(tmp, 'remote', 'example.txt'), 'w') as fw:
+      fw.write('a\tb\n')
+    requests = []
+    class Handler(SimpleHTTPRequestHandler):
+      def log_message(self, *args):
+        requests.append(self.command)
+    server = HTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=os.path.join(tmp, 'remote')))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+      url = f"http://127.0.0.1:{server.server_port}/example.txt"
+      examples = ExampleCache(os.path.join(tmp, 'cache'))
+      path, content_type = examples.fetch(url)
+      assert open(path, 'r').read() == 'a\tb\n' and content_type == 'text/plain'
+      assert requests == ['HEAD', 'GET']
+      # unchanged on the remote, served from the cache
+      assert examples.fetch(url) == (path, content_type)
+      assert requests == ['HEAD', 'GET', 'HEAD']
+      # changed size on the remote, re-downloaded
+      with open(os.path.join(tmp, 'remote', 'example.txt'), 'w') as fw:
+        fw.write('a\tb\nc\td\n')
+      path, _ = examples.fetch(url)
+      assert open(path, 'r').read() == 'a\tb\nc\td\n'
+      # the local mirror never uses the network
+      mirror = ExampleCache(os.path.join(tmp, 'cache'), mirror=os.path.join(tmp, 'mirror'))
+      os.makedirs(os.path.dirname(mirror.mirror_path(url)))
+      with open(mirror.mirror_path(url), 'w') as fw:
+        fw.write('mirrored')
+      requests.clear()
+      path, _ = mirror.fetch(url)
+      assert open(path, 'r').read() == 'mirrored' and requests == []
+    finally:
+      server.shutdown()
+
+def test_reflink_or_copy():
+  from validate.validate_merge import reflink_or_copy
+  with tempfile.TemporaryDirectory() as tmp:
+    src, dst = os.path.join(tmp, 'cached.txt'), os.path.join(tmp, 'input.txt')
+    with open(src, 'w') as fw:
+      fw.write('cached')
+    os.chmod(src, 0o644)
+    reflink_or_copy(src, dst)
+    # the validation's chmod & writes from the notebook don't reach the cached file
+    assert os.stat(src).st_ino != os.stat(dst).st_ino
+    os.chmod(dst, 0o777)
+    with open(dst, 'w') as fw:
+      fw.write('changed')
+    assert open(src, 'r').read() == 'cached'
+    assert os.stat(src).st_mode & 0o777 == 0o644
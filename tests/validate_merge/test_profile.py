@@ -0,0 +1,44 @@
+def test_parse_size():
+  from validate.validate_merge import parse_size
+  assert parse_size('512B') == 512
+  assert parse_size('1.5KiB') == 1536
+  assert parse_size('2MB') == 2000000
+  assert parse_size('1GiB') == 1024**3
+
+def test_notebook_profile():
+  from validate.validate_merge import NotebookProfile
+  profile = NotebookProfile()
+  profile.update({'type': 'status', 'data': 'Executing...'})
+  profile.update({'type': 'progress', 'data': 0})
+  profile.sample(100)
+  profile.update({'type': 'cell', 'data': [{'cell_type': 'code', 'source': 'import pandas as pd'}, 0]})
+  profile.update({'type': 'progress', 'data': 1})
+  profile.sample(300)
+  profile.update({'type': 'cell', 'data': [{'cell_type': 'code', 'source': 'df = pd.read_csv(f)'}, 1]})
+  profile.update({'type': 'status', 'data': 'Success'})
+  report = profile.to_dict()
+  assert report['peak_rss'] == 300
+  assert [(cell['index'], cell['peak_rss'], cell['source']) for cell in report['cells']] == [
+    (0, 100, 'import pandas as pd'),
+    (1, 300, 'df = pd.read_csv(f)'),
+  ]
+  assert all(cell['seconds'] >= 0 for cell in report['cells'])
+
+def test_compare_profiles():
+  from validate.validate_merge import compare_profiles
+  baseline = {'cells': [
+    {'index': 0, 'source_sha256': 'a', 'seconds': 10, 'peak_rss': 1024**3},
+    {'index': 1, 'source_sha256': 'b', 'seconds': 10, 'peak_rss': 1024**3},
+  ]}
+  report = {'cells': [
+    {'index': 0, 'source_sha256': 'a', 'seconds': 30, 'peak_rss': 1024**3},
+    # changed cells aren't compared
+    {'index': 1, 'source_sha256': 'c', 'seconds': 30, 'peak_rss': 4 * 1024**3},
+  ]}
+  assert compare_profiles(report, baseline) == ['cell 0 took 30.0s (baseline 10.0s)']
+  assert compare_profiles(report, baseline, tolerance=3) == []
+
+def test_suggest_resources():
+  from validate.validate_merge import suggest_resources
+  assert suggest_resources(dict(peak_rss=700 * 1024**2, total_seconds=100)) == dict(memory='1280M', runtime=150)
+  assert suggest_resources(dict(peak_rss=1300 * 1024**2, total_seconds=10)) == dict(memory='2G', runtime=15)
@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+def test_hash_paths_ignores_generated():
+  from validate.validate_merge import hash_paths, _generated
+  with tempfile.TemporaryDirectory() as tmp:
+    with open(os.path.join(tmp, 'appyter.json'), 'w') as fw:
+      fw.write('{}')
+    before = hash_paths(tmp, exclude=_generated)
+    # build outputs don't change the hash
+    with open(os.path.join(tmp, 'Dockerfile'), 'w') as fw:
+      fw.write('FROM scratch')
+    os.makedirs(os.path.join(tmp, 'override'))
+    assert hash_paths(tmp, exclude=_generated) == before
+    # authored files do
+    with open(os.path.join(tmp, 'appyter.json'), 'w') as fw:
+      fw.write('{"name": "x"}')
+    assert hash_paths(tmp, exclude=_generated) != before
+
+def test_result_store():
+  from validate.validate_merge import ResultStore
+  with tempfile.TemporaryDirectory() as tmp:
+    store = ResultStore(os.path.join(tmp, 'results'))
+    assert store.get('abc') is None
+    store.put('abc', {'appyter': 'x', 'validated': 'now'})
+    assert store.get('abc') == {'appyter': 'x', 'validated': 'now'}
+
+def test_run_validation_skips_cached(monkeypatch):
+  import validate.validate_merge as validate_merge
+  monkeypatch.setattr(validate_merge, 'validation_key', lambda appyter: 'key')
+  calls = []
+  monkeypatch.setattr(validate_merge, 'validate_appyter', lambda appyter, timer, examples, reports: calls.append(appyter) or True)
+  with tempfile.TemporaryDirectory() as tmp:
+    store = validate_merge.ResultStore(tmp)
+    _, valid, timer = validate_merge.run_validation('x', store=store)
+    assert valid and not timer.cached and calls == ['x']
+    _, valid, timer = validate_merge.run_validation('x', store=store)
+    assert valid and timer.cached and calls == ['x']
+    _, valid, timer = validate_merge.run_validation('x', store=store, force=True)
+    assert valid and not timer.cached and calls == ['x', 'x']
+
+def test_run_validation_stopped(monkeypatch):
+  import validate.validate_merge as validate_merge
+  monkeypatch.setattr(validate_merge, 'validation_key', lambda appyter: 'key')
+  monkeypatch.setattr(validate_merge, 'validate_appyter', lambda appyter, timer, examples, reports: False)
+  with tempfile.TemporaryDirectory() as tmp:
+    store = validate_merge.ResultStore(tmp)
+    result = validate_merge.run_validation('x', store=store)
+    _, valid, timer = result
+    # stopping early doesn't fail the run, but it isn't reported as ok nor stored
+    assert valid and timer.stopped and store.get('key') is None
+    assert validate_merge.format_timings([result]).splitlines()[1].split()[-1] == 'stopped'
@@ -2,15 +2,22 @@ import os
 import re
 import sys
 import json
+import time
 import click
 import shutil
 import logging
+import threading
+import uuid
+import hashlib
+import datetime
+import mimetypes
 import nbformat as nbf
 import traceback
 import jsonschema
-import urllib.request, urllib.error
+import urllib.request, urllib.error, urllib.parse
 from PIL import Image
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # remove user agent from urllib.request requests
 _opener = urllib.request.build_opener()
@@ -24,6 +31,352 @@ def try_json_loads(s):
   except:
     s
 
+class StageTimer:
+  ''' Record the wall time spent in each consecutive stage of a pipeline
+  '''
+  def __init__(self):
+    self.stages = {}
+    self._stage = None
+    self._start = None
+    self.cached = False
+    # the validation stopped early (an example requires manual intervention)
+    self.stopped = False
+
+  def start(self, stage):
+    now = time.perf_counter()
+    if self._stage is not None:
+      self.stages[self._stage] = self.stages.get(self._stage, 0) + (now - self._start)
+    self._stage, self._start = stage, now
+
+  def stop(self):
+    self.start(None)
+
+def default_jobs(memory_per_job=4 * 1024**3):
+  ''' Size the worker pool to the available cores and memory, each appyter
+  pipeline (docker build + notebook execution) is assumed to need `memory_per_job`
+  '''
+  cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+  try:
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (ValueError, OSError, AttributeError):
+    return max(1, cpus)
+  return max(1, min(cpus, memory // memory_per_job))
+
+# files written into an appyter's directory by the build rather than by its authors
+_generated = {'Dockerfile', 'override', 'catalog_helper.py', 'enrichr_client.py', '.build', '.publish', '.deploy', '__pycache__', '.ipynb_checkpoints'}
+
+def hash_paths(*paths, exclude=frozenset()):
+  ''' Hash the relative paths & contents of all files under `paths` (files or directories),
+  skipping any file or directory whose name is in `exclude`
+  '''
+  h = hashlib.sha256()
+  for path in paths:
+    h.update(f"\0{os.path.basename(os.path.normpath(path))}\0".encode())
+    if os.path.isfile(path):
+      h.update(open(path, 'rb').read())
+      continue
+    for root, dirs, files in os.walk(path):
+      dirs[:] = sorted(d for d in dirs if d not in exclude)
+      for f in sorted(files):
+        if f in exclude: continue
+        h.update(f"\0{os.path.relpath(os.path.join(root, f), path)}\0".encode())
+        h.update(open(os.path.join(root, f), 'rb').read())
+  return h.hexdigest()
+
+def get_appyter_version():
+  ''' The appyter library version validation runs against: `appyter_version` from the
+  environment if set, otherwise that of the installed appyter package
+  '''
+  if os.environ.get('appyter_version'):
+    return os.environ['appyter_version']
+  try:
+    from importlib.metadata import version
+    return version('appyter')
+  except Exception:
+    return 'unknown'
+
+def validation_key(appyter, appyter_version=None):
+  ''' Everything a validation depends on: the appyter directory, the override templates,
+  catalog_helper.py, enrichr_client.py, the Dockerfile templates and the appyter library version
+  '''
+  if appyter_version is None: appyter_version = get_appyter_version()
+  root = os.path.join(os.path.dirname(__file__), '..')
+  return hashlib.sha256('\n'.join([
+    hash_paths(os.path.join('appyters', appyter), exclude=_generated),
+    hash_paths(os.path.join(root, 'override'), exclude=_generated),
+    hash_paths(
+      os.path.join(root, 'compose', 'catalog_helper.py'),
+      os.path.join(root, 'compose', 'enrichr_client.py'),
+      os.path.join(root, 'compose', 'build_dockerfile.py'),
+      os.path.join(root, 'compose', 'templates'),
+    ),
+    appyter_version,
+  ]).encode()).hexdigest()
+
+class ResultStore:
+  ''' Successful validations recorded on disk as `{key}.json`
+  '''
+  def __init__(self, path=os.path.join('.tmp', '.results')):
+    self.path = path
+
+  def get(self, key):
+    try:
+      return json.load(open(os.path.join(self.path, f"{key}.json"), 'r'))
+    except (FileNotFoundError, json.JSONDecodeError):
+      return None
+
+  def put(self, key, result):
+    os.makedirs(self.path, exist_ok=True)
+    with open(os.path.join(self.path, f"{key}.json.tmp"), 'w') as fw:
+      json.dump(result, fw)
+    os.replace(os.path.join(self.path, f"{key}.json.tmp"), os.path.join(self.path, f"{key}.json"))
+
+class ExampleCache:
+  ''' Example files shared between validations, keyed by url & the remote's ETag (or size).
+  With a `mirror`, files are served from `{mirror}/{host}/{path}` without touching the network.
+  '''
+  def __init__(self, path=os.path.join('.tmp', '.examples'), mirror=None):
+    self.path = path
+    self.mirror = mirror
+    self._lock = threading.Lock()
+    self._url_locks = {}
+
+  def _url_lock(self, url):
+    with self._lock:
+      return self._url_locks.setdefault(url, threading.Lock())
+
+  def mirror_path(self, url):
+    parsed = urllib.parse.urlparse(url)
+    return os.path.join(self.mirror, parsed.netloc, parsed.path.lstrip('/'))
+
+  def fetch(self, url):
+    ''' Returns (path, content_type) of the example at url, downloading it only if
+    the remote no longer matches what's cached. Servers reporting neither an ETag
+    nor a size are always re-downloaded.
+    '''
+    if self.mirror is not None:
+      path = self.mirror_path(url)
+      assert os.path.isfile(path), f"{url} is not in the mirror at {path}"
+      return path, mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    #
+    with self._url_lock(url):
+      try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD')) as response:
+          validator = response.headers.get('ETag') or response.headers.get('Content-Length') or ''
+      except urllib.error.HTTPError as e:
+        # not all servers support HEAD
+        if e.getcode() not in (405, 501): raise
+        validator = ''
+      key = hashlib.sha256(f"{url}\0{validator}".encode()).hexdigest()
+      path = os.path.join(self.path, key)
+      if validator:
+        try:
+          return path, json.load(open(f"{path}.json", 'r'))['content_type']
+        except (FileNotFoundError, json.JSONDecodeError):
+          pass
+      #
+      os.makedirs(self.path, exist_ok=True)
+      with urllib.request.urlopen(url) as response:
+        content_type = response.headers.get_content_type()
+        with open(f"{path}.tmp", 'wb') as fw:
+          shutil.copyfileobj(response, fw, 1024 * 1024)
+      os.replace(f"{path}.tmp", path)
+      with open(f"{path}.json", 'w') as fw:
+        json.dump(dict(url=url, validator=validator, content_type=content_type), fw)
+      return path, content_type
+
+def reflink_or_copy(src, dst):
+  ''' Put cached files into place as copy-on-write clones where the filesystem supports them (to avoid
+  copying multi-GB examples), copying otherwise. They're never hard linked: the validation changes
+  their permissions and notebooks may write to their inputs, which would change the cached files.
+  '''
+  if os.path.exists(dst): os.remove(dst)
+  if Popen(['cp', '--reflink=auto', src, dst], stderr=DEVNULL).wait() != 0:
+    shutil.copyfile(src, dst)
+
+def get_example_urls(appyter):
+  ''' Statically find the urls of the default FileField examples in an appyter's notebook
+  so they can be fetched before the docker image (required for nbinspect) is built
+  '''
+  config = json.load(open(os.path.join('appyters', appyter, 'appyter.json'), 'r'))
+  nb = nbf.read(open(os.path.join('appyters', appyter, config['appyter']['file']), 'r'), as_version=4)
+  urls = set()
+  for cell in nb.cells:
+    if cell['cell_type'] != 'code': continue
+    for field in re.split(r'\bFileField\s*\(', cell['source'])[1:]:
+      default = re.search(r'''\bdefault\s*=\s*['"]([^'"]+)['"]''', field)
+      examples = re.search(r'\bexamples\s*=\s*\{([^}]*)\}', field)
+      if not default or not examples: continue
+      for name, url in re.findall(r'''['"]([^'"]+)['"]\s*:\s*['"](https?://[^'"]+)['"]''', examples.group(1)):
+        if name == default.group(1):
+          urls.add(url)
+  return urls
+
+def prefetch_examples(examples, appyters, jobs=8):
+  ''' Concurrently fill the example cache with the default examples of all appyters,
+  failures are only logged as validation will report them
+  '''
+  logger = logging.getLogger('prefetch')
+  urls = set()
+  for appyter in appyters:
+    try:
+      urls |= get_example_urls(appyter)
+    except Exception as e:
+      logger.warning(f"Couldn't find examples of {appyter}: {e}")
+  if not urls: return
+  logger.info(f"Prefetching {len(urls)} example file(s)...")
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    futures = {executor.submit(examples.fetch, url): url for url in sorted(urls)}
+    for future in as_completed(futures):
+      try:
+        future.result()
+        logger.debug(f"Prefetched {futures[future]}")
+      except Exception as e:
+        logger.warning(f"Prefetching {futures[future]} failed: {e}")
+
+def parse_size(size):
+  ''' Parse docker's human readable sizes (e.g. `1.5GiB`, `12MB`) into bytes
+  '''
+  m = re.match(r'^\s*(?P<value>[\d.]+)\s*(?P<unit>[kKMGTP]?i?B)\s*$', size)
+  assert m, f"Unrecognized size {size}"
+  unit = m.group('unit')
+  power = ' KMGTP'.index(unit[0].upper()) if len(unit) > 1 else 0
+  return int(float(m.group('value')) * (1024 if 'i' in unit else 1000) ** power)
+
+class NotebookProfile:
+  ''' Per-cell wall time & peak container memory of a notebook execution, built from
+  the messages of `appyter nbexecute` (`progress` n is emitted as cell n starts) and
+  memory samples of the container.
+  '''
+  def __init__(self):
+    self.cells = {}
+    self.current = None
+    self.peak_rss = 0
+    self._start = None
+    self._lock = threading.Lock()
+
+  def _cell(self, index):
+    return self.cells.setdefault(index, dict(index=index, seconds=None, peak_rss=0))
+
+  def _finish(self, now):
+    if self.current is not None:
+      self._cell(self.current)['seconds'] = now - self._start
+    self.current = None
+
+  def update(self, msg):
+    if type(msg) != dict: return
+    now = time.perf_counter()
+    with self._lock:
+      if msg['type'] == 'progress':
+        self._finish(now)
+        self.current, self._start = msg['data'], now
+        self._cell(self.current)
+      elif msg['type'] == 'status' and msg['data'] == 'Success':
+        self._finish(now)
+      elif msg['type'] == 'cell':
+        cell, index = msg['data']
+        source = cell.get('source', '')
+        if type(source) == list: source = ''.join(source)
+        self._cell(index).update(
+          cell_type=cell.get('cell_type'),
+          source_sha256=hashlib.sha256(source.encode()).hexdigest(),
+          source=next(iter(source.strip().splitlines()), '')[:60],
+        )
+
+  def sample(self, rss):
+    with self._lock:
+      self.peak_rss = max(self.peak_rss, rss)
+      if self.current is not None:
+        cell = self._cell(self.current)
+        cell['peak_rss'] = max(cell['peak_rss'], rss)
+
+  def to_dict(self):
+    with self._lock:
+      cells = [cell for _, cell in sorted(self.cells.items()) if cell['seconds'] is not None]
+      return dict(
+        total_seconds=sum(cell['seconds'] for cell in cells),
+        peak_rss=self.peak_rss,
+        cells=cells,
+      )
+
+def sample_container_memory(container, profile):
+  ''' Stream `docker stats` for the container into profile.sample until terminated
+  '''
+  p = Popen(['docker', 'stats', '--format', '{{.MemUsage}}', container], stdout=PIPE, stderr=PIPE)
+  def reader():
+    for line in map(bytes.decode, p.stdout):
+      # streamed stats are separated with terminal escape sequences
+      m = re.search(r'([\d.]+\s*[kKMGTP]?i?B)\s*/', line)
+      if m: profile.sample(parse_size(m.group(1)))
+  threading.Thread(target=reader, daemon=True).start()
+  return p
+
+def format_profile(report, top=10):
+  ''' Summarize the slowest and most memory hungry cells of a profile report
+  '''
+  def rows(key, fmt):
+    return [
+      f"  cell {cell['index']:>3}  {fmt(cell[key]):>10}  {cell.get('source', '')}"
+      for cell in sorted(report['cells'], key=lambda cell: cell[key], reverse=True)[:top]
+    ]
+  return '\n'.join([
+    f"{report['appyter']}: {report['total_seconds']:.1f}s total, {report['peak_rss'] / 1024**2:.0f}MiB peak",
+    'slowest cells:',
+    *rows('seconds', lambda v: f"{v:.1f}s"),
+    'most memory hungry cells:',
+    *rows('peak_rss', lambda v: f"{v / 1024**2:.0f}MiB"),
+  ])
+
+def compare_profiles(report, baseline, tolerance=0.5, min_seconds=5, min_rss=256 * 1024**2):
+  ''' Cells (matched by index and unchanged source) which became slower or more memory hungry
+  than the baseline by more than `tolerance` (a fraction) and the absolute minimums (noise)
+  '''
+  baseline_cells = {cell['index']: cell for cell in baseline['cells']}
+  regressions = []
+  for cell in report['cells']:
+    base = baseline_cells.get(cell['index'])
+    if base is None or base.get('source_sha256') != cell.get('source_sha256'): continue
+    if cell['seconds'] > base['seconds'] * (1 + tolerance) and cell['seconds'] - base['seconds'] > min_seconds:
+      regressions.append(f"cell {cell['index']} took {cell['seconds']:.1f}s (baseline {base['seconds']:.1f}s)")
+    if base['peak_rss'] and cell['peak_rss'] > base['peak_rss'] * (1 + tolerance) and cell['peak_rss'] - base['peak_rss'] > min_rss:
+      regressions.append(f"cell {cell['index']} peaked at {cell['peak_rss'] / 1024**2:.0f}MiB (baseline {base['peak_rss'] / 1024**2:.0f}MiB)")
+  return regressions
+
+def suggest_resources(report, headroom=1.5):
+  ''' A `resources` block for appyter.json from a profile report, with headroom
+  '''
+  # MiB, rounded up to a multiple of 256
+  memory = -(-int(report['peak_rss'] * headroom) // (256 * 1024**2)) * 256
+  return dict(
+    memory=f"{memory // 1024}G" if memory % 1024 == 0 else f"{memory}M",
+    runtime=max(1, int(report['total_seconds'] * headroom + 0.5)),
+  )
+
+class ProfileReports:
+  ''' Write `{appyter}.json` & `{appyter}.txt` profile reports to `path`, comparing them
+  against the `{appyter}.json` reports in `baseline` if given
+  '''
+  def __init__(self, path=os.path.join('.tmp', '.reports'), baseline=None, tolerance=0.5):
+    self.path = path
+    self.baseline = baseline
+    self.tolerance = tolerance
+
+  def record(self, appyter, report):
+    ''' Write the report, returning the regressions relative to the baseline
+    '''
+    os.makedirs(self.path, exist_ok=True)
+    with open(os.path.join(self.path, f"{appyter}.json"), 'w') as fw:
+      json.dump(report, fw, indent=2)
+    with open(os.path.join(self.path, f"{appyter}.txt"), 'w') as fw:
+      print(format_profile(report), file=fw)
+    if self.baseline is None or not os.path.isfile(os.path.join(self.baseline, f"{appyter}.json")):
+      return []
+    baseline = json.load(open(os.path.join(self.baseline, f"{appyter}.json"), 'r'))
+    return compare_profiles(report, baseline, tolerance=self.tolerance)
+
+# base images are shared between appyters, only build them one at a time
+_base_images_lock = threading.Lock()
+
 def get_changed_appyters(github_action):
   if github_action:
     # load files from stdin
@@ -44,11 +397,16 @@ def get_changed_appyters(github_action):
   #
   return appyters
 
-def validate_appyter(appyter):
+def validate_appyter(appyter, timer=None, examples=None, reports=None):
   logger = logging.getLogger(appyter)
+  if timer is None: timer = StageTimer()
+  if examples is None: examples = ExampleCache()
+  if reports is None: reports = ProfileReports()
 
+  timer.start('checks')
   logger.info("Preparing temporary directory...")
-  tmp_directory = os.path.realpath('.tmp')
+  # each appyter gets its own directory so that concurrent validations don't clobber each other
+  tmp_directory = os.path.realpath(os.path.join('.tmp', appyter))
   os.makedirs(tmp_directory, exist_ok=True)
   #
   logger.info("Checking for existing of files...")
@@ -106,20 +464,29 @@ def validate_appyter(appyter):
   assert not os.path.isfile(os.path.join('appyters', appyter, 'Dockerfile')), 'Custom Dockerfiles are no longer supported'
   logger.info("Creating Dockerfile...")
   import sys; sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
-  from compose.build_dockerfile import prepare_appyter
+  from compose.build_dockerfile import prepare_appyter, plan_base_images, write_base_images, build_base_images
+  bases = plan_base_images()
   with open(os.path.join('appyters', appyter, 'Dockerfile'), 'w') as fw:
-    print(prepare_appyter(os.path.join('appyters', appyter), config), file=fw)
+    print(prepare_appyter(os.path.join('appyters', appyter), config, bases=bases, wheelhouse=True), file=fw)
+  #
+  timer.start('docker build')
+  logger.info("Building base image...")
+  with _base_images_lock:
+    bases_path = os.path.realpath(os.path.join('.tmp', '.bases'))
+    write_base_images(bases[0], bases_path, wheelhouse=True)
+    build_base_images(bases[0], bases_path, tags=[bases[1][appyter]], registry='maayanlab')
   #
   logger.info("Building Dockerfile...")
   with Popen([
     'docker', 'build',
     '-t', f"maayanlab/appyters-{config['name'].lower()}:{config['version']}",
     '.',
-  ], cwd=os.path.join('appyters', appyter), stdout=PIPE, stderr=sys.stderr) as p:
+  ], cwd=os.path.join('appyters', appyter), env=dict(os.environ, DOCKER_BUILDKIT='1'), stdout=PIPE, stderr=sys.stderr) as p:
     for line in filter(None, map(str.strip, map(bytes.decode, p.stdout))):
       logger.debug(f"`docker build .`: {line}")
     assert p.wait() == 0, '`docker build .` command failed'
   #
+  timer.start('nbinspect')
   logger.info("Inspecting appyter...")
   with Popen([
     'docker', 'run',
@@ -139,6 +506,7 @@ def validate_appyter(appyter):
   }
   assert len(field_args) == len(inspect), "Some of your fields weren't captured, there might be duplicate `name`s"
   #
+  timer.start('examples')
   logger.info("Preparing defaults...")
   default_args = {
     field_name: field.get('default')
@@ -159,10 +527,11 @@ def validate_appyter(appyter):
           logger.info(f"Copying example file {default_file} from {field_examples[default_file]}...")
           shutil.copyfile(os.path.join('appyters', appyter, field_examples[default_file]), os.path.join(tmp_directory, default_file))
         else:
-          logger.info(f"Downloading example file {default_file} from {field_examples[default_file]}...")
+          logger.info(f"Fetching example file {default_file} from {field_examples[default_file]}...")
           try:
-            _, response = urllib.request.urlretrieve(field_examples[default_file], filename=os.path.join(tmp_directory, default_file))
-            assert response.get_content_type() != 'text/html', 'Expected data, got html'
+            path, content_type = examples.fetch(field_examples[default_file])
+            assert content_type != 'text/html', 'Expected data, got html'
+            reflink_or_copy(path, os.path.join(tmp_directory, default_file))
           except AssertionError as e:
             logger.warning(f"example file {default_file} from {field_examples[default_file]} resulted in error {str(e)}.")
             early_stopping = True
@@ -177,12 +546,14 @@ def validate_appyter(appyter):
   #
   if early_stopping:
     logger.warning(f"Stopping early as a download requires manual intervention.")
-    return
+    timer.stop()
+    return False
   logger.info(f"Fixing permissions...")
   assert Popen(['chmod', '-R', '777', tmp_directory]).wait() == 0, f"ERROR: Changing permissions failed"
+  timer.start('nbconstruct')
   logger.info(f"Constructing default notebook from appyter...")
   with Popen([
-    'docker', 'run',
+    'docker', 'run', '--rm',
     '-v', f"{tmp_directory}:/data",
     "-i", f"maayanlab/appyters-{config['name'].lower()}:{config['version']}",
     'appyter', 'nbconstruct',
@@ -197,9 +568,14 @@ def validate_appyter(appyter):
     assert p.wait() == 0, f"`appyter nbconstruct {nbfile}` command failed"
     assert os.path.exists(os.path.join(tmp_directory, config['appyter']['file'])), f"nbconstruct output was not created"
   #
+  timer.start('nbexecute')
   logger.info(f"Executing default notebook with appyter...")
+  container = f"validate-{appyter.lower()}-{uuid.uuid4().hex[:8]}"
+  profile = NotebookProfile()
+  sampler = None
   with Popen([
     'docker', 'run',
+    '--name', container,
     '-v', f"{tmp_directory}:/data",
     '-e', 'PYTHONPATH=/app',
     f"maayanlab/appyters-{config['name'].lower()}:{config['version']}",
@@ -209,25 +585,98 @@ def validate_appyter(appyter):
   ], stdout=PIPE, stderr=sys.stderr) as p:
     procLogger = logger.getChild(f"appyter nbexecute {nbfile}")
     last_msg = None
-    for msg in map(try_json_loads, p.stdout):
-      if type(msg) == dict and msg['type'] == 'error':
-        procLogger.error(f"{json.dumps(last_msg)}")
-        procLogger.error(f"{json.dumps(msg)}")
-        raise Exception(f"error {msg.get('data')}")
-      else:
-        procLogger.debug(f"{json.dumps(msg)}")
-        last_msg = msg
-    assert p.wait() == 0, f"`appyter nbexecute {nbfile}` command failed"
+    try:
+      for msg in map(try_json_loads, p.stdout):
+        # the container is certainly running once it has produced output
+        if sampler is None: sampler = sample_container_memory(container, profile)
+        profile.update(msg)
+        if type(msg) == dict and msg['type'] == 'error':
+          procLogger.error(f"{json.dumps(last_msg)}")
+          procLogger.error(f"{json.dumps(msg)}")
+          raise Exception(f"error {msg.get('data')}")
+        else:
+          procLogger.debug(f"{json.dumps(msg)}")
+          last_msg = msg
+      assert p.wait() == 0, f"`appyter nbexecute {nbfile}` command failed"
+    finally:
+      if sampler is not None: sampler.terminate()
+      # the named container would otherwise linger (still running if execution failed)
+      Popen(['docker', 'rm', '-f', container], stdout=PIPE, stderr=PIPE).communicate()
   #
+  timer.stop()
+  logger.info(f"Writing execution profile...")
+  report = dict(appyter=appyter, nbfile=nbfile, **profile.to_dict())
+  regressions = reports.record(appyter, report)
+  logger.info(format_profile(report, top=5))
+  logger.info(f"Suggested appyter.json resources: {json.dumps(suggest_resources(report))}")
+  assert regressions == [], 'Performance regressed from the baseline:\n' + '\n'.join(regressions)
   logger.info(f"Success!")
+  return True
+
+def run_validation(appyter, store=None, force=False, examples=None, reports=None):
+  ''' Validate a single appyter, returning (appyter, valid, timer). With a `store`,
+  appyters whose validation key already has a successful result are skipped unless `force`d.
+  Validations which stop early aren't failures but aren't stored either (`timer.stopped`).
+  '''
+  logger = logging.getLogger(appyter)
+  timer = StageTimer()
+  try:
+    key = validation_key(appyter) if store is not None else None
+    if key is not None and not force:
+      result = store.get(key)
+      if result is not None:
+        logger.info(f"Unchanged since successful validation at {result['validated']}, skipping (use --force to re-validate)")
+        timer.cached = True
+        return appyter, True, timer
+    if not validate_appyter(appyter, timer=timer, examples=examples, reports=reports):
+      timer.stopped = True
+    elif key is not None:
+      store.put(key, dict(
+        appyter=appyter,
+        validated=datetime.datetime.now().isoformat(),
+        stages=timer.stages,
+      ))
+    return appyter, True, timer
+  except Exception as e:
+    timer.stop()
+    logger.error(str(e))
+    logger.error(traceback.format_exc())
+    return appyter, False, timer
+
+def format_timings(results):
+  ''' Render a per-stage timing table (seconds) for each validated appyter
+  '''
+  stages = ['checks', 'docker build', 'nbinspect', 'examples', 'nbconstruct', 'nbexecute']
+  header = ['appyter', *stages, 'total', 'status']
+  rows = [
+    [
+      appyter,
+      *[f"{timer.stages[stage]:.1f}" if stage in timer.stages else '-' for stage in stages],
+      f"{sum(timer.stages.values()):.1f}",
+      'FAILED' if not valid else 'cached' if timer.cached else 'stopped' if timer.stopped else 'ok',
+    ]
+    for appyter, valid, timer in sorted(results)
+  ]
+  widths = [max(map(len, col)) for col in zip(header, *rows)]
+  return '\n'.join(
+    '  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+    for row in [header, *rows]
+  )
 
 @click.command(help='Performs validation tests for all appyters that were changed when diffing against origin/master')
 @click.option('-v', '--verbose', count=True, default=0, help='How verbose this should be, more -v = more verbose')
+@click.option('-j', '--jobs', type=int, default=None, help='Number of appyters to validate concurrently (defaults to what cores & memory allow)')
+@click.option('--force', default=False, is_flag=True, help='Re-validate appyters even if they are unchanged since their last successful validation')
+@click.option('--example-cache', default=os.path.join('.tmp', '.examples'), type=click.Path(file_okay=False), help='Directory in which downloaded example files are cached')
+@click.option('--example-mirror', envvar='APPYTER_EXAMPLE_MIRROR', default=None, type=click.Path(exists=True, file_okay=False), help='Serve example files from this local mirror ({host}/{path}) instead of downloading them')
+@click.option('--reports', 'reports_path', default=os.path.join('.tmp', '.reports'), type=click.Path(file_okay=False), help='Directory in which per-cell execution time & memory reports are written')
+@click.option('--baseline', default=None, type=click.Path(exists=True, file_okay=False), help='Fail when a cell regresses past the reports in this directory')
+@click.option('--tolerance', default=0.5, type=float, help='Fraction by which a cell may exceed its baseline time or memory')
 @click.option('--github-action', default=False, type=bool, is_flag=True, help='Use for receiving json on stdin from github actions')
-def validate_merge(github_action=False, verbose=0):
-  logging.basicConfig(level=30 - (verbose*10))
-  valid = True
-  for appyter in get_changed_appyters(github_action):
+def validate_merge(github_action=False, verbose=0, jobs=None, force=False, example_cache=None, example_mirror=None, reports_path=None, baseline=None, tolerance=0.5):
+  logging.basicConfig(level=30 - (verbose*10), format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
+  appyters = []
+  for appyter in sorted(get_changed_appyters(github_action)):
     logger = logging.getLogger(appyter)
     if not os.path.exists(os.path.join('appyters', appyter)):
       logger.info(f"{appyter} directory no longer exists, ignoring")
@@ -235,15 +684,29 @@ def validate_merge(github_action=False, verbose=0):
     elif not os.path.isdir(os.path.join('appyters', appyter)):
       logger.info(f"{appyter} is not a directory, ignoring")
       continue
-    #
-    try:
-      validate_appyter(appyter)
-    except Exception as e:
-      logger.error(str(e))
-      logger.error(traceback.format_exc())
-      valid = False
+    appyters.append(appyter)
+  #
+  if jobs is None: jobs = default_jobs()
+  jobs = max(1, min(jobs, len(appyters) or 1))
+  logging.getLogger('validate_merge').info(f"Validating {len(appyters)} appyter(s) with {jobs} worker(s)")
+  store = ResultStore()
+  examples = ExampleCache(example_cache, mirror=example_mirror)
+  reports = ProfileReports(reports_path, baseline=baseline, tolerance=tolerance)
+  if example_mirror is None:
+    prefetch_examples(examples, [
+      appyter
+      for appyter in appyters
+      if force or store.get(validation_key(appyter)) is None
+    ])
+  results = []
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    for future in as_completed([executor.submit(run_validation, appyter, store=store, force=force, examples=examples, reports=reports) for appyter in appyters]):
+      results.append(future.result())
+  #
+  if results:
+    click.echo(format_timings(results), err=True)
   #
-  if valid:
+  if all(valid for _, valid, _ in results):
     sys.exit(0)
   else:
     sys.exit(1)